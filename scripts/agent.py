@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+agent.py
+Run the issue pipeline in one process, passing the context in memory.
+
+Run as separate scripts, every stage pays for its own interpreter start-up
+and imports and re-reads issue_context.json from disk. agent.py runs the
+same stage functions (each script's main() is a thin wrapper around them)
+one after another in a single process:
+
+  collect  collect_issue_context.collect()       (skipped with --context)
+  plan     plan_sections.plan()                  -> ctx["required_sections"]
+  prepare  fetch_and_prepare_pdf.prepare_context()
+  select   select_prompt.select()                -> --selection-out (routes on
+                                                    the prepared PDFs' signals)
+  retrieve retrieval.retrieve_context()          (no-op unless RETRIEVAL=pdf|text)
+  upload   upload_to_gcs.upload_context()        (only with --bucket / GCS_BUCKET)
+  prompt   build_prompt.build()                  -> --prompt-out, --settings
+  model    run_gemini_sdk.run()                  -> --out
+
+A stage's modules are imported only when that stage runs: PyMuPDF is loaded
+by "prepare", the storage client by "upload" and the Vertex SDK by "model".
+The context is written to --context-out after every stage, so later workflow
+steps (and a rerun with --context and --stages) see the same files as
+before. Options agent.py does not know are passed on to run_gemini_sdk.py
+(e.g. --stream, --by-section, --mode map-reduce).
+
+Usage:
+  python scripts/agent.py --repo owner/name --issue 42 --event issue_comment \\
+      --project my-proj --location global --timings
+  python scripts/agent.py --context issue_context.json --stages upload,prompt,model ...
+
+--timings prints, per stage, the seconds spent importing its modules (and
+how many modules that loaded), initialising clients (storage, model SDK)
+and running it, plus the process start-up before agent.py's first line
+(Linux); --timings-out writes the same figures as JSON.
+"""
+
+from __future__ import annotations
+
+import time
+
+_T0 = time.perf_counter()
+
+import argparse
+import importlib
+import json
+import os
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+STAGES = ("collect", "plan", "prepare", "select", "retrieve", "upload", "prompt", "model")
+STAGE_MODULES = {
+    "collect": "collect_issue_context",
+    "plan": "plan_sections",
+    "prepare": "fetch_and_prepare_pdf",
+    "select": "select_prompt",
+    "retrieve": "retrieval",
+    "upload": "upload_to_gcs",
+    "prompt": "build_prompt",
+    "model": "run_gemini_sdk",
+}
+
+
+def _process_age() -> Optional[float]:
+    """Seconds since this process started (Linux /proc), else None."""
+    try:
+        with open("/proc/self/stat", encoding="ascii") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", encoding="ascii") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+_STARTUP_S = _process_age()
+
+
+def _write_json(path: str, obj) -> None:
+    p = Path(path)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_text(json.dumps(obj, indent=2), encoding="utf-8")
+
+
+def import_stage(stage: str, timings: Optional[dict] = None):
+    """Import a stage's module, recording the cost of a first import."""
+    t0, n0 = time.perf_counter(), len(sys.modules)
+    module = importlib.import_module(STAGE_MODULES[stage])
+    if timings is not None:
+        timings.setdefault(stage, {}).update(
+            import_s=round(time.perf_counter() - t0, 3), modules_loaded=len(sys.modules) - n0)
+    return module
+
+
+def run_pipeline(opts, gemini_argv: List[str] = (), timings: Optional[dict] = None) -> dict:
+    """Run the selected stages for one issue; returns the final context."""
+    timings = timings if timings is not None else {}
+    stages = opts.stages
+
+    def timed(stage: str, key: str, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings.setdefault(stage, {})[key] = round(time.perf_counter() - t0, 3)
+
+    def save(ctx: dict) -> dict:
+        _write_json(opts.context_out, ctx)
+        return ctx
+
+    if opts.context:
+        with open(opts.context, encoding="utf-8") as f:
+            ctx = json.load(f)
+        if opts.issue is not None:
+            ctx["issue_number"] = opts.issue
+    elif "collect" in stages:
+        m = import_stage("collect", timings)
+        ctx = save(timed("collect", "run_s", m.collect, opts.repo, opts.issue, opts.event))
+    else:
+        raise SystemExit("No issue context: pass --context or run the collect stage (--repo, --issue)")
+
+    if "plan" in stages:
+        m = import_stage("plan", timings)
+        ctx["required_sections"] = timed("plan", "run_s", m.plan, ctx)
+        save(ctx)
+
+    if "prepare" in stages:
+        m = import_stage("prepare", timings)
+        save(timed("prepare", "run_s", m.prepare_context, ctx, opts.output_root))
+
+    selection = None
+    if "select" in stages:
+        if Path(opts.routing).exists():
+            m = import_stage("select", timings)
+            selection = timed("select", "run_s", lambda: m.select(ctx, m.load_routing(opts.routing)))
+            _write_json(opts.selection_out, selection)
+        else:
+            print(f"WARN: routing file {opts.routing} not found; using the default prompts", file=sys.stderr)
+    if selection is None and Path(opts.selection_out).exists():
+        with open(opts.selection_out, encoding="utf-8") as f:
+            selection = json.load(f)
+
+    if "retrieve" in stages:
+        m = import_stage("retrieve", timings)
+        save(timed("retrieve", "run_s", m.retrieve_context, ctx))
+
+    if "upload" in stages and opts.bucket:
+        m = import_stage("upload", timings)
+        timed("upload", "init_s", m.default_client, os.environ.get("GCP_PROJECT_ID") or None)
+        result = timed("upload", "run_s", m.upload_context, ctx, opts.bucket)
+        save(ctx)
+        print(f"GCS: {result['uploaded']} uploaded, {result['skipped']} unchanged, "
+              f"{result['bytes']} bytes in {result['wall_s']}s", file=sys.stderr)
+    elif "upload" in stages:
+        print("INFO: no --bucket / GCS_BUCKET; skipping upload", file=sys.stderr)
+
+    model_id = (ctx.get("policy") or {}).get("model") or opts.model
+    prompt_text = system_instruction = None
+    if "prompt" in stages:
+        m = import_stage("prompt", timings)
+        prompt_text, settings = timed("prompt", "run_s", m.build, ctx, model_id, (selection or {}).get("chosen"))
+        system_instruction = settings.get("systemInstruction")
+        Path(opts.prompt_out).parent.mkdir(parents=True, exist_ok=True)
+        Path(opts.prompt_out).write_text(prompt_text, encoding="utf-8")
+        _write_json(opts.settings, settings)
+
+    if "model" in stages:
+        m = import_stage("model", timings)
+        args = m.build_parser().parse_args([
+            "--context", opts.context_out, "--model", model_id, "--prompt-file", opts.prompt_out,
+            "--project", opts.project, "--location", opts.location, "--out", opts.out,
+            "--settings", opts.settings, *gemini_argv,
+        ])
+        if prompt_text is None:
+            prompt_text = m.read_text(opts.prompt_out)
+            if Path(opts.settings).exists():
+                system_instruction = m.load_json(opts.settings).get("systemInstruction")
+        # SDK import + init, so the model's run time is the model's
+        timed("model", "init_s", m.model_backend.get_backend, args.backend_name, args.project, args.location)
+        text = timed("model", "run_s", m.run, args, ctx, prompt_text, system_instruction or None)
+        save(ctx)
+        if text:
+            print(f"OK: wrote Gemini output to {opts.out} ({len(text)} chars)")
+        else:
+            print("ERROR: Gemini returned no text", file=sys.stderr)
+    return ctx
+
+
+def report_timings(timings: dict, total_s: float) -> dict:
+    """Print the --timings table to stderr; returns the JSON form."""
+    out = {
+        "process_startup_s": round(_STARTUP_S, 3) if _STARTUP_S is not None else None,
+        "stages": timings,
+        "total_s": round(total_s, 3),
+    }
+    def cell(t: dict, key: str, width: int) -> str:
+        v = t.get(key)
+        if v is None:
+            return " " * width
+        return f"{v:>{width}d}" if isinstance(v, int) else f"{v:>{width}.3f}"
+
+    print(f"{'stage':<10}{'import_s':>10}{'modules':>9}{'init_s':>9}{'run_s':>9}", file=sys.stderr)
+    if _STARTUP_S is not None:
+        print(f"{'startup':<10}{_STARTUP_S:>10.3f}", file=sys.stderr)
+    for stage in ("agent",) + STAGES:
+        t = timings.get(stage)
+        if t is not None:
+            print(f"{stage:<10}" + cell(t, "import_s", 10) + cell(t, "modules_loaded", 9)
+                  + cell(t, "init_s", 9) + cell(t, "run_s", 9), file=sys.stderr)
+    print(f"{'total':<10}{total_s:>37.3f}", file=sys.stderr)
+    return out
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="Run the issue pipeline in one process",
+                                epilog="Other options are passed to run_gemini_sdk.py.")
+    p.add_argument("--repo", default=os.environ.get("GITHUB_REPOSITORY", ""))
+    p.add_argument("--issue", type=int, default=None)
+    p.add_argument("--event", default="issues", choices=["issues", "issue_comment"])
+    p.add_argument("--context", default="", help="start from this issue context instead of collecting it")
+    p.add_argument("--stages", default=",".join(STAGES), help=f"comma-separated subset of {','.join(STAGES)}")
+    p.add_argument("--output-root", default=os.environ.get("OUTPUT_ROOT", "docs/issue-reports"))
+    p.add_argument("--routing", default=os.path.join(os.environ.get("PROMPTS_DIR", "prompts"), "routing.yaml"))
+    p.add_argument("--bucket", default=os.environ.get("GCS_BUCKET", ""), help="gs://bucket; upload is skipped without one")
+    p.add_argument("--project", default=os.environ.get("GCP_PROJECT_ID", ""))
+    p.add_argument("--location", default=os.environ.get("GCP_LOCATION", "global"))
+    p.add_argument("--model", default="gemini-2.5-pro", help="model when the prepared context names none")
+    p.add_argument("--context-out", default="issue_context.json")
+    p.add_argument("--selection-out", default="prompt_selection.json")
+    p.add_argument("--prompt-out", default="prompt.txt")
+    p.add_argument("--settings", default=os.path.join(".gemini", "settings.json"))
+    p.add_argument("--out", default="summary.txt")
+    p.add_argument("--timings", action="store_true", help="print import/start-up/run seconds per stage")
+    p.add_argument("--timings-out", default="", help="write the timings JSON here")
+    return p
+
+
+def parse_args(argv=None) -> tuple:
+    """(options, arguments for run_gemini_sdk.py)."""
+    p = build_parser()
+    opts, gemini_argv = p.parse_known_args(argv)
+    opts.stages = [s.strip() for s in opts.stages.split(",") if s.strip()]
+    unknown = sorted(set(opts.stages) - set(STAGES))
+    if unknown:
+        p.error(f"unknown stage(s): {', '.join(unknown)}")
+    if not opts.context and "collect" in opts.stages and (opts.issue is None or not opts.repo):
+        p.error("collecting the issue needs --issue and --repo (or GITHUB_REPOSITORY)")
+    return opts, gemini_argv
+
+
+def main(argv=None):
+    opts, gemini_argv = parse_args(argv)
+    timings: dict = {"agent": {"import_s": round(time.perf_counter() - _T0, 3)}}
+    t0 = time.perf_counter()
+    try:
+        run_pipeline(opts, gemini_argv, timings)
+    finally:
+        if opts.timings or opts.timings_out:
+            out = report_timings(timings, time.perf_counter() - t0)
+            if opts.timings_out:
+                _write_json(opts.timings_out, out)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,11 @@ Compose the system instruction and user prompt for Gemini. The system
 instruction is assembled from a persona template and one or more task
 templates selected by the prompt selection script. The user prompt
 includes issue context (title, body, comments), references to the
-source documents in Google Cloud Storage, and relative image paths for
-extracted images. When relevant, a small set of curated regulatory
-snippets (micro-RAG) for Australian payments is appended.
+source documents in Google Cloud Storage (with the kept page ranges, or
+the page excerpts themselves, when retrieval.py trimmed them), and relative
+image paths for extracted images. When relevant, a small set of curated regulatory
+snippets (micro-RAG) for Australian payments is appended, ranked by
+relevance to the issue and fitted to a token budget (snippet_store.py).
 
 The script writes the final prompt to a text file and emits system
 instruction and other settings in a JSON file used by the Gemini CLI
@@ -16,17 +18,19 @@ GitHub Action.
 import argparse
 import json
 import os
+import sys
 from pathlib import Path
-from util import read_json
+from util import read_cached, read_json
 
 
 def load_text(p):
-    return Path(p).read_text(encoding="utf-8")
+    return read_cached(p)
 
 
-def _load_required_sections():
+def _load_required_sections(planned=None):
     """
-    Load planned/required sections if provided by the planner step.
+    Load planned/required sections if provided by the planner step
+    (ctx["required_sections"] when run by agent.py, else required_sections.json).
     Fallback: None (so existing behavior is unchanged).
     Also supports an env override CUSTOM_REQUIRED_SECTIONS="A,B,C".
     """
@@ -34,6 +38,8 @@ def _load_required_sections():
     if env_val:
         parts = [s.strip() for s in env_val.split(",") if s.strip()]
         return parts or None
+    if planned:
+        return list(planned)
 
     rs_path = Path("required_sections.json")
     if rs_path.exists():
@@ -47,15 +53,8 @@ def _load_required_sections():
     return None
 
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--context", required=True)
-    ap.add_argument("--model", required=True)
-    ap.add_argument("--out", required=True)
-    ap.add_argument("--settings", required=True)
-    args = ap.parse_args()
-
-    ctx = read_json(args.context)
+def build(ctx, model, chosen_ids=None):
+    """Return (prompt, settings) for an issue context and the selected prompt IDs."""
     issue = ctx["issue_number"]
     title = ctx.get("title", "")
     body = ctx.get("body", "") or ""
@@ -66,13 +65,6 @@ def main():
     # Determine prompts directory (passed via env in workflow)
     prompts_dir = os.environ.get("PROMPTS_DIR", "prompts")
 
-    # Load prompt selection result
-    chosen_ids = []
-    if Path("prompt_selection.json").exists():
-        try:
-            chosen_ids = json.loads(Path("prompt_selection.json").read_text()).get("chosen", [])
-        except Exception:
-            chosen_ids = []
     if not chosen_ids:
         chosen_ids = ["npp_requirements"]
 
@@ -96,7 +88,7 @@ def main():
     images = sorted([p.name for p in images_dir.glob("*.png")]) if images_dir.exists() else []
 
     # Load planned sections (if present)
-    required_sections = _load_required_sections()
+    required_sections = _load_required_sections(ctx.get("required_sections"))
 
     # Build user prompt
     prompt = f"""
@@ -115,6 +107,19 @@ CONTEXT:
 
 SOURCE DOCUMENT(S):
 """.strip() + "\n" + "\n".join(["- " + u for u in gcs_uris]) + "\n\n"
+    retrieval = ctx.get("retrieval") or {}
+    if retrieval.get("applied"):
+        # retrieval.py kept only the pages relevant to this issue
+        spans = "; ".join(
+            f"{src} pages " + ", ".join(f"{a}-{b}" if a != b else str(a) for a, b in rs)
+            for src, rs in (retrieval.get("ranges") or {}).items()
+        )
+        if retrieval.get("excerpts_path"):
+            prompt += f"DOCUMENT EXCERPTS ({spans}; each page is headed with its source and original page number):\n"
+            prompt += load_text(retrieval["excerpts_path"]).strip() + "\n\n"
+        else:
+            prompt += f"NOTE: the document(s) above hold only the pages relevant to this issue ({spans}). " \
+                      "Cite the original page numbers listed here.\n\n"
     prompt += "IMAGES EXTRACTED FROM THE PDF (embed where they belong; if unsure, place near matching section):\n"
     prompt += "\n".join(["- " + "images/" + fn for fn in images]) + "\n\n"
     prompt += "OUTPUT:\n"
@@ -133,26 +138,20 @@ SOURCE DOCUMENT(S):
         rag_path = Path(prompts_dir) / "standards" / "au_snippets.yaml"
         if rag_path.exists():
             try:
-                import yaml  # lazy import so we don't hard-require it if not used
-                snips = yaml.safe_load(rag_path.read_text(encoding="utf-8")) or []
-                lines = []
-                for s in snips[:8]:
-                    # be defensive: each snippet should have id/title/text/source
-                    sid = s.get("id", "ref")
-                    ttl = s.get("title", "Untitled")
-                    txt = s.get("text", "").strip()
-                    src = s.get("source", "")
-                    lines.append(f"- [{sid}] {ttl}: {txt} (Source: {src})")
+                import snippet_store  # compiled + ranked; see snippet_store.py
+
+                lines = [snippet_store.render(s) for s in snippet_store.select(rag_path, ctx, chosen_ids)]
                 if lines:
                     rag_block = "REFERENCE SNIPPETS (AU standards):\n" + "\n".join(lines)
-            except Exception:
+            except Exception as e:
+                print(f"WARN: reference snippets skipped: {e}", file=sys.stderr)
                 rag_block = ""
     if rag_block:
         prompt += "\n" + rag_block + "\n"
 
     # Write settings JSON
     settings = {
-        "model": args.model,
+        "model": model,
         "vertexAI": {
             "project": os.environ.get("GCP_PROJECT_ID"),
             # Keep existing default to avoid breaking callers; location used by SDK step.
@@ -160,6 +159,29 @@ SOURCE DOCUMENT(S):
         },
         "systemInstruction": system_instruction,
     }
+    return prompt, settings
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--context", required=True)
+    ap.add_argument("--model", required=True)
+    ap.add_argument("--out", required=True)
+    ap.add_argument("--settings", required=True)
+    ap.add_argument("--selection", default="prompt_selection.json", help="output of select_prompt.py")
+    args = ap.parse_args(argv)
+
+    ctx = read_json(args.context)
+
+    # Load prompt selection result
+    chosen_ids = []
+    if Path(args.selection).exists():
+        try:
+            chosen_ids = json.loads(Path(args.selection).read_text()).get("chosen", [])
+        except Exception:
+            chosen_ids = []
+
+    prompt, settings = build(ctx, args.model, chosen_ids)
     Path(args.settings).parent.mkdir(parents=True, exist_ok=True)
     with open(args.settings, "w", encoding="utf-8") as f:
         json.dump(settings, f)
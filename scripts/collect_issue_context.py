@@ -25,7 +25,7 @@ import re
 import subprocess
 import sys
 from typing import List, Set
-import requests
+from util import http_head
 
 # Any http(s) URL candidates
 URL_RE = re.compile(r"""https?://[^\s<>()\[\]"]+""", re.IGNORECASE)
@@ -73,12 +73,11 @@ def is_pdf_url(url: str, headers: dict) -> bool:
     """
     if url.lower().split("?")[0].endswith(".pdf"):
         return True
-    try:
-        r = requests.head(url, headers=headers, timeout=8, allow_redirects=True)
-        ctype = (r.headers.get("Content-Type") or "").lower()
-        return "application/pdf" in ctype
-    except requests.RequestException:
+    r = http_head(url, headers=headers)
+    if r is None:
         return False
+    ctype = (r.headers.get("Content-Type") or "").lower()
+    return "application/pdf" in ctype
 
 def collect_pdf_refs(issue_body: str, comments: List[dict], headers: dict) -> List[str]:
     """Collect unique PDF references from issue body and comments.
@@ -111,22 +110,16 @@ def collect_pdf_refs(issue_body: str, comments: List[dict], headers: dict) -> Li
     # Merge (keep order stable: URLs first, then local paths)
     return pdf_urls + sorted(repo_candidates)
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--repo", required=True)
-    ap.add_argument("--issue", required=True, type=int)
-    ap.add_argument("--event", required=True, choices=["issues", "issue_comment"])
-    ap.add_argument("--out-json", required=True)
-    args = ap.parse_args()
-
+def collect(repo: str, issue_number: int, event: str) -> dict:
+    """Build the issue context (see module docstring) for repo#issue_number."""
     # Query the issue and its comments using gh.
-    issue = gh_json(["gh", "api", f"repos/{args.repo}/issues/{args.issue}"])
-    comments = gh_json(["gh", "api", f"repos/{args.repo}/issues/{args.issue}/comments"])
+    issue = gh_json(["gh", "api", f"repos/{repo}/issues/{issue_number}"])
+    comments = gh_json(["gh", "api", f"repos/{repo}/issues/{issue_number}/comments"])
 
     title = issue.get("title", "")
     body = issue.get("body") or ""
     latest_comment = None
-    if args.event == "issue_comment" and comments:
+    if event == "issue_comment" and comments:
         latest_comment = (comments[-1].get("body") or "")
 
     # Prepare authorization header for HEAD requests (for URL Content-Type checks)
@@ -138,8 +131,8 @@ def main():
 
     pdf_refs = collect_pdf_refs(body, comments, headers)
 
-    out = {
-        "issue_number": args.issue,
+    return {
+        "issue_number": issue_number,
         "title": title,
         "body": body,
         "latest_comment": latest_comment,
@@ -147,9 +140,19 @@ def main():
         "pdf_urls": pdf_refs,   # may contain URLs and/or repo-local paths
         "is_update": bool(latest_comment),
     }
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repo", required=True)
+    ap.add_argument("--issue", required=True, type=int)
+    ap.add_argument("--event", required=True, choices=["issues", "issue_comment"])
+    ap.add_argument("--out-json", required=True)
+    args = ap.parse_args(argv)
+
+    out = collect(args.repo, args.issue, args.event)
     with open(args.out_json, "w", encoding="utf-8") as f:
         json.dump(out, f, indent=2)
-    print(f"Wrote {args.out_json} with {len(pdf_refs)} PDF reference(s).")
+    print(f"Wrote {args.out_json} with {len(out['pdf_urls'])} PDF reference(s).")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,103 @@
+"""
+continuation.py
+Bounded continuation context and overlap-aware splicing for run_gemini_sdk.py.
+
+A continuation pass used to resend the whole report so far as PRIOR_OUTPUT
+and append the reply with a newline, so input grew quadratically with the
+number of passes and anything the model repeated ended up in the report
+twice. Instead:
+
+  - prior_block(text) sends an outline of the headings written so far plus
+    only the last GEMINI_CONT_WINDOW_CHARS characters (default 6000);
+  - splice(text, more) joins the reply at the longest suffix/prefix overlap
+    between the two (found with a rolling hash, verified by comparison), so
+    text the model repeats from the end of the window is dropped. Overlaps
+    shorter than MIN_OVERLAP are only trusted when they cover exactly the
+    unfinished last line.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from typing import List
+
+__all__ = [
+    "PRIOR_MARKER",
+    "window_chars",
+    "outline",
+    "prior_block",
+    "overlap",
+    "splice",
+]
+
+PRIOR_MARKER = "PRIOR_OUTPUT (last part only; do not repeat; continue from the exact end):\n"
+MIN_OVERLAP = 12
+MAX_OVERLAP = 8000
+MAX_OUTLINE = 80
+
+_HEADING_RE = re.compile(r"^(#{1,4})\s+(.+?)\s*#*\s*$", re.M)
+_BASE = 257
+_MOD = (1 << 61) - 1
+
+
+def window_chars() -> int:
+    """Tail window sent with each continuation (GEMINI_CONT_WINDOW_CHARS)."""
+    try:
+        return max(500, int(os.environ.get("GEMINI_CONT_WINDOW_CHARS", "6000")))
+    except ValueError:
+        return 6000
+
+
+def outline(text: str) -> List[str]:
+    """Markdown headings in text, in order (the last MAX_OUTLINE of them)."""
+    heads = [f"{m.group(1)} {m.group(2)}" for m in _HEADING_RE.finditer(text or "")]
+    return heads[-MAX_OUTLINE:]
+
+
+def prior_block(text: str, window: int = 0) -> str:
+    """Continuation context: heading outline + the tail window of text."""
+    window = window or window_chars()
+    tail = text[-window:]
+    if len(text) > window:
+        # start the window on a line boundary when one is close
+        cut = tail.find("\n")
+        if 0 <= cut < 200:
+            tail = tail[cut + 1:]
+    heads = outline(text)
+    block = "\n\n"
+    if heads:
+        block += "OUTLINE_SO_FAR (headings already written, in order; do not restart them):\n"
+        block += "\n".join(heads) + "\n\n"
+    return block + PRIOR_MARKER + tail
+
+
+def overlap(text: str, more: str, max_len: int = MAX_OVERLAP) -> int:
+    """Length k of the longest suffix of text equal to the prefix more[:k]."""
+    n = min(len(text), len(more), max_len)
+    h_suffix = h_prefix = 0
+    power, best = 1, 0
+    for k in range(1, n + 1):
+        h_prefix = (h_prefix * _BASE + ord(more[k - 1])) % _MOD
+        h_suffix = (ord(text[-k]) * power + h_suffix) % _MOD
+        power = power * _BASE % _MOD
+        if h_suffix == h_prefix and text[-k:] == more[:k]:
+            best = k
+    return best
+
+
+def splice(text: str, more: str) -> str:
+    """Append a continuation reply to text, dropping what it repeats."""
+    if not text:
+        return (more or "").strip()
+    if not more or not more.strip():
+        return text
+    text = text.rstrip()
+    more = more.lstrip("\n")
+    k = overlap(text, more)
+    last_line = len(text) - (text.rfind("\n") + 1)
+    if k >= MIN_OVERLAP or (k and k == last_line):
+        return (text + more[k:]).strip()
+    if more[:1].isspace() or more[:1] in ",.;:)]":
+        return (text + more).strip()
+    return (text + "\n" + more).strip()
@@ -7,45 +7,70 @@ paths to the final PDFs, their GCS URIs, and extraction policy metadata.
 
 New behavior:
 - Entries in ctx["pdf_urls"] may be HTTP(S) URLs OR repo-local paths (e.g., upload-pdf/my.pdf).
-- Local paths are resolved relative to the repo root, validated, and copied into a temp workspace.
+- Local paths are resolved relative to the repo root, validated, and placed into the
+  workspace (PREP_WORK_DIR, default .agent/work) with a reflink or hardlink when the
+  filesystem allows, falling back to a copy (see pdf_io.py). Each PDF is then opened
+  once per process and shared by indexing, OCR, splitting and extraction; peak
+  memory and I/O bytes are reported in ctx["ingest"]["resources"].
+- Several PDFs are ingested concurrently (INGEST_CONCURRENCY, default 2): the fetch of
+  PDF N+1 overlaps the OCR/extraction of PDF N, CPU-bound stages share one process
+  pool, and per-PDF stage timings are written to ctx["ingest"].
 
 Selective extraction mode (default) extracts images only from interesting
 pages based on heuristics: first few pages, every 20th page, pages that
 contain headings, or pages flagged as image heavy. Full extraction can be
 triggered by setting the EXTRACT_MODE environment variable to "full".
+Repeated images are written once: by xref within a PDF, by content hash across
+pages, PDFs and runs, and optionally by perceptual hash (IMAGE_PHASH=1). The
+pages showing each kept image are recorded in ctx["image_refs"].
 
 Large PDFs (>50MB or >1000 pages) are split into chunks so they fit within
-Vertex AI size limits. OCR is applied only when the PDF lacks a text layer.
-
-An up-front HEAD request caps the download size to avoid PDF bombs for HTTP(S) inputs.
+Vertex AI size limits. Parts are packed from measured per-page object sizes and
+ctx["part_manifest"] maps every part back to its original page range. OCR is applied page by page, only to pages that lack a
+text layer, in parallel and cached per page content.
+
+HTTP(S) inputs are fetched with util.http_download() on a shared keep-alive
+session: the size cap (avoids PDF bombs) is enforced from Content-Length and
+while streaming, dropped connections resume with a Range request, and the
+SHA-256 is computed during the download so the cache does not rehash the file.
+
+Prepared outputs (final PDFs, split parts, images, policy) are cached by the
+SHA-256 of the source bytes plus EXTRACT_MODE and split limits (see
+pdf_cache.py), so re-runs on an unchanged PDF skip OCR, splitting and
+extraction entirely.
 """
 
 from __future__ import annotations
 
 import argparse
+import multiprocessing
 import os
 import tempfile
 import fitz
+import hashlib
 import subprocess
+import sys
+import threading
+import time
 import json
 import math
 import re
-import requests
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
-from util import mkdirp, http_get, read_json, write_json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from util import mkdirp, http_download, read_json, tmp_path, write_json
+import pdf_cache
+import page_index
+import image_store
+import pdf_io
 
 MAX_BYTES = 200 * 1024 * 1024  # 200 MB guard against oversized downloads (HTTP and local)
+SPLIT_MAX_PAGES = 1000  # Vertex AI page limit per PDF part
+SPLIT_TARGET_MB = 50    # Vertex AI size limit per PDF part
 
-
-def head_size(url: str, headers: dict) -> int:
-    """Return Content-Length of URL or zero if unavailable."""
-    try:
-        r = requests.head(url, headers=headers, timeout=8, allow_redirects=True)
-        cl = r.headers.get("Content-Length")
-        return int(cl) if cl and cl.isdigit() else 0
-    except Exception:
-        return 0
+# PyMuPDF is not thread-safe. PDFs are ingested on concurrent threads, so
+# in-process fitz work is serialised here; the heavy lifting (extraction and
+# part saving on the process pool, ocrmypdf subprocesses, downloads) overlaps.
+FITZ_LOCK = threading.RLock()
 
 
 def is_http_url(s: str) -> bool:
@@ -70,215 +95,732 @@ def resolve_repo_path(path_like: str) -> Path:
     return p
 
 
-def quick_text_probe(pdf_path) -> bool:
-    """Check if a PDF appears to contain any text layer by sampling pages."""
+def ocr_pdf(in_path, out_path, jobs=None):
+    """Run OCR on a PDF using ocrmypdf, preserving existing text."""
+    cmd = ["ocrmypdf", "--skip-text", "--quiet"]
+    if jobs:
+        cmd += ["--jobs", str(jobs)]
+    subprocess.check_call(cmd + [str(in_path), str(out_path)])
+
+
+# ----- Page-level OCR -----
+
+def pages_needing_ocr(index):
+    """Pages without a text layer that draw anything at all (images, inline images or paths)."""
+    return [
+        i for i in range(index["page_count"])
+        if not index["has_text"][i] and not index["blank"][i]
+    ]
+
+
+def page_content_key(doc, page_no) -> str:
+    """Hash of what OCR sees on a page: geometry, content streams and image streams."""
+    pg = doc.load_page(page_no)
+    h = hashlib.sha256()
+    h.update(f"{tuple(pg.rect)}|{pg.rotation}|".encode("ascii"))
+    h.update(pg.read_contents() or b"")
+    for img in pg.get_images(full=True):
+        h.update(doc.xref_stream_raw(img[0]) or b"")
+    return h.hexdigest()
+
+
+def ocr_workers() -> int:
+    """Parallel single-page OCR processes (OCR_WORKERS overrides)."""
     try:
-        doc = fitz.open(pdf_path)
-        for i in range(min(5, len(doc))):
-            if doc.load_page(i).get_text().strip():
-                doc.close()
-                return True
-        doc.close()
-        return False
+        return max(1, int(os.environ.get("OCR_WORKERS", "")))
+    except ValueError:
+        return os.cpu_count() or 2
+
+
+def _ocr_one(single_page_pdf, cached_path):
+    tmp = tmp_path(cached_path)
+    ocr_pdf(single_page_pdf, tmp, jobs=1)
+    os.replace(tmp, cached_path)
+
+
+def ocr_missing_pages(pdf_path, out_path, pages, work_dir, pool=None):
+    """OCR only the given pages (0-based) and merge them into one searchable PDF.
+
+    Each page is cut into a one-page PDF and OCR'd by its own ocrmypdf process
+    on pool (the run-wide OCR thread pool; a private one with ocr_workers()
+    threads is created when omitted). Results are cached by page_content_key()
+    under <PDF_CACHE_DIR>/ocr, so identical pages (repeated scans, re-runs)
+    are OCR'd once. All other pages are copied from the source unchanged.
+    """
+    root = pdf_cache.cache_root()
+    cache_dir = (root / "ocr") if root is not None else Path(work_dir) / "ocr"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    stem = Path(pdf_path).stem
+
+    ocrd, jobs = {}, {}
+    with FITZ_LOCK:
+        doc = pdf_io.open_doc(pdf_path)
+        for i in pages:
+            key = page_content_key(doc, i)
+            ocrd[i] = cache_dir / f"{key}.pdf"
+            if not ocrd[i].exists() and key not in jobs:
+                single = os.path.join(work_dir, f"{stem}-ocr-{i+1}.pdf")
+                one = fitz.open()
+                one.insert_pdf(doc, from_page=i, to_page=i)
+                one.save(single)
+                one.close()
+                jobs[key] = (single, ocrd[i])
+
+    # ocrmypdf runs as a subprocess, so threads are enough to use every core
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPoolExecutor(max_workers=ocr_workers())
+    try:
+        for fut in [pool.submit(_ocr_one, *job) for job in jobs.values()]:
+            fut.result()
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    with FITZ_LOCK:
+        doc = pdf_io.open_doc(pdf_path)
+        out, start = fitz.open(), 0
+        for i in sorted(ocrd):
+            if start < i:
+                out.insert_pdf(doc, from_page=start, to_page=i - 1)
+            page_doc = fitz.open(ocrd[i])
+            out.insert_pdf(page_doc)
+            page_doc.close()
+            start = i + 1
+        if start < len(doc):
+            out.insert_pdf(doc, from_page=start, to_page=len(doc) - 1)
+        out.set_toc(doc.get_toc())
+        out.set_metadata(doc.metadata or {})
+        out.save(out_path, garbage=3, deflate=True)
+        out.close()
+    print(f"OCR: {len(pages)} page(s) without text, {len(jobs)} OCR'd, {len(pages) - len(jobs)} from cache", file=sys.stderr)
+    return out_path
+
+
+def get_page_count(pdf_path, index=None) -> int:
+    try:
+        index = index or page_index.load_or_build(pdf_path)
+        return index["page_count"]
     except Exception:
-        return False
+        return 0
 
 
-def ocr_pdf(in_path, out_path):
-    """Run OCR on a PDF using ocrmypdf, preserving existing text."""
-    subprocess.check_call(["ocrmypdf", "--skip-text", "--quiet", in_path, out_path])
+# ----- Size-accurate splitting -----
+
+SPLIT_SAFETY = 0.9  # pack to 90% of the byte limit; saved parts carry some overhead
 
 
-def get_page_count(pdf_path) -> int:
+def _xref_ref(doc, xref, key) -> int:
+    """Follow an indirect reference stored under key in xref's dictionary (0 if none)."""
     try:
-        d = fitz.open(pdf_path)
-        n = len(d)
-        d.close()
-        return n
+        kind, val = doc.xref_get_key(xref, key)
+        if kind == "xref":
+            return int(val.split()[0])
+        if kind == "array" and key == "DescendantFonts":
+            return int(val.strip("[]").split()[0])
+    except Exception:
+        pass
+    return 0
+
+
+def _xref_size(doc, xref) -> int:
+    """Bytes an object contributes to a saved PDF: dictionary plus stream."""
+    try:
+        return len(doc.xref_object(xref, compressed=True)) + page_index.stream_length(doc, xref)
     except Exception:
         return 0
 
 
-def split_pdf_by_pages(pdf_path, out_dir, max_pages=1000, target_mb=50):
-    """Split a PDF into chunks that meet page and size limits."""
-    doc = fitz.open(pdf_path)
-    total = len(doc)
-    size_mb = os.path.getsize(pdf_path) / (1024 * 1024)
-    # approximate pages per part by size ratio
-    pages_by_size = max(1, math.floor(total * (target_mb / max(1e-6, size_mb))))
-    pages_per_part = min(max_pages, pages_by_size)
-    parts, start = [], 0
-    while start < total:
-        end = min(total, start + pages_per_part)
-        part = fitz.open()
-        part.insert_pdf(doc, from_page=start, to_page=end - 1)
-        outp = os.path.join(out_dir, f"{Path(pdf_path).stem}-part-{len(parts)+1}.pdf")
-        part.save(outp)
-        part.close()
-        parts.append(outp)
-        start = end
-    doc.close()
-    return parts
+def page_resource_sizes(doc, page_no) -> dict:
+    """{xref: bytes} for the objects a page pulls into a part: the page itself,
+    content streams, images (with soft masks), form XObjects and embedded font
+    programs. Shared xrefs (fonts, logos) are costed once per part by the packer."""
+    pg = doc.load_page(page_no)
+    xrefs = {pg.xref}
+    xrefs.update(pg.get_contents())
+    for img in pg.get_images(full=True):
+        xrefs.update(x for x in img[:2] if x)
+    xrefs.update(x[0] for x in pg.get_xobjects() if x[0])
+    for font in pg.get_fonts(full=True):
+        fx = font[0]
+        if not fx:
+            continue
+        xrefs.add(fx)
+        desc = _xref_ref(doc, _xref_ref(doc, fx, "DescendantFonts") or fx, "FontDescriptor")
+        for key in ("FontFile", "FontFile2", "FontFile3"):
+            ff = _xref_ref(doc, desc, key) if desc else 0
+            if ff:
+                xrefs.add(ff)
+    return {x: _xref_size(doc, x) for x in xrefs}
+
+
+def pack_page_ranges(sizes, max_pages, max_bytes):
+    """Greedily pack pages into (start, end) ranges within page and byte limits.
+
+    sizes is the per-page {xref: bytes} list; an xref already in the current
+    range adds nothing, so shared resources are not double counted. Returns
+    [(start, end, estimated_bytes)] with end exclusive.
+    """
+    ranges, start, seen, used = [], 0, set(), 0
+    for i, res in enumerate(sizes):
+        add = sum(b for x, b in res.items() if x not in seen)
+        if i > start and (used + add > max_bytes or i - start >= max_pages):
+            ranges.append((start, i, used))
+            start, seen, used = i, set(), sum(res.values())
+        else:
+            used += add
+        seen.update(res)
+    if sizes:
+        ranges.append((start, len(sizes), used))
+    return ranges
+
+
+def save_page_range(pdf_path, start, end, out_path):
+    """Pool task: write pages [start, end) of pdf_path to out_path; returns its size."""
+    part = fitz.open()
+    part.insert_pdf(pdf_io.open_doc(pdf_path), from_page=start, to_page=end - 1)
+    part.save(out_path, garbage=3, deflate=True)
+    part.close()
+    return os.path.getsize(out_path)
+
+
+def split_pdf_by_size(pdf_path, out_dir, pool=None, max_pages=SPLIT_MAX_PAGES, target_mb=SPLIT_TARGET_MB):
+    """Split a PDF into parts that meet page and size limits.
+
+    Each page's real size contribution is measured from the objects it
+    references (page_resource_sizes) and pages are packed greedily up to
+    max_pages and SPLIT_SAFETY * target_mb. Parts are saved in parallel on
+    pool. Any saved part still over target_mb is halved and re-saved.
+
+    Returns the manifest: [{"path", "first_page", "last_page", "bytes"}] with
+    1-based, inclusive page numbers of the original PDF, in page order.
+    """
+    limit = target_mb * 1024 * 1024
+    with FITZ_LOCK:
+        doc = pdf_io.open_doc(pdf_path)
+        sizes = [page_resource_sizes(doc, i) for i in range(len(doc))]
+    ranges = [(s, e) for s, e, _ in pack_page_ranges(sizes, max_pages, int(limit * SPLIT_SAFETY))]
+
+    own_pool = pool is None
+    if own_pool:
+        pool = process_pool()
+    stem = Path(pdf_path).stem
+    done = {}
+    try:
+        while ranges:
+            futures = {
+                (s, e): pool.submit(save_page_range, pdf_path, s, e, os.path.join(out_dir, f"{stem}-pages-{s+1}-{e}.pdf"))
+                for s, e in ranges
+            }
+            ranges = []
+            for (s, e), fut in futures.items():
+                size = fut.result()
+                path = os.path.join(out_dir, f"{stem}-pages-{s+1}-{e}.pdf")
+                if size > limit and e - s > 1:
+                    os.remove(path)
+                    mid = (s + e) // 2
+                    ranges += [(s, mid), (mid, e)]
+                else:
+                    done[s] = {"path": path, "first_page": s + 1, "last_page": e, "bytes": size}
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    manifest = [done[s] for s in sorted(done)]
+    for n, m in enumerate(manifest, start=1):
+        final = os.path.join(out_dir, f"{stem}-part-{n}.pdf")
+        os.replace(m["path"], final)
+        m["path"] = final
+    return manifest
 
 
 # ----- Selective image extraction helpers -----
 
-def page_is_interesting(doc, i):
+def page_is_interesting(index, i):
     """Identify pages that should always be included in selective extraction."""
     if i < 5 or i % 20 == 0:
         return True
-    pg = doc.load_page(i)
-    txt = pg.get_text("text") or ""
-    return bool(re.search(r"^\s{0,3}(Chapter|Section|Table|Figure)\b", txt, re.I | re.M))
+    return bool(index["heading"][i])
 
 
-def image_heavy(pg):
+def image_heavy(index, i):
     """Heuristic to detect if a page has significant imagery."""
-    imgs = pg.get_images(full=True)
-    txt = pg.get_text("text") or ""
-    return (len(imgs) >= 2) or (len(txt) < 200 and len(imgs) >= 1)
+    n_imgs = len(index["images"][i])
+    return (n_imgs >= 2) or (index["text_len"][i] < 200 and n_imgs >= 1)
+
 
+def extract_page_images(doc, store, page_no, images=None, phash=False):
+    """Extract the images of one page of an open document into the image store.
 
-def extract_page_images(pdf_path, out_dir, page_index):
-    """Extract all images from a single page of a PDF and save them to disk."""
+    images is [(ix, [xref, width, height, nbytes]), ...] from the page index;
+    when omitted the page's images are listed from the PDF. Each image is
+    hashed from its encoded stream first and only decoded if the store does
+    not hold it yet. Returns one record per stored image:
+    {"page", "ix", "xref", "sha", "path", "phash"}.
+    """
     import fitz as _fitz  # local alias
-    doc = _fitz.open(pdf_path)
-    pg = doc.load_page(page_index)
+    if images is None:
+        images = [
+            (ix, [img[0], img[2], img[3], 0])
+            for ix, img in enumerate(doc.load_page(page_no).get_images(full=True))
+        ]
     out = []
-    for ix, img in enumerate(pg.get_images(full=True)):
-        xref = img[0]
+    for ix, rec in images:
+        xref = rec[0]
         try:
-            pix = _fitz.Pixmap(doc, xref)
-            if pix.n >= 5:  # e.g., CMYK
-                pix = _fitz.Pixmap(_fitz.csRGB, pix)
-            name = f"page-{page_index+1}-img-{ix+1}.png"
-            path = os.path.join(out_dir, name)
-            pix.save(path)
-            # guard against zero-byte artifacts
-            if os.path.getsize(path) < 1024:
-                try:
-                    os.remove(path)
-                except Exception:
-                    pass
+            sha = image_store.content_key(doc.xref_stream_raw(xref) or b"", rec[1], rec[2])
+            path = Path(store) / f"{sha}.png"
+            skip = Path(store) / f"{sha}.skip"
+            if skip.exists():
                 continue
-            out.append(path)
+            pix = None
+            if not path.exists():
+                pix = _fitz.Pixmap(doc, xref)
+                if pix.n >= 5:  # e.g., CMYK
+                    pix = _fitz.Pixmap(_fitz.csRGB, pix)
+                tmp = tmp_path(path).with_suffix(".png")
+                pix.save(str(tmp))
+                # guard against zero-byte artifacts (remembered via a .skip marker)
+                if os.path.getsize(tmp) < image_store.MIN_IMAGE_BYTES:
+                    os.remove(tmp)
+                    skip.touch()
+                    continue
+                os.replace(tmp, path)
+            ph = image_store.dhash(pix or _fitz.Pixmap(str(path))) if phash else None
+            out.append({"page": page_no, "ix": ix, "xref": xref, "sha": sha, "path": str(path), "phash": ph})
         except Exception:
             # ignore corrupt or unsupported encodings
             continue
-    doc.close()
     return out
 
 
-def selective_extract_images(pdf_path, out_dir, mode="selective"):
+def extract_page_range(pdf_path, store, batch, phash=False):
+    """Pool task: extract a contiguous batch of pages with one open document.
+
+    batch is [(page_no, images), ...]. Returns (records, stats) where stats
+    carries the worker pid, page/image counts and busy seconds.
+    """
+    t0 = time.perf_counter()
+    doc = pdf_io.open_doc(pdf_path)
+    out = []
+    for page_no, images in batch:
+        out.extend(extract_page_images(doc, store, page_no, images, phash))
+    stats = {"pid": os.getpid(), "pages": len(batch), "images": len(out), "seconds": time.perf_counter() - t0}
+    return out, stats
+
+
+def extract_workers() -> int:
+    """Worker count for the shared extraction pool (EXTRACT_WORKERS overrides)."""
+    try:
+        return max(1, int(os.environ.get("EXTRACT_WORKERS", "")))
+    except ValueError:
+        return os.cpu_count() or 2
+
+
+def process_pool() -> ProcessPoolExecutor:
+    """A process pool for extraction and part saving, with spawned workers.
+
+    The pool starts its workers on the first submit, from a preparer thread,
+    while fetcher threads download and other preparers may hold FITZ_LOCK or
+    fitz/SSL state; a forked child would inherit those locks held. Spawned
+    workers (unlike forkserver ones) are still direct children, so
+    pdf_io.resource_usage() counts them.
+    """
+    return ProcessPoolExecutor(max_workers=extract_workers(), mp_context=multiprocessing.get_context("spawn"))
+
+
+def plan_batches(jobs, workers):
+    """Split page jobs into contiguous batches: ~4 batches per worker for load
+    balancing, but never fewer than 4 or more than 64 pages per batch."""
+    if not jobs:
+        return []
+    size = min(64, max(4, math.ceil(len(jobs) / (workers * 4))))
+    return [jobs[i:i + size] for i in range(0, len(jobs), size)]
+
+
+def new_extract_stats():
+    """Run-level extraction counters, aggregated per worker pid."""
+    return {"batches": 0, "workers": {}}
+
+
+def merge_extract_stats(total, part):
+    """Fold one PDF's extraction counters into the run-level totals."""
+    total["batches"] += part.get("batches", 0)
+    for pid, w in part.get("workers", {}).items():
+        t = total["workers"].setdefault(pid, {"pages": 0, "images": 0, "seconds": 0.0})
+        for k in ("pages", "images", "seconds"):
+            t[k] += w[k]
+    return total
+
+
+def summarize_extract_stats(stats):
+    """Add pages/s per worker and print a one-line summary to stderr."""
+    for w in stats["workers"].values():
+        w["seconds"] = round(w["seconds"], 3)
+        w["pages_per_s"] = round(w["pages"] / w["seconds"], 1) if w["seconds"] else None
+    pages = sum(w["pages"] for w in stats["workers"].values())
+    print(
+        f"Image extraction: {pages} page(s) in {stats['batches']} batch(es) "
+        f"across {len(stats['workers'])} worker(s)",
+        file=sys.stderr,
+    )
+    return stats
+
+
+def selective_extract_images(pdf_path, mode="selective", index=None, pool=None, stats=None):
     """Extract images from a PDF selectively or fully.
 
     In selective mode only pages flagged by heuristics are processed. In full
-    mode every page is processed. Extraction is parallelised across CPU cores.
+    mode every page is processed. Pages come from the page index, and pages
+    without images are skipped without opening them. Extraction is
+    parallelised across CPU cores: contiguous page batches are sent to pool
+    (the run-wide executor; a private one is created when omitted) and
+    per-worker throughput is accumulated into stats.
+
+    Duplicates are collapsed inside the document: an xref is decoded only on
+    the first target page that uses it, and images with equal content (or
+    perceptual) hashes are kept once. Returns a list of
+    {"name", "path", "sha", "phash", "pages"} where path points into the image
+    store and pages are the 1-based pages that show the image.
     """
-    out = []
-    doc = fitz.open(pdf_path)
-    pages = range(len(doc))
-    targets = []
+    index = index or page_index.load_or_build(pdf_path)
+    pages = range(index["page_count"])
     if mode == "full":
         targets = list(pages)
     else:
-        for i in pages:
-            pg = doc.load_page(i)
-            if page_is_interesting(doc, i) or image_heavy(pg):
-                targets.append(i)
-    # Use a process pool to parallelise extraction across pages
-    with ProcessPoolExecutor(max_workers=os.cpu_count() or 2) as ex:
-        from functools import partial
-        for imgs in ex.map(partial(extract_page_images, pdf_path, out_dir), targets):
-            out.extend(imgs)
-    doc.close()
-    return out
+        targets = [i for i in pages if page_is_interesting(index, i) or image_heavy(index, i)]
+
+    # dedupe by xref: only the first target page referencing an xref decodes it
+    xref_pages, jobs = {}, []
+    for i in targets:
+        todo = []
+        for ix, rec in enumerate(page_index.page_images(index, i)):
+            if rec[0] not in xref_pages:
+                xref_pages[rec[0]] = []
+                todo.append((ix, rec))
+            xref_pages[rec[0]].append(i + 1)
+        if todo:
+            jobs.append((i, todo))
+
+    found, by_name = [], {}
+    registry = image_store.new_registry()
+    store = image_store.store_dir()
+    stats = stats if stats is not None else new_extract_stats()
+    own_pool = pool is None
+    if own_pool:
+        pool = process_pool()
+    try:
+        batches = plan_batches(jobs, extract_workers())
+        futures = [
+            pool.submit(extract_page_range, pdf_path, str(store), b, image_store.phash_enabled())
+            for b in batches
+        ]
+        for fut in futures:
+            recs, st = fut.result()
+            stats["batches"] += 1
+            w = stats["workers"].setdefault(str(st["pid"]), {"pages": 0, "images": 0, "seconds": 0.0})
+            for k in ("pages", "images", "seconds"):
+                w[k] += st[k]
+            for r in recs:
+                name = f"page-{r['page']+1}-img-{r['ix']+1}.png"
+                kept = image_store.register(registry, r["sha"], r["phash"], name)
+                if kept is None:
+                    by_name[name] = {"name": name, "path": r["path"], "sha": r["sha"], "phash": r["phash"], "pages": []}
+                    found.append(by_name[name])
+                    kept = name
+                by_name[kept]["pages"].extend(xref_pages[r["xref"]])
+    finally:
+        if own_pool:
+            pool.shutdown()
+    return found
+
+
+def place_images(found, images_dir, registry, source=1):
+    """Link extracted images into images_dir, skipping run-level duplicates.
+
+    registry is shared by all PDFs of the run, so an image already placed for
+    an earlier document is only referenced. Names are prefixed with the
+    1-based source index ("pdf2-page-3-img-1.png"): page/index names repeat
+    across PDFs, and different images must not replace each other. Returns
+    (paths, refs) where refs maps each kept image name to the pages of this
+    PDF that show it.
+    """
+    paths, refs = [], {}
+    for img in found:
+        name = f"pdf{source}-{img['name']}"
+        kept = image_store.register(registry, img["sha"], img["phash"], name)
+        if kept is None:
+            paths.append(pdf_cache.link_or_copy(img["path"], os.path.join(images_dir, name)))
+            kept = name
+        refs.setdefault(kept, []).extend(img["pages"])
+    return paths, refs
+
+
+def prepare_pdf(pdf_path, work_dir, extract_mode="selective", sha256=None, pool=None, ocr_pool=None):
+    """OCR (if needed), split (if needed) and extract images for one local PDF.
+
+    The page index is built once per document and shared by OCR page
+    selection, the page count check and image selection. Only pages that lack
+    a text layer are OCR'd (see ocr_missing_pages()). Images are extracted
+    from the whole document (not per split part), so page numbers in image
+    names refer to the original PDF and never collide across parts.
+
+    Returns {"parts", "manifest", "images", "policy", "extract_stats",
+    "timings"} where manifest holds the original page range of each part
+    (same order as parts), images are the records from
+    selective_extract_images(), policy is this PDF's contribution to the
+    run-level policy block and timings has seconds per stage.
+    """
+    timings = {}
+    t0 = time.perf_counter()
+    with FITZ_LOCK:
+        index = page_index.load_or_build(pdf_path, sha256)
+    ocr_pages = pages_needing_ocr(index)
+    outp = os.path.join(work_dir, f"final-{os.path.basename(pdf_path)}")
+    timings["index_s"] = time.perf_counter() - t0
+    if ocr_pages:
+        t0 = time.perf_counter()
+        ocr_missing_pages(pdf_path, outp, ocr_pages, work_dir, ocr_pool)
+        use = outp
+        with FITZ_LOCK:
+            index = page_index.load_or_build(use)
+        timings["ocr_s"] = time.perf_counter() - t0
+    else:
+        use = pdf_path
+
+    t0 = time.perf_counter()
+    n_pages = get_page_count(use, index)
+    need_split = (os.path.getsize(use) > SPLIT_TARGET_MB * 1024 * 1024) or (n_pages > SPLIT_MAX_PAGES)
+    if need_split:
+        manifest = split_pdf_by_size(use, work_dir, pool)
+        timings["split_s"] = time.perf_counter() - t0
+    else:
+        manifest = [{"path": use, "first_page": 1, "last_page": n_pages, "bytes": os.path.getsize(use)}]
+
+    # selective image extraction (into the image store; placed by the caller)
+    t0 = time.perf_counter()
+    stats = new_extract_stats()
+    images = selective_extract_images(use, mode=extract_mode, index=index, pool=pool, stats=stats)
+    timings["extract_s"] = time.perf_counter() - t0
+
+    # Simple policy selection (placeholder, unchanged)
+    policy = {"chunked": need_split, "model": "gemini-2.5-pro", "reason": "standard_pro"}
+    parts = [m.pop("path") for m in manifest]
+    return {
+        "parts": parts,
+        "manifest": manifest,
+        "images": images,
+        "policy": policy,
+        "extract_stats": stats,
+        "timings": {k: round(v, 3) for k, v in timings.items()},
+    }
+
+
+def prepare_pdf_cached(pdf_path, work_dir, extract_mode="selective", pool=None, ocr_pool=None, sha256=None):
+    """prepare_pdf() behind the content-addressed cache in pdf_cache.py.
+
+    The key covers the source bytes, EXTRACT_MODE, the split limits and the
+    perceptual-dedupe switch, so a hit can be restored by linking the stored
+    parts into place; image records point into the cache entry and are placed
+    by the caller with place_images().
+
+    sha256 may be passed when the content hash is already known (computed
+    while downloading). Returns prepare_pdf()'s dict plus "cache_hit".
+    """
+    stem = Path(pdf_path).stem
+    sha256 = sha256 or pdf_cache.sha256_file(pdf_path)
+    key = pdf_cache.make_key(
+        sha256,
+        extract_mode=extract_mode,
+        split_max_pages=SPLIT_MAX_PAGES,
+        split_target_mb=SPLIT_TARGET_MB,
+        image_phash=image_store.phash_enabled(),
+    )
+    meta = pdf_cache.lookup(key)
+    if meta is not None:
+        prepared = pdf_cache.materialize(key, meta, work_dir, stem)
+        prepared["policy"] = meta["policy"]
+        prepared["manifest"] = meta["manifest"]
+        print(f"PDF cache hit for {pdf_path} ({key[:12]})", file=sys.stderr)
+        return {**prepared, "extract_stats": new_extract_stats(), "timings": {}, "cache_hit": True}
+
+    prepared = prepare_pdf(pdf_path, work_dir, extract_mode, sha256, pool, ocr_pool)
+    pdf_cache.store(key, stem, prepared["parts"], prepared["images"], prepared["policy"], prepared["manifest"])
+    return {**prepared, "cache_hit": False}
+
+
+# ----- Ingestion -----
+
+def fetch_pdf(i, ref, work_dir, headers):
+    """Resolve one ctx["pdf_urls"] entry (URL or repo path) to work_dir/src-<i>.pdf.
+
+    Returns (path, how, sha256) where how is "download", "reflink", "hardlink"
+    or "copy"; sha256 is the content hash computed while downloading (None for
+    repo-local files, which are hashed by the cache layer).
+    """
+    dest = os.path.join(work_dir, f"src-{i}.pdf")
+    if is_http_url(ref):
+        # HTTP(S) path: one GET on the shared session; the size cap is checked
+        # against Content-Length before the body is read and again while streaming
+        res = http_download(ref, dest, headers=headers, max_bytes=MAX_BYTES)
+        return dest, "download", res["sha256"]
+
+    # Repo-local path
+    p = resolve_repo_path(ref)
+    if not p.is_file():
+        raise RuntimeError(f"PDF path referenced in issue not found: {p}")
+    if p.suffix.lower() != ".pdf":
+        raise RuntimeError(f"Not a PDF: {p}")
+    size = p.stat().st_size
+    if size == 0:
+        raise RuntimeError(f"PDF is empty: {p}")
+    if size > MAX_BYTES:
+        raise RuntimeError(f"Refusing to process oversized local PDF ({size} bytes): {p}")
+
+    # Place into the workspace (downstream assumes workspace paths); reflink or
+    # hardlink when the filesystem allows, so no bytes are copied
+    return dest, pdf_io.place_file(p, dest), None
+
+
+def ingest_concurrency() -> int:
+    """PDFs fetched/prepared at the same time (INGEST_CONCURRENCY, default 2)."""
+    try:
+        return max(1, int(os.environ.get("INGEST_CONCURRENCY", "2")))
+    except ValueError:
+        return 2
 
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--context", required=True)
-    ap.add_argument("--output-root", required=True)
-    a = ap.parse_args()
+def ingest_pdfs(refs, work_dir, headers, extract_mode, pool, ocr_pool):
+    """Fetch and prepare every referenced PDF with bounded concurrency.
 
-    ctx = read_json(a.context)
+    Fetches run on their own threads, so downloading PDF N+1 overlaps the
+    OCR/split/extraction of PDF N. Up to ingest_concurrency() PDFs are
+    prepared at once; all of them share the run's process pool (extraction,
+    part saving) and OCR pool. Results come back in reference order. The first
+    failing PDF (in order) cancels the remaining work and fails the run with
+    its reference in the message.
+
+    Returns (prepared_list, report) where report is the progress/timing summary.
+    """
+    n = len(refs)
+    conc = ingest_concurrency()
+    report = [{"source": ref} for ref in refs]
+    t_run = time.perf_counter()
+
+    def fetch(i):
+        t0 = time.perf_counter()
+        path, report[i]["placed"], sha256 = fetch_pdf(i + 1, refs[i], work_dir, headers)
+        report[i]["fetch_s"] = round(time.perf_counter() - t0, 3)
+        return path, sha256
+
+    def prepare(i, fetched):
+        path, sha256 = fetched.result()
+        t0 = time.perf_counter()
+        prepared = prepare_pdf_cached(path, work_dir, extract_mode, pool, ocr_pool, sha256)
+        report[i]["prepare_s"] = round(time.perf_counter() - t0, 3)
+        report[i]["cache_hit"] = prepared["cache_hit"]
+        report[i].update(prepared["timings"])
+        print(
+            f"[{i+1}/{n}] {refs[i]}: fetched in {report[i]['fetch_s']}s, "
+            f"prepared in {report[i]['prepare_s']}s" + (" (cache hit)" if prepared["cache_hit"] else ""),
+            file=sys.stderr,
+        )
+        return prepared
+
+    fetchers = ThreadPoolExecutor(max_workers=conc)
+    preparers = ThreadPoolExecutor(max_workers=conc)
+    try:
+        fetched = [fetchers.submit(fetch, i) for i in range(n)]
+        futures = [preparers.submit(prepare, i, fetched[i]) for i in range(n)]
+        results = []
+        for i, fut in enumerate(futures):
+            try:
+                results.append(fut.result())
+            except Exception as e:
+                raise RuntimeError(f"Failed to prepare PDF {refs[i]}: {e}") from e
+    finally:
+        preparers.shutdown(wait=True, cancel_futures=True)
+        fetchers.shutdown(wait=True, cancel_futures=True)
+
+    summary = {
+        "concurrency": conc,
+        "wall_s": round(time.perf_counter() - t_run, 3),
+        "pdfs": report,
+    }
+    return results, summary
+
+
+def prepare_context(ctx: dict, output_root: str) -> dict:
+    """Fetch and prepare every PDF in ctx["pdf_urls"]; updates and returns ctx."""
     issue = ctx["issue_number"]
-    issue_dir = os.path.join(a.output_root, f"issue-{issue}")
+    issue_dir = os.path.join(output_root, f"issue-{issue}")
     images_dir = mkdirp(os.path.join(issue_dir, "images"))
-    tmp = tempfile.mkdtemp()
+    # Workspace next to the repo (and the PDF cache) so sources and cache
+    # entries can be hardlinked instead of copied across filesystems
+    work_root = mkdirp(os.path.abspath(os.environ.get("PREP_WORK_DIR") or os.path.join(".agent", "work")))
+    tmp = tempfile.mkdtemp(prefix=f"issue-{issue}-", dir=work_root)
 
     headers = {"Authorization": f"token {os.environ.get('GH_TOKEN','')}"}
-    local_pdfs = []
-
-    # --- Build local_pdfs from ctx["pdf_urls"] which may contain URLs or repo paths ---
-    for i, u in enumerate(ctx.get("pdf_urls", []), start=1):
-        if is_http_url(u):
-            # HTTP(S) path: check size and download
-            sz = head_size(u, headers)
-            if sz and sz > MAX_BYTES:
-                raise RuntimeError(f"Refusing to download oversized PDF ({sz} bytes): {u}")
-            dest = os.path.join(tmp, f"src-{i}.pdf")
-            http_get(u, headers=headers, dest_path=dest)
-            local_pdfs.append(dest)
-            continue
-
-        # Repo-local path
-        p = resolve_repo_path(u)
-        if not p.is_file():
-            raise RuntimeError(f"PDF path referenced in issue not found: {p}")
-        if p.suffix.lower() != ".pdf":
-            raise RuntimeError(f"Not a PDF: {p}")
-        size = p.stat().st_size
-        if size == 0:
-            raise RuntimeError(f"PDF is empty: {p}")
-        if size > MAX_BYTES:
-            raise RuntimeError(f"Refusing to process oversized local PDF ({size} bytes): {p}")
-
-        # Copy into temp workspace (downstream assumes temp copies)
-        dest = os.path.join(tmp, f"src-{i}.pdf")
-        with open(p, "rb") as src, open(dest, "wb") as dst:
-            for chunk in iter(lambda: src.read(1024 * 1024), b""):
-                dst.write(chunk)
-        local_pdfs.append(dest)
+    refs = ctx.get("pdf_urls", [])
 
     # If no PDFs were found at all, fail early with a helpful message
-    if not local_pdfs:
+    if not refs:
         raise RuntimeError(
             "No PDFs found in context. Ensure the issue includes a URL or a repo path like 'upload-pdf/your.pdf'."
         )
 
     final_pdfs, policy = [], {"chunked": False, "model": None, "reason": ""}
     extract_mode = os.environ.get("EXTRACT_MODE", "selective")
-
-    for p in local_pdfs:
-        has_text = quick_text_probe(p)
-        outp = os.path.join(tmp, f"final-{os.path.basename(p)}")
-        if not has_text:
-            ocr_pdf(p, outp)
-            use = outp
-        else:
-            use = p
-
-        need_split = (os.path.getsize(use) > 50 * 1024 * 1024) or (get_page_count(use) > 1000)
-        parts = split_pdf_by_pages(use, tmp) if need_split else [use]
-        if need_split:
-            policy["chunked"] = True
-
-        for part in parts:
-            # selective image extraction
-            selective_extract_images(part, images_dir, mode=extract_mode)
-            final_pdfs.append(part)
-
-        # Simple policy selection (placeholder, unchanged)
-        policy["model"] = "gemini-2.5-pro"
-        policy["reason"] = "standard_pro"
+    registry = image_store.new_registry()  # dedupes images across all PDFs of the run
+    image_refs, part_manifest = {}, []
+    stats = new_extract_stats()
+
+    # One process pool (extraction, part saving) and one OCR pool for the whole run
+    with process_pool() as pool, \
+            ThreadPoolExecutor(max_workers=ocr_workers()) as ocr_pool:
+        results, ingest = ingest_pdfs(refs, tmp, headers, extract_mode, pool, ocr_pool)
+    pdf_io.close_docs()
+    # after the pool has shut down, so worker processes are included
+    ingest["resources"] = pdf_io.resource_usage()
+    print(
+        f"Ingest: peak RSS {ingest['resources']['peak_rss_mb']} MB "
+        f"(workers {ingest['resources']['children_peak_rss_mb']} MB), "
+        f"read {ingest['resources']['read_bytes']} B, wrote {ingest['resources']['write_bytes']} B",
+        file=sys.stderr,
+    )
+
+    for source, (ref, prepared) in enumerate(zip(refs, results), 1):
+        final_pdfs.extend(prepared["parts"])
+        for part, m in zip(prepared["parts"], prepared["manifest"]):
+            part_manifest.append({"part": Path(part).name, "source": ref, **m})
+        _, refs_by_name = place_images(prepared["images"], images_dir, registry, source)
+        for name, pages in refs_by_name.items():
+            image_refs.setdefault(name, []).extend(f"{ref}#page={n}" for n in pages)
+        merge_extract_stats(stats, prepared["extract_stats"])
+        policy["chunked"] = policy["chunked"] or prepared["policy"]["chunked"]
+        policy["model"] = prepared["policy"]["model"]
+        policy["reason"] = prepared["policy"]["reason"]
 
     ctx["artifact_dir"] = issue_dir
     ctx["final_pdf_paths"] = final_pdfs
     bucket = os.environ.get("GCS_BUCKET", "").replace("gs://", "")
     ctx["gcs_uris"] = [f"gs://{bucket}/issues/{issue}/{Path(p).name}" for p in final_pdfs]
     ctx["policy"] = policy
-    write_json(a.context, ctx)
+    ctx["part_manifest"] = part_manifest
+    ctx["image_refs"] = image_refs
+    ctx["extract_stats"] = summarize_extract_stats(stats)
+    ctx["ingest"] = ingest
+    return ctx
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--context", required=True)
+    ap.add_argument("--output-root", required=True)
+    a = ap.parse_args(argv)
+
+    ctx = read_json(a.context)
+    write_json(a.context, prepare_context(ctx, a.output_root))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+"""
+image_store.py
+Content-addressed image store and duplicate registry for PDF image extraction.
+
+Branded documents repeat the same logo/header image on hundreds of pages,
+often as one xref, sometimes re-embedded as separate xrefs or across PDFs.
+Extraction therefore works in three layers:
+
+  - by xref: within one document each xref is decoded at most once;
+  - by content: the raw (still encoded) image stream plus its dimensions is
+    hashed before decoding; the PNG is stored once as <store>/<sha>.png and
+    reused by every later page, document and run;
+  - by perceptual hash (optional): a 64-bit dHash folds near-identical
+    re-encodings of the same picture together.
+
+The registry records which image name was kept for each hash so duplicates are
+written once and only referenced elsewhere (see ctx["image_refs"]).
+
+Environment:
+  IMAGE_PHASH            "1" to enable perceptual-hash deduplication
+  IMAGE_PHASH_DISTANCE   max Hamming distance treated as a duplicate (default 4)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import pdf_cache
+
+__all__ = [
+    "store_dir",
+    "content_key",
+    "dhash",
+    "phash_enabled",
+    "new_registry",
+    "register",
+]
+
+MIN_IMAGE_BYTES = 1024  # smaller PNGs are treated as zero-byte artifacts
+
+
+def store_dir() -> Path:
+    """Blob directory under the PDF cache root (a temp dir if caching is off)."""
+    root = pdf_cache.cache_root()
+    if root is None:
+        return Path(tempfile.mkdtemp(prefix="img-store-"))
+    path = root / "blobs"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def content_key(raw: bytes, width: int, height: int) -> str:
+    """Hash of an image's encoded stream and dimensions (no decoding needed)."""
+    h = hashlib.sha256(raw)
+    h.update(f"|{width}x{height}".encode("ascii"))
+    return h.hexdigest()
+
+
+def dhash(pix) -> int:
+    """64-bit difference hash of a fitz.Pixmap (9x8 grayscale, row gradients)."""
+    import fitz
+
+    small = fitz.Pixmap(pix, 9, 8, None)
+    gray = fitz.Pixmap(fitz.csGRAY, small)
+    if gray.alpha:
+        gray = fitz.Pixmap(gray, 0)
+    px = gray.samples
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits
+
+
+def phash_enabled() -> bool:
+    return os.environ.get("IMAGE_PHASH", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _phash_distance() -> int:
+    try:
+        return int(os.environ.get("IMAGE_PHASH_DISTANCE", "4"))
+    except ValueError:
+        return 4
+
+
+def new_registry() -> dict:
+    """Empty duplicate registry: content hash -> kept name, plus (phash, name) pairs."""
+    return {"sha": {}, "phash": []}
+
+
+def register(registry: dict, sha: str, phash: Optional[int], name: str) -> Optional[str]:
+    """
+    Record an image. Returns the name of the already-kept duplicate, or None
+    when the image is new (and is now the kept copy for its hashes).
+    """
+    kept = registry["sha"].get(sha)
+    if kept is not None:
+        return kept
+    if phash is not None:
+        limit = _phash_distance()
+        for other, other_name in registry["phash"]:
+            if bin(other ^ phash).count("1") <= limit:
+                registry["sha"][sha] = other_name
+                return other_name
+        registry["phash"].append((phash, name))
+    registry["sha"][sha] = name
+    return None
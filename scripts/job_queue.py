@@ -0,0 +1,291 @@
+"""
+job_queue.py
+Local queue of issue jobs for worker.py.
+
+Two interchangeable implementations, chosen by open_queue(spec):
+
+  <dir>              SpoolQueue: pending/, running/, done/ and failed/ hold one
+                     JSON file per job. A job is claimed by hard-linking its
+                     record to running/issue-<n>.json, which fails if that
+                     issue is already running, so claims are atomic across
+                     processes without a lock server.
+  <file>.db|.sqlite  SqliteQueue: one "jobs" table (WAL mode); a claim is a
+  sqlite:///<path>   single BEGIN IMMEDIATE transaction.
+
+A job record is a dict: {"id", "issue", "status", "enqueued", "worker",
+"started", "finished", "result", ...payload} with status one of pending,
+running, done, failed or merged.
+
+Claiming follows the oldest pending job, but runs the newest job queued for
+that issue and marks the older ones "merged" into it: every run re-reads the
+whole issue, so a burst of comments needs one run. Issues that already have
+a running job are skipped, so at most one job per issue runs at a time.
+
+Both queues assume one supervisor (worker.py run) per queue: recover() puts
+jobs left "running" by a previous, dead supervisor back to pending.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import List, Optional
+
+__all__ = ["STATUSES", "new_job", "SpoolQueue", "SqliteQueue", "open_queue"]
+
+STATUSES = ("pending", "running", "done", "failed", "merged")
+
+
+def new_job(issue: int, **payload) -> dict:
+    """A pending job record for issue (payload: repo, event, env, context...)."""
+    return {
+        "id": uuid.uuid4().hex[:12],
+        "issue": int(issue),
+        "status": "pending",
+        "enqueued": time.time(),
+        **payload,
+    }
+
+
+def _tmp_tag() -> str:
+    """Unique per process and thread: claims may race within one process too."""
+    return f"{os.getpid()}-{threading.get_ident()}"
+
+
+def _write_atomic(path: Path, obj) -> None:
+    tmp = path.with_name(f".{path.name}.{_tmp_tag()}.tmp")
+    tmp.write_text(json.dumps(obj, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _read(path: Path) -> Optional[dict]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None  # claimed or finished by another process meanwhile
+
+
+class SpoolQueue:
+    """Directory spool; safe across processes on one filesystem."""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        for sub in ("pending", "running", "done", "failed"):
+            (self.root / sub).mkdir(parents=True, exist_ok=True)
+
+    def _lock(self, issue) -> Path:
+        return self.root / "running" / f"issue-{issue}.json"
+
+    def put(self, job: dict) -> str:
+        name = f"{int(job['enqueued'] * 1e6):020d}-{job['id']}.json"
+        _write_atomic(self.root / "pending" / name, job)
+        return job["id"]
+
+    def _pending(self) -> List[tuple]:
+        out = []
+        for path in sorted((self.root / "pending").glob("*.json")):
+            job = _read(path)
+            if job is not None:
+                out.append((path, job))
+        return out
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """Take the next runnable job (see module docstring), or None."""
+        pending = self._pending()
+        seen = set()
+        for _, first in pending:
+            issue = first["issue"]
+            if issue in seen:
+                continue
+            seen.add(issue)
+            lock = self._lock(issue)
+            if lock.exists():
+                continue
+            same = [(p, j) for p, j in pending if j["issue"] == issue]
+            path, job = same[-1]
+            job = dict(job, status="running", worker=worker, started=time.time(),
+                       merged=[j["id"] for _, j in same[:-1]])
+            tmp = lock.with_name(f".{lock.name}.{_tmp_tag()}.tmp")
+            tmp.write_text(json.dumps(job, indent=2), encoding="utf-8")
+            try:
+                os.link(tmp, lock)
+            except FileExistsError:
+                continue
+            finally:
+                tmp.unlink()
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                lock.unlink()  # another worker already ran this job
+                continue
+            for old_path, old in same[:-1]:
+                try:
+                    old_path.unlink()
+                except FileNotFoundError:
+                    continue
+                _write_atomic(self.root / "done" / f"{old['id']}.json",
+                              dict(old, status="merged", merged_into=job["id"], finished=time.time()))
+            return job
+        return None
+
+    def finish(self, job: dict, status: str, result: Optional[dict] = None) -> None:
+        record = dict(job, status=status, finished=time.time(), result=result or {})
+        _write_atomic(self.root / ("failed" if status == "failed" else "done") / f"{job['id']}.json", record)
+        try:
+            self._lock(job["issue"]).unlink()
+        except FileNotFoundError:
+            pass
+
+    def running(self) -> List[dict]:
+        return [j for j in (_read(p) for p in (self.root / "running").glob("issue-*.json")) if j]
+
+    def release(self, worker: str, error: str) -> None:
+        """Fail the jobs held by a worker process that died or was killed."""
+        for job in self.running():
+            if job.get("worker") == worker:
+                self.finish(job, "failed", {"error": error})
+
+    def recover(self) -> int:
+        """Put jobs left running by a previous supervisor back to pending."""
+        n = 0
+        for job in self.running():
+            self.put(dict(job, status="pending", worker=None, started=None))
+            self._lock(job["issue"]).unlink()
+            n += 1
+        return n
+
+    def get(self, job_id: str) -> Optional[dict]:
+        for sub in ("done", "failed"):
+            job = _read(self.root / sub / f"{job_id}.json")
+            if job:
+                return job
+        for job in self.running():
+            if job["id"] == job_id:
+                return job
+        return next((j for _, j in self._pending() if j["id"] == job_id), None)
+
+    def counts(self) -> dict:
+        out = {s: 0 for s in STATUSES}
+        out["pending"] = len(list((self.root / "pending").glob("*.json")))
+        out["running"] = len(list((self.root / "running").glob("issue-*.json")))
+        out["failed"] = len(list((self.root / "failed").glob("*.json")))
+        for path in (self.root / "done").glob("*.json"):
+            job = _read(path)
+            if job:
+                out[job.get("status", "done")] = out.get(job.get("status", "done"), 0) + 1
+        return out
+
+
+class SqliteQueue:
+    """SQLite-backed queue; one short-lived connection per operation."""
+
+    def __init__(self, path: str):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, issue INTEGER, status TEXT,"
+                " enqueued REAL, worker TEXT, started REAL, job TEXT)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, enqueued)")
+
+    def _db(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def _save(db, job: dict) -> None:
+        db.execute(
+            "INSERT OR REPLACE INTO jobs (id, issue, status, enqueued, worker, started, job) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job["id"], job["issue"], job["status"], job["enqueued"], job.get("worker"), job.get("started"),
+             json.dumps(job)),
+        )
+
+    def put(self, job: dict) -> str:
+        with self._db() as db:
+            self._save(db, job)
+        return job["id"]
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """Take the next runnable job (see module docstring), or None."""
+        db = self._db()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT issue FROM jobs WHERE status = 'pending' AND issue NOT IN"
+                " (SELECT issue FROM jobs WHERE status = 'running') ORDER BY enqueued LIMIT 1"
+            ).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            rows = db.execute(
+                "SELECT job FROM jobs WHERE status = 'pending' AND issue = ? ORDER BY enqueued", (row[0],)
+            ).fetchall()
+            same = [json.loads(r[0]) for r in rows]
+            job = dict(same[-1], status="running", worker=worker, started=time.time(),
+                       merged=[j["id"] for j in same[:-1]])
+            self._save(db, job)
+            for old in same[:-1]:
+                self._save(db, dict(old, status="merged", merged_into=job["id"], finished=time.time()))
+            db.execute("COMMIT")
+            return job
+        except Exception:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def finish(self, job: dict, status: str, result: Optional[dict] = None) -> None:
+        with self._db() as db:
+            self._save(db, dict(job, status=status, finished=time.time(), result=result or {}))
+
+    def _select(self, where: str, params=()) -> List[dict]:
+        db = self._db()
+        try:
+            return [json.loads(r[0]) for r in db.execute(f"SELECT job FROM jobs WHERE {where}", params)]
+        finally:
+            db.close()
+
+    def running(self) -> List[dict]:
+        return self._select("status = 'running'")
+
+    def release(self, worker: str, error: str) -> None:
+        """Fail the jobs held by a worker process that died or was killed."""
+        for job in self._select("status = 'running' AND worker = ?", (worker,)):
+            self.finish(job, "failed", {"error": error})
+
+    def recover(self) -> int:
+        """Put jobs left running by a previous supervisor back to pending."""
+        jobs = self.running()
+        for job in jobs:
+            self.put(dict(job, status="pending", worker=None, started=None))
+        return len(jobs)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        found = self._select("id = ?", (job_id,))
+        return found[0] if found else None
+
+    def counts(self) -> dict:
+        out = {s: 0 for s in STATUSES}
+        db = self._db()
+        try:
+            for status, n in db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+                out[status] = n
+        finally:
+            db.close()
+        return out
+
+
+def open_queue(spec: str):
+    """SqliteQueue for sqlite:///path or *.db / *.sqlite, else a SpoolQueue directory."""
+    if spec.startswith("sqlite:///"):
+        return SqliteQueue(spec[len("sqlite:///"):])
+    if spec.endswith((".db", ".sqlite", ".sqlite3")):
+        return SqliteQueue(spec)
+    return SpoolQueue(spec)
@@ -0,0 +1,410 @@
+"""
+model_backend.py
+Model backends used by run_gemini_sdk.py.
+
+The runner talks to the model only through a backend object:
+
+  backend.model(model_id, system_instruction=None, location=None)
+                                                    -> model (location: another
+                                                       region, for hedging)
+  backend.pdf_part(uri)                             -> request part for a gs:// PDF
+  backend.generation_config(**cfg)                  -> value for generation_config=
+  backend.safety_settings()                         -> value for safety_settings= (or None)
+  backend.create_context(model_id, parts, system_instruction, ttl_s) -> handle
+  backend.model_for_context(handle)                 -> model whose requests are
+                                                       prefixed by the cached parts
+  backend.delete_context(handle)
+
+Models expose generate_content(parts, generation_config=..., safety_settings=...,
+stream=False) with the Vertex SDK's response shape (.text, .candidates,
+.to_dict() with usage_metadata / finish_reason; stream=True yields such
+responses chunk by chunk) and count_tokens(parts) -> .total_tokens.
+
+Backends (get_backend(name, project, location); one shared instance per
+name/project/location, so a long-lived process such as worker.py initialises
+the SDK once and reuses its model clients across issues):
+
+  vertex  Vertex AI (the vertexai package of google-cloud-aiplatform),
+          imported when the backend is first created.
+  fake    Local, offline stand-in for load-testing the runner's retry,
+          continuation and concurrency paths. It writes a deterministic
+          Markdown report (the sections named in the prompt, map notes, or a
+          single section for SECTION REQUESTs), continues it after
+          PRIOR_OUTPUT, and simulates:
+            FAKE_GEMINI_TTFB           seconds before the first token (default 0.5)
+            FAKE_GEMINI_TPS            output tokens per second (default 200; 0 = instant)
+            FAKE_GEMINI_OUTPUT_TOKENS  length of a full report (default 3000)
+            FAKE_GEMINI_MAX_TOKENS     cap below max_output_tokens, to force
+                                       finish_reason=MAX_TOKENS
+            FAKE_GEMINI_ERROR_RATE     probability a call fails with a transient
+                                       503/429 before any output (default 0)
+            FAKE_GEMINI_BREAK_RATE     probability a stream breaks mid-way (default 0)
+            FAKE_GEMINI_SLOW_RATE      probability a call takes FAKE_GEMINI_SLOW_S
+                                       (default 30) extra seconds (default 0)
+            FAKE_GEMINI_REPEAT_CHARS   characters a continuation repeats before the
+                                       unfinished last line (default 0)
+            FAKE_GEMINI_PDF_TOKENS     prompt tokens counted per PDF part (default 10000)
+            FAKE_GEMINI_SEED           seed for error injection (default 0)
+          Token counts are approximated as characters / 4.
+
+Cached context: the PDFs, the user prompt and the system instruction are
+registered once (Vertex CachedContent) and every later call (first pass,
+sections, continuations) sends only its new text. Input tokens billed per
+pass then drop to roughly that new text; the cached prefix is reported as
+usage_metadata.cached_content_token_count.
+"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from typing import List, Optional
+
+__all__ = ["BACKENDS", "VertexBackend", "FakeBackend", "get_backend"]
+
+MAX_MODELS = 32  # model clients kept per backend (one per model / system instruction / region)
+
+
+class VertexBackend:
+    """Vertex AI (google-cloud-aiplatform) implementation."""
+
+    name = "vertex"
+
+    def __init__(self, project: str, location: str):
+        # vertexai.init configures the shared aiplatform initializer too;
+        # google.cloud.aiplatform itself is never imported directly
+        from vertexai import init as vertexai_init
+
+        self.project, self.location = project, location
+        vertexai_init(project=project, location=location)
+        self._models: dict = {}  # (model_id, system_instruction, location) -> GenerativeModel
+        self._lock = threading.Lock()
+
+    def model(self, model_id: str, system_instruction: Optional[str] = None, location: Optional[str] = None):
+        from vertexai.generative_models import GenerativeModel
+
+        key = (model_id, system_instruction, location)
+        with self._lock:
+            model = self._models.get(key)
+        if model is not None:
+            return model  # keeps its prediction client (and channel) warm
+        if location and location != self.location:
+            # a full resource name pins the model to another region
+            model_id = f"projects/{self.project}/locations/{location}/publishers/google/models/{model_id}"
+        if system_instruction:
+            model = GenerativeModel(model_id, system_instruction=system_instruction)
+        else:
+            model = GenerativeModel(model_id)
+        with self._lock:
+            if len(self._models) >= MAX_MODELS:
+                self._models.pop(next(iter(self._models)))
+            self._models[key] = model
+        return model
+
+    def pdf_part(self, uri: str):
+        from vertexai.generative_models import Part
+
+        return Part.from_uri(uri, mime_type="application/pdf")
+
+    def generation_config(self, **cfg):
+        from vertexai.generative_models import GenerationConfig
+
+        return GenerationConfig(**cfg)
+
+    def safety_settings(self):
+        """Version tolerant: None when this SDK lacks the enums."""
+        from vertexai.generative_models import SafetySetting
+
+        try:
+            HC = SafetySetting.HarmCategory
+            HBT = SafetySetting.HarmBlockThreshold
+            return [
+                SafetySetting(category=HC.HARASSMENT, threshold=HBT.BLOCK_NONE),
+                SafetySetting(category=HC.HATE_SPEECH, threshold=HBT.BLOCK_NONE),
+                SafetySetting(category=HC.SEXUAL, threshold=HBT.BLOCK_MEDIUM_AND_ABOVE),
+                SafetySetting(category=HC.DANGEROUS, threshold=HBT.BLOCK_NONE),
+            ]
+        except Exception:
+            return None
+
+    def create_context(self, model_id: str, parts: List, system_instruction: Optional[str], ttl_s: int):
+        from vertexai.generative_models import Content, Part
+        from vertexai.preview import caching
+
+        contents = [
+            Content(role="user", parts=[Part.from_text(p) if isinstance(p, str) else p for p in parts])
+        ]
+        return caching.CachedContent.create(
+            model_name=model_id,
+            system_instruction=system_instruction or None,
+            contents=contents,
+            ttl=datetime.timedelta(seconds=ttl_s),
+            display_name="issue-pdf-agent",
+        )
+
+    def model_for_context(self, handle):
+        from vertexai.preview.generative_models import GenerativeModel
+
+        return GenerativeModel.from_cached_content(cached_content=handle)
+
+    def delete_context(self, handle) -> None:
+        handle.delete()
+
+
+# ---------------------------
+# Local fake
+# ---------------------------
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+PRIOR_MARKER = "PRIOR_OUTPUT ("  # continuation.prior_block(); the window follows the marker line
+FALLBACK_SECTIONS = ("Executive Summary", "Requirements", "Assumptions")
+
+_RNG_LOCK = threading.Lock()
+_RNG = random.Random(int(_env_float("FAKE_GEMINI_SEED", 0)))
+
+
+def _tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+class _FakePdf:
+    """Stand-in for Part.from_uri(); to_dict() matches the Vertex shape."""
+
+    def __init__(self, uri: str):
+        self.uri = uri
+
+    def to_dict(self) -> dict:
+        return {"file_data": {"file_uri": self.uri, "mime_type": "application/pdf"}}
+
+
+class _FakeResponse:
+    """Response / stream chunk with the attributes the runner reads."""
+
+    def __init__(self, text: str, finish_reason: Optional[str], usage: dict, model_id: str):
+        self.text = text
+        self.finish_reason = finish_reason
+        self.usage_metadata = usage
+        self.model_id = model_id
+
+    def to_dict(self) -> dict:
+        cand = {"content": {"role": "model", "parts": [{"text": self.text}]}}
+        if self.finish_reason:
+            cand["finish_reason"] = self.finish_reason
+        return {"candidates": [cand], "usage_metadata": self.usage_metadata, "model_version": self.model_id}
+
+
+class _FakeTokenCount:
+    def __init__(self, total: int):
+        self.total_tokens = total
+        self.total_billable_characters = total * 4
+
+
+def _paragraph(topic: str, i: int) -> str:
+    seed = hashlib.sha256(f"{topic}:{i}".encode("utf-8")).hexdigest()[:8]
+    return (
+        f"The system shall handle {topic.lower()} item {i + 1} (ref {seed}) as described in the "
+        "source document, recording the outcome and the responsible control for audit."
+    )
+
+
+def _body(topic: str, n_tokens: int) -> str:
+    out, i = [], 0
+    while _tokens("\n\n".join(out)) < n_tokens:
+        out.append(_paragraph(topic, i))
+        i += 1
+    return "\n\n".join(out)
+
+
+class _FakeModel:
+    def __init__(self, model_id: str, system_instruction: Optional[str] = None, prefix: Optional[List] = None):
+        self.model_id = model_id
+        self.system_instruction = system_instruction or ""
+        self.prefix = list(prefix or [])
+
+    # -- request analysis --
+
+    @staticmethod
+    def _split(parts: List) -> tuple:
+        """(request text without PRIOR_OUTPUT, prior output, pdf count)."""
+        texts, prior, pdfs = [], "", 0
+        for p in parts:
+            if isinstance(p, str):
+                if PRIOR_MARKER in p:
+                    prior = p.split(PRIOR_MARKER, 1)[1].split("\n", 1)[-1]
+                else:
+                    texts.append(p)
+            else:
+                pdfs += 1
+        return "\n".join(texts), prior, pdfs
+
+    @staticmethod
+    def _document(request: str) -> str:
+        """The full answer to a request; deterministic, so continuations line up."""
+        size = int(_env_float("FAKE_GEMINI_OUTPUT_TOKENS", 3000))
+        m = re.search(r"top-level sections in order: (.+?)\. Use these headings", request)
+        sections = [s.strip() for s in m.group(1).split(",")] if m else list(FALLBACK_SECTIONS)
+        sec = re.search(r"Write ONLY the section '## (.+?)'", request)
+        if sec:
+            return f"## {sec.group(1)}\n\n" + _body(sec.group(1), size // max(1, len(sections)))
+        if "MAP STEP" in request:
+            return "\n\n".join(f"### {s}\n- " + _paragraph(s, 0) for s in sections)
+        per = size // max(1, len(sections))
+        return "# Report\n\n" + "\n\n".join(f"## {s}\n\n" + _body(s, per) for s in sections)
+
+    @staticmethod
+    def _resume(doc: str, prior: str) -> str:
+        """The rest of doc after prior, matched on the longest unambiguous tail."""
+        prior = prior.strip()
+        if not prior:
+            return doc
+        for n in (400, 160, 60):
+            tail = prior[-n:]
+            if doc.count(tail) == 1:
+                end = doc.find(tail) + len(tail)
+                # like a real model: restart the unfinished line, plus any extra echo
+                start = doc.rfind("\n", 0, end) + 1
+                start = max(0, start - int(_env_float("FAKE_GEMINI_REPEAT_CHARS", 0)))
+                return doc[start:]
+        return ""
+
+    def _plan(self, parts: List, generation_config) -> tuple:
+        request, prior, pdfs = self._split(self.prefix + list(parts))
+        remaining = self._resume(self._document(request), prior)
+        cfg = generation_config if isinstance(generation_config, dict) else {}
+        limit = int(cfg.get("max_output_tokens") or 8192)
+        cap = int(_env_float("FAKE_GEMINI_MAX_TOKENS", 0))
+        if cap > 0:
+            limit = min(limit, cap)
+        text = remaining[: limit * 4]
+        finish = "MAX_TOKENS" if len(remaining) > len(text) else "STOP"
+        prompt_tokens = self.count_tokens(parts).total_tokens
+        cached = self.count_tokens(self.prefix).total_tokens if self.prefix else 0
+        usage = {
+            "prompt_token_count": prompt_tokens + cached,
+            "candidates_token_count": _tokens(text),
+            "total_token_count": prompt_tokens + cached + _tokens(text),
+        }
+        if cached:
+            usage["cached_content_token_count"] = cached
+        return text, finish, usage
+
+    @staticmethod
+    def _maybe_fail(rate_env: str) -> None:
+        rate = _env_float(rate_env, 0.0)
+        if rate <= 0:
+            return
+        with _RNG_LOCK:
+            roll, pick = _RNG.random(), _RNG.random()
+        if roll < rate:
+            if pick < 0.5:
+                raise RuntimeError("503 Service Unavailable: fake backend is temporarily unavailable")
+            raise RuntimeError("429 Resource exhausted: fake backend rate limit, retry later")
+
+    @staticmethod
+    def _first_token_delay() -> float:
+        delay = _env_float("FAKE_GEMINI_TTFB", 0.5)
+        with _RNG_LOCK:
+            slow = _RNG.random() < _env_float("FAKE_GEMINI_SLOW_RATE", 0.0)
+        return delay + (_env_float("FAKE_GEMINI_SLOW_S", 30.0) if slow else 0.0)
+
+    # -- model surface --
+
+    def count_tokens(self, parts: List) -> _FakeTokenCount:
+        pdf_tokens = int(_env_float("FAKE_GEMINI_PDF_TOKENS", 10000))
+        total = _tokens(self.system_instruction) if not self.prefix else 0
+        for p in parts:
+            total += _tokens(p) if isinstance(p, str) else pdf_tokens
+        return _FakeTokenCount(total)
+
+    def generate_content(self, parts, generation_config=None, safety_settings=None, stream: bool = False):
+        if stream:
+            return self._stream(list(parts), generation_config)
+        time.sleep(self._first_token_delay())
+        self._maybe_fail("FAKE_GEMINI_ERROR_RATE")
+        text, finish, usage = self._plan(list(parts), generation_config)
+        tps = _env_float("FAKE_GEMINI_TPS", 200)
+        if tps > 0:
+            time.sleep(_tokens(text) / tps)
+        return _FakeResponse(text, finish, usage, self.model_id)
+
+    def _stream(self, parts: List, generation_config):
+        time.sleep(self._first_token_delay())
+        self._maybe_fail("FAKE_GEMINI_ERROR_RATE")
+        text, finish, usage = self._plan(parts, generation_config)
+        tps = _env_float("FAKE_GEMINI_TPS", 200)
+        step = 32 * 4  # ~32 tokens per chunk
+        pieces = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+        with _RNG_LOCK:
+            breaks = _RNG.random() < _env_float("FAKE_GEMINI_BREAK_RATE", 0.0)
+            break_at = _RNG.randrange(1, len(pieces)) if breaks and len(pieces) > 1 else None
+        for i, piece in enumerate(pieces):
+            if i == break_at:
+                raise RuntimeError("Fake stream reset by peer (connection reset)")
+            if tps > 0:
+                time.sleep(_tokens(piece) / tps)
+            last = i == len(pieces) - 1
+            yield _FakeResponse(piece, finish if last else None, usage if last else {}, self.model_id)
+
+
+class FakeBackend:
+    """Offline backend with simulated latency, truncation and transient errors."""
+
+    name = "fake"
+
+    def __init__(self, project: str = "", location: str = ""):
+        self.contexts = {}
+
+    def model(self, model_id: str, system_instruction: Optional[str] = None, location: Optional[str] = None):
+        return _FakeModel(model_id, system_instruction)
+
+    def pdf_part(self, uri: str):
+        return _FakePdf(uri)
+
+    def generation_config(self, **cfg):
+        return dict(cfg)
+
+    def safety_settings(self):
+        return None
+
+    def create_context(self, model_id: str, parts: List, system_instruction: Optional[str], ttl_s: int):
+        handle = f"fake-context-{len(self.contexts) + 1}"
+        self.contexts[handle] = (model_id, list(parts), system_instruction)
+        return handle
+
+    def model_for_context(self, handle):
+        model_id, parts, system_instruction = self.contexts[handle]
+        return _FakeModel(model_id, system_instruction, prefix=parts)
+
+    def delete_context(self, handle) -> None:
+        self.contexts.pop(handle, None)
+
+
+BACKENDS = {"vertex": VertexBackend, "fake": FakeBackend}
+
+
+_INSTANCES: dict = {}
+_INSTANCES_LOCK = threading.Lock()
+
+
+def get_backend(name: str, project: str, location: str):
+    """The backend for name (see BACKENDS), created on first use in this process."""
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown model backend {name!r} (choose from {', '.join(BACKENDS)})") from None
+    key = (name, project, location)
+    with _INSTANCES_LOCK:
+        if key not in _INSTANCES:
+            _INSTANCES[key] = cls(project, location)
+        return _INSTANCES[key]
@@ -0,0 +1,116 @@
+"""
+page_index.py
+Single-pass per-page feature index for a PDF.
+
+The PDF stage used to reparse the same document several times: the text
+probe, the page counter, the selective-extraction heuristics (two
+get_text("text") calls per page) and every extraction worker. This module
+scans the document once and records, per page:
+
+  text_len   – length of the page's plain text
+  has_text   – 1 if the page has a non-blank text layer
+  heading    – 1 if a Chapter/Section/Table/Figure heading starts a line
+  images     – [[xref, width, height, stream_bytes], ...] for each image
+  blank      – 1 if the page draws nothing: no text, no image (inline BI/ID
+               images included, which `images` cannot list) and no vector
+               paths; OCR skips only these text-less pages
+
+The index is columnar JSON (one list per feature) so it stays compact and
+loads with a single json.load. It is persisted under the PDF cache root
+(<PDF_CACHE_DIR>/index/<sha256>.json), keyed by the PDF's content hash, so any
+later stage can reuse it without reopening the PDF.
+"""
+
+from __future__ import annotations
+
+import re
+from pathlib import Path
+from typing import List, Optional
+
+from util import load_or_build_json
+import pdf_cache
+import pdf_io
+
+__all__ = [
+    "INDEX_VERSION",
+    "HEADING_RE",
+    "build_index",
+    "load_or_build",
+    "index_path",
+    "page_images",
+    "stream_length",
+]
+
+INDEX_VERSION = 2
+
+HEADING_RE = re.compile(r"^\s{0,3}(Chapter|Section|Table|Figure)\b", re.I | re.M)
+
+
+def stream_length(doc, xref: int) -> int:
+    """Compressed stream size of an xref from its /Length key (0 if unknown)."""
+    try:
+        kind, val = doc.xref_get_key(xref, "Length")
+        if kind == "int":
+            return int(val)
+        if kind == "xref":
+            return int(doc.xref_object(int(val.split()[0])).strip())
+    except Exception:
+        pass
+    return 0
+
+
+def build_index(pdf_path, sha256: Optional[str] = None) -> dict:
+    """Scan every page of pdf_path once and return the columnar index."""
+    text_len: List[int] = []
+    has_text: List[int] = []
+    heading: List[int] = []
+    images: List[list] = []
+    blank: List[int] = []
+    doc = pdf_io.open_doc(pdf_path)  # shared with the later stages
+    for pg in doc:
+        txt = pg.get_text("text") or ""
+        text_len.append(len(txt))
+        has_text.append(1 if txt.strip() else 0)
+        heading.append(1 if HEADING_RE.search(txt) else 0)
+        images.append([
+            [img[0], img[2], img[3], stream_length(doc, img[0])]
+            for img in pg.get_images(full=True)
+        ])
+        # scans stored as inline images or drawn as paths have no xref images;
+        # only text-less pages pay for the extra scans
+        blank.append(0 if txt.strip() or pg.get_image_info() or pg.get_cdrawings() else 1)
+    page_count = len(doc)
+    return {
+        "version": INDEX_VERSION,
+        "sha256": sha256,
+        "page_count": page_count,
+        "text_len": text_len,
+        "has_text": has_text,
+        "heading": heading,
+        "images": images,
+        "blank": blank,
+    }
+
+
+def index_path(sha256: str) -> Optional[Path]:
+    """Where the index for a given content hash lives (None if caching is off)."""
+    root = pdf_cache.cache_root()
+    if root is None:
+        return None
+    return root / "index" / f"{sha256}.json"
+
+
+def load_or_build(pdf_path, sha256: Optional[str] = None) -> dict:
+    """
+    Return the index for pdf_path, loading the persisted copy when present.
+
+    sha256 may be passed when the caller already hashed the file.
+    """
+    sha256 = sha256 or pdf_cache.sha256_file(pdf_path)
+    idx, _ = load_or_build_json(index_path(sha256), INDEX_VERSION, lambda: build_index(pdf_path, sha256))
+    return idx
+
+
+def page_images(idx: dict, i: int) -> List[list]:
+    """Image records ([xref, width, height, stream_bytes]) for page i."""
+    return idx["images"][i]
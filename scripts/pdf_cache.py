@@ -0,0 +1,201 @@
+"""
+pdf_cache.py
+Content-addressed on-disk cache for prepared PDFs.
+
+fetch_and_prepare_pdf.py probes, OCRs, splits and extracts images for every
+referenced PDF. When the same source bytes are processed again (comment
+re-runs, several issues pointing at the same upload-pdf/*.pdf) the results are
+identical, so they are stored here and a repeat run reduces to a hash plus a
+link/copy.
+
+Layout of one entry (key = SHA-256 of source bytes + preparation parameters):
+
+  <root>/<key>/
+    meta.json        – part names and page manifest, image records, policy block
+    parts/<n>.pdf    – final PDF(s) sent to Vertex (OCR'd and/or split)
+    images/<name>    – images extracted from the PDF (already deduplicated)
+
+Entries are assembled in a temp directory next to the root and renamed into
+place, so an interrupted or concurrent run never observes a partial entry.
+Files are materialised with hardlinks when source and destination share a
+filesystem, and copied otherwise.
+
+Environment:
+  PDF_CACHE_DIR   cache root (default: .agent/cache/pdf)
+  PDF_CACHE       set to "0"/"off" to bypass the cache for a run
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from util import tmp_path
+
+__all__ = [
+    "CACHE_VERSION",
+    "cache_root",
+    "sha256_file",
+    "make_key",
+    "link_or_copy",
+    "lookup",
+    "materialize",
+    "store",
+]
+
+# Bump when preparation output changes shape so stale entries are ignored.
+CACHE_VERSION = 6
+
+DEFAULT_CACHE_DIR = os.path.join(".agent", "cache", "pdf")
+
+PathLike = Union[str, Path]
+
+
+def cache_root() -> Optional[Path]:
+    """Return the cache root, or None when caching is disabled via PDF_CACHE."""
+    if os.environ.get("PDF_CACHE", "").strip().lower() in ("0", "off", "false", "no"):
+        return None
+    return Path(os.environ.get("PDF_CACHE_DIR") or DEFAULT_CACHE_DIR)
+
+
+def sha256_file(path: PathLike, chunk_size: int = 1024 * 1024) -> str:
+    """Return the hex SHA-256 of a file, hashed from a read-only memory map
+    (no user-space copy); falls back to chunked reads where mmap fails."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+            return h.hexdigest()
+        except (OSError, ValueError):  # empty file, pipe, unsupported fs
+            pass
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_key(source_sha256: str, **params) -> str:
+    """Derive the entry key from the source hash and preparation parameters."""
+    blob = json.dumps(
+        {"v": CACHE_VERSION, "sha256": source_sha256, "params": params},
+        sort_keys=True,
+    )
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def link_or_copy(src: PathLike, dst: PathLike) -> str:
+    """
+    Place src at dst using a hardlink, falling back to a copy across devices.
+
+    An existing dst is replaced atomically; if dst already is src, nothing happens.
+    """
+    src, dst = Path(src), Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if dst.exists() and os.path.samefile(src, dst):
+            return str(dst)
+    except OSError:
+        pass
+    tmp = tmp_path(dst)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    return str(dst)
+
+
+def lookup(key: str) -> Optional[dict]:
+    """Return the entry metadata for key, or None on a miss (or when disabled)."""
+    root = cache_root()
+    if root is None:
+        return None
+    meta_path = root / key / "meta.json"
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != CACHE_VERSION:
+        return None
+    entry = root / key
+    files = [entry / p["file"] for p in meta.get("parts", [])]
+    files += [entry / "images" / img["name"] for img in meta.get("images", [])]
+    if not all(f.is_file() for f in files):
+        return None
+    return meta
+
+
+def materialize(key: str, meta: dict, work_dir: PathLike, stem: str) -> Dict[str, list]:
+    """
+    Restore a cached entry: parts are linked into work_dir (renamed for this
+    source stem); image records are returned with "path" pointing into the
+    entry, ready for the caller to place. Returns {"parts": [...], "images": [...]}.
+    """
+    entry = cache_root() / key
+    parts = []
+    for p in meta.get("parts", []):
+        name = p["name"].replace("{stem}", stem)
+        parts.append(link_or_copy(entry / p["file"], Path(work_dir) / name))
+    images = [
+        {**img, "path": str(entry / "images" / img["name"])}
+        for img in meta.get("images", [])
+    ]
+    return {"parts": parts, "images": images}
+
+
+def store(
+    key: str,
+    stem: str,
+    parts: List[str],
+    images: List[dict],
+    policy: dict,
+    manifest: Optional[List[dict]] = None,
+) -> bool:
+    """
+    Save prepared outputs under key. Part names are stored relative to the
+    source stem so a later run with a different temp name maps them back.
+    images are records with at least "name" and "path"; every other field is
+    kept in meta.json. manifest (page ranges per part) is stored as-is.
+    Returns True when the entry was written; failures are
+    non-fatal.
+    """
+    root = cache_root()
+    if root is None:
+        return False
+    final = root / key
+    if final.exists():
+        return True
+    try:
+        root.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(prefix=f".{key[:12]}-", dir=root))
+        meta = {
+            "version": CACHE_VERSION,
+            "parts": [],
+            "manifest": manifest or [],
+            "images": [],
+            "policy": policy,
+        }
+        for i, part in enumerate(parts):
+            rel = f"parts/{i}.pdf"
+            link_or_copy(part, staging / rel)
+            meta["parts"].append({"file": rel, "name": Path(part).name.replace(stem, "{stem}", 1)})
+        for img in images:
+            link_or_copy(img["path"], staging / "images" / img["name"])
+            meta["images"].append({k: v for k, v in img.items() if k != "path"})
+        with open(staging / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        try:
+            os.rename(staging, final)
+        except OSError:
+            # another run stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,155 @@
+"""
+pdf_io.py
+Zero-copy placement and shared document handles for the PDF stage.
+
+Repo-local PDFs used to be copied into the temp workspace in 1 MB chunks and
+then reopened from disk by every stage. This module provides:
+
+  - place_file(): put a source PDF into the workspace with a reflink
+    (copy-on-write clone), else a hardlink, else an in-kernel copy;
+  - open_doc(): one file-backed fitz.Document per PDF per process, shared by
+    the index scan, OCR page cutting, split sizing and (inside pool workers)
+    extraction. MuPDF reads the file lazily, so the OS page cache is the only
+    buffer; PyMuPDF cannot open an mmap without first copying it to bytes;
+  - resource_usage(): peak RSS and I/O bytes for this process and its
+    finished children, to confirm the saving.
+
+Hardlinked sources share an inode with the repo file. Nothing in the pipeline
+writes to a source PDF in place, and git replaces files rather than rewriting
+them, so this is safe for checkouts.
+
+Environment:
+  INGEST_MODE   "link" (default: reflink/hardlink when possible) or "copy"
+"""
+
+from __future__ import annotations
+
+import os
+import resource
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from typing import Union
+
+__all__ = [
+    "place_file",
+    "open_doc",
+    "close_docs",
+    "resource_usage",
+]
+
+FICLONE = 0x40049409  # linux/fs.h: _IOW(0x94, 9, int)
+MAX_OPEN_DOCS = 4
+
+_DOCS: "OrderedDict[str, object]" = OrderedDict()
+
+
+def _forget_inherited_docs() -> None:
+    # A forked pool worker must not share the parent's MuPDF file handles
+    # (and their file offsets); forget them and reopen lazily in the child.
+    global _DOCS
+    _DOCS = OrderedDict()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_inherited_docs)
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:  # non-POSIX
+        return False
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+
+
+def place_file(src: Union[str, Path], dst: Union[str, Path]) -> str:
+    """
+    Make dst a byte-identical copy of src as cheaply as the filesystem allows.
+
+    Returns the method used: "reflink", "hardlink" or "copy". INGEST_MODE=copy
+    forces a copy (still done in-kernel via shutil.copyfile).
+    """
+    src, dst = Path(src), Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if os.environ.get("INGEST_MODE", "link").strip().lower() != "copy":
+        if _reflink(src, dst):
+            return "reflink"
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def open_doc(pdf_path):
+    """
+    Return this process's shared fitz.Document for pdf_path (opened on first use).
+
+    Callers must not close it. At most MAX_OPEN_DOCS stay open; the least
+    recently used is closed first. Not thread-safe: in the main process,
+    callers hold fetch_and_prepare_pdf.FITZ_LOCK.
+    """
+    import fitz
+
+    key = os.path.abspath(pdf_path)
+    doc = _DOCS.get(key)
+    if doc is not None:
+        _DOCS.move_to_end(key)
+        return doc
+    while len(_DOCS) >= MAX_OPEN_DOCS:
+        _, old = _DOCS.popitem(last=False)
+        old.close()
+    doc = _DOCS[key] = fitz.open(key)
+    return doc
+
+
+def close_docs() -> None:
+    """Close every shared document of this process."""
+    while _DOCS:
+        _, doc = _DOCS.popitem()
+        doc.close()
+
+
+def _proc_io() -> dict:
+    """Counters from /proc/self/io (Linux only; empty elsewhere)."""
+    out = {}
+    try:
+        with open("/proc/self/io", encoding="ascii") as f:
+            for line in f:
+                k, _, v = line.partition(":")
+                out[k.strip()] = int(v)
+    except (OSError, ValueError):
+        pass
+    return out
+
+
+def resource_usage() -> dict:
+    """
+    Peak memory and I/O for this process and its reaped children (pool
+    workers count once the pool has shut down). Block counts are 512-byte
+    units as reported by getrusage.
+    """
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    kids_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = _proc_io()
+    return {
+        "peak_rss_mb": round(self_ru.ru_maxrss / 1024, 1),
+        "children_peak_rss_mb": round(kids_ru.ru_maxrss / 1024, 1),
+        "read_bytes": io.get("read_bytes", self_ru.ru_inblock * 512),
+        "write_bytes": io.get("write_bytes", self_ru.ru_oublock * 512),
+        "read_chars": io.get("rchar"),
+        "children_read_bytes": kids_ru.ru_inblock * 512,
+        "children_write_bytes": kids_ru.ru_oublock * 512,
+    }
@@ -0,0 +1,238 @@
+"""
+pdf_signals.py
+Document signals for prompt routing (select_prompt.py), cached per PDF.
+
+For each prepared PDF this computes, in one pass:
+
+  page_count      pages in the PDF
+  text_coverage   share of pages with a text layer
+  image_density   share of pages showing an image of at least MIN_IMAGE_AREA px
+  table_density   share of pages that look like they hold a table: ruling
+                  lines (horizontal and vertical, or many horizontal ones)
+                  or a "Table <n>" caption
+  doc_type        best document-type hint ("specification", "regulatory",
+                  "invoice", "datasheet"), with doc_type_cues per type; ""
+                  when no type has MIN_CUES distinct cue phrases or the
+                  leaders tie. "invoice" and "datasheet" switch prompts, and
+                  their cues (gst, abn, due date) also turn up in payments
+                  specs, so they must lead the runner-up by ROUTING_MARGIN
+
+Coverage and images come from the per-page index (page_index.py) when the
+PDF stage already built one for this content hash; everything else is read
+from at most SIGNALS_SAMPLE_PAGES pages (the first SAMPLE_FRONT pages plus
+an even spread), so a 1000-page document costs the same as a 50-page one.
+Densities measured on a sample are estimates; "sampled" says how many pages
+were read.
+
+Results are stored under the PDF cache root
+(<PDF_CACHE_DIR>/signals/<sha256>.json), keyed by the PDF's content hash, so
+re-runs on the same PDF only hash it. combine() merges several PDFs (split
+parts or several sources) into the signals select_prompt.py routes on:
+page_count is summed, densities are page-weighted, and contains_tables /
+likely_invoice / likely_datasheet are derived from them.
+
+Environment:
+  SIGNALS_SAMPLE_PAGES  pages read per PDF (default 48)
+  SIGNALS_TABLE_MIN     table_density at which contains_tables is set
+                        (default 0.05)
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from typing import Dict, List, Optional
+
+from util import load_or_build_json
+import page_index
+import pdf_cache
+import pdf_io
+
+__all__ = [
+    "SIGNALS_VERSION",
+    "DOC_TYPE_CUES",
+    "DEFAULT_SIGNALS",
+    "sample_pages",
+    "doc_type",
+    "analyze",
+    "load_or_analyze",
+    "combine",
+    "detect",
+]
+
+SIGNALS_VERSION = 2
+
+SAMPLE_FRONT = 4
+MIN_IMAGE_AREA = 100 * 100  # logos and bullets are not "images"
+MIN_CUES = 2
+ROUTING_MARGIN = 2  # lead over the runner-up needed for invoice / datasheet
+
+TABLE_CAPTION_RE = re.compile(r"^\s*Table\s+[A-Z]?\d", re.M)
+DOC_TYPE_CUES = {
+    "invoice": ("tax invoice", "invoice number", "invoice no", "amount due", "bill to", "due date", "gst", "abn"),
+    "datasheet": ("datasheet", "data sheet", "electrical characteristics", "absolute maximum ratings",
+                  "pin configuration", "ordering information", "operating temperature"),
+    "specification": ("shall", "must", "requirement", "specification", "message", "iso 20022", "schema",
+                      "version", "field"),
+    "regulatory": ("consultation", "prudential", "regulation", "regulator", "reserve bank", "apra", "asic",
+                   "compliance", "access regime"),
+}
+
+DEFAULT_SIGNALS = {
+    "page_count": 0,
+    "contains_tables": False,
+    "likely_invoice": False,
+    "likely_datasheet": False,
+    "text_coverage": 0.0,
+    "image_density": 0.0,
+    "table_density": 0.0,
+    "doc_type": "",
+}
+
+
+def sample_pages(n: int, k: int) -> List[int]:
+    """The first SAMPLE_FRONT pages plus an even spread, k pages in all (all pages when n <= k)."""
+    if n <= k:
+        return list(range(n))
+    front = list(range(min(SAMPLE_FRONT, k)))
+    rest = k - len(front)
+    step = (n - len(front)) / rest
+    return front + [len(front) + int(i * step) for i in range(rest)]
+
+
+def doc_type(cues: Dict[str, int]) -> str:
+    """The leading type by distinct cues, or "" (too few cues, a tie, or a routing type without a clear lead)."""
+    ranked = sorted(cues.items(), key=lambda kv: -kv[1])
+    if not ranked or ranked[0][1] < MIN_CUES:
+        return ""
+    best, n = ranked[0]
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    margin = ROUTING_MARGIN if best in ("invoice", "datasheet") else 1
+    return best if n - runner_up >= margin else ""
+
+
+def _table_like(page) -> bool:
+    """Ruling lines of a grid, or the horizontal rules of a booktabs-style table."""
+    h = v = 0
+    for d in page.get_drawings():
+        for item in d["items"]:
+            if item[0] == "l":
+                a, b = item[1], item[2]
+                if abs(a.y - b.y) < 1 and abs(a.x - b.x) > 20:
+                    h += 1
+                elif abs(a.x - b.x) < 1 and abs(a.y - b.y) > 8:
+                    v += 1
+            elif item[0] == "re":
+                r = item[1]
+                if r.height < 2 and r.width > 20:
+                    h += 1
+                elif r.width < 2 and r.height > 8:
+                    v += 1
+    return (h >= 4 and v >= 2) or h >= 8
+
+
+def analyze(pdf_path, sha256: Optional[str] = None, sample: Optional[int] = None) -> dict:
+    """Signals for one PDF (see module docstring)."""
+    if sample is None:
+        sample = int(os.environ.get("SIGNALS_SAMPLE_PAGES", "48"))
+    idx = None
+    path = page_index.index_path(sha256) if sha256 else None
+    if path is not None and path.exists():
+        idx = page_index.load_or_build(pdf_path, sha256)  # already built by the PDF stage
+
+    doc = pdf_io.open_doc(pdf_path)
+    n = len(doc)
+    pages = sample_pages(n, max(1, sample))
+    with_text = with_images = tables = 0
+    words = []
+    for i in pages:
+        pg = doc[i]
+        text = pg.get_text("text") or ""
+        words.append(text.lower())
+        if TABLE_CAPTION_RE.search(text) or _table_like(pg):
+            tables += 1
+        if idx is None:
+            with_text += 1 if text.strip() else 0
+            with_images += 1 if any(img[2] * img[3] >= MIN_IMAGE_AREA for img in pg.get_images(full=True)) else 0
+
+    if idx is not None:
+        text_coverage = sum(idx["has_text"]) / max(1, n)
+        image_density = sum(
+            1 for recs in idx["images"] if any(r[1] * r[2] >= MIN_IMAGE_AREA for r in recs)
+        ) / max(1, n)
+    else:
+        text_coverage = with_text / max(1, len(pages))
+        image_density = with_images / max(1, len(pages))
+
+    sampled_text = "\n".join(words)
+    cues = {
+        kind: sum(1 for c in phrases if re.search(r"\b" + re.escape(c) + r"\b", sampled_text))
+        for kind, phrases in DOC_TYPE_CUES.items()
+    }
+    return {
+        "version": SIGNALS_VERSION,
+        "sha256": sha256,
+        "page_count": n,
+        "sampled": len(pages),
+        "from_index": idx is not None,
+        "text_coverage": round(text_coverage, 3),
+        "image_density": round(image_density, 3),
+        "table_density": round(tables / max(1, len(pages)), 3),
+        "doc_type": doc_type(cues),
+        "doc_type_cues": cues,
+    }
+
+
+def signals_path(sha256: str):
+    root = pdf_cache.cache_root()
+    if root is None:
+        return None
+    return root / "signals" / f"{sha256}.json"
+
+
+def load_or_analyze(pdf_path) -> tuple:
+    """(signals, cache_hit) for one PDF, persisted by content hash."""
+    sha256 = pdf_cache.sha256_file(pdf_path)
+    return load_or_build_json(signals_path(sha256), SIGNALS_VERSION, lambda: analyze(pdf_path, sha256))
+
+
+def combine(per_pdf: List[dict]) -> dict:
+    """Routing signals for several PDFs: pages summed, densities page-weighted."""
+    if not per_pdf:
+        return dict(DEFAULT_SIGNALS)
+    total = sum(s["page_count"] for s in per_pdf) or 1
+
+    def weighted(key: str) -> float:
+        return round(sum(s[key] * s["page_count"] for s in per_pdf) / total, 3)
+
+    cues: Dict[str, int] = {}
+    for s in per_pdf:
+        for kind, n in s.get("doc_type_cues", {}).items():
+            cues[kind] = max(cues.get(kind, 0), n)
+    kind = doc_type(cues)
+    table_min = float(os.environ.get("SIGNALS_TABLE_MIN", "0.05"))
+    out = {
+        "page_count": sum(s["page_count"] for s in per_pdf),
+        "text_coverage": weighted("text_coverage"),
+        "image_density": weighted("image_density"),
+        "table_density": weighted("table_density"),
+        "doc_type": kind,
+        "doc_type_cues": cues,
+        "sampled": sum(s.get("sampled", 0) for s in per_pdf),
+    }
+    out["contains_tables"] = out["table_density"] >= table_min
+    out["likely_invoice"] = kind == "invoice"
+    out["likely_datasheet"] = kind == "datasheet"
+    return out
+
+
+def detect(pdf_paths: List[str]) -> dict:
+    """combine() over the given PDFs, each analysed once per content hash."""
+    per_pdf, hits = [], 0
+    for p in pdf_paths:
+        sig, hit = load_or_analyze(p)
+        per_pdf.append(sig)
+        hits += hit
+    out = combine(per_pdf)
+    out["cache_hits"] = hits
+    return out
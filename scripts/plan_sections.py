@@ -70,17 +70,19 @@ def _pick_from_text(text: str):
 
     return []
 
-def main():
+def plan(ctx: dict):
+    """Required sections for an issue context (falls back to DEFAULTS)."""
+    text = (ctx.get("latest_comment") or "") + "\n\n" + (ctx.get("body") or "")
+    return _pick_from_text(text) or DEFAULTS[:]
+
+def main(argv=None):
     ap = argparse.ArgumentParser()
     ap.add_argument("--context", required=True)  # issue_context.json
     ap.add_argument("--out", required=True, default="required_sections.json")
-    args = ap.parse_args()
+    args = ap.parse_args(argv)
 
     ctx = json.loads(Path(args.context).read_text())
-    text = (ctx.get("latest_comment") or "") + "\n\n" + (ctx.get("body") or "")
-    sections = _pick_from_text(text)
-    if not sections:
-        sections = DEFAULTS[:]
+    sections = plan(ctx)
 
     outp = {"sections": sections}
     Path(args.out).write_text(json.dumps(outp, indent=2))
@@ -0,0 +1,176 @@
+"""
+response_cache.py
+Deterministic on-disk cache for Gemini responses.
+
+Re-running the workflow on an unchanged issue sends Vertex a byte-identical
+request. run_gemini_sdk.py therefore looks every call up here first (first
+pass, map, section and continuation calls alike). The key covers everything
+that determines the request:
+
+  - model id and GenerationConfig values
+  - the system instruction
+  - each request part: SHA-256 of text parts, and the content hash of the PDF
+    behind each gs:// part (never just its URI, which is reused across runs)
+
+A request whose PDF content hash is unknown is not cached.
+
+Layout: <root>/<key[:2]>/<key>.json holding {"text", "finish_reason",
+"usage", "model_version", "created"}. Entries are written atomically. A hit
+refreshes the entry's mtime, and stores evict the least recently used entries
+once the directory exceeds its size budget.
+
+Environment:
+  GEMINI_CACHE_DIR      cache root (default: .agent/cache/gemini/responses)
+  GEMINI_CACHE          set to "0"/"off" to bypass the cache
+  GEMINI_CACHE_MAX_MB   size budget for LRU eviction (default 256)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+__all__ = [
+    "CACHE_VERSION",
+    "cache_root",
+    "make_key",
+    "get",
+    "put",
+    "metrics",
+    "reset_metrics",
+]
+
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(".agent", "cache", "gemini", "responses")
+
+_LOCK = threading.Lock()
+_METRICS = {"hits": 0, "misses": 0, "uncacheable": 0, "stores": 0, "evictions": 0, "saved_output_tokens": 0}
+
+
+def cache_root() -> Optional[Path]:
+    """Return the cache root, or None when disabled via GEMINI_CACHE."""
+    if os.environ.get("GEMINI_CACHE", "").strip().lower() in ("0", "off", "false", "no"):
+        return None
+    return Path(os.environ.get("GEMINI_CACHE_DIR") or DEFAULT_CACHE_DIR)
+
+
+def _max_bytes() -> int:
+    try:
+        return int(float(os.environ.get("GEMINI_CACHE_MAX_MB", "256")) * 1024 * 1024)
+    except ValueError:
+        return 256 * 1024 * 1024
+
+
+def make_key(model: str, gen_cfg: dict, system_instruction: Optional[str], part_keys: Iterable[str]) -> str:
+    """
+    Derive the entry key. part_keys are per-part fingerprints in request
+    order, e.g. "text:<sha256>" or "pdf:<content hash>".
+    """
+    blob = json.dumps(
+        {
+            "v": CACHE_VERSION,
+            "model": model,
+            "cfg": gen_cfg,
+            "system": hashlib.sha256((system_instruction or "").encode("utf-8")).hexdigest(),
+            "parts": list(part_keys),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _path(key: str) -> Optional[Path]:
+    root = cache_root()
+    return None if root is None else root / key[:2] / f"{key}.json"
+
+
+def _count(name: str, n: int = 1) -> None:
+    with _LOCK:
+        _METRICS[name] += n
+
+
+def get(key: Optional[str]) -> Optional[dict]:
+    """Return the cached record for key (None on a miss, bypass or key=None)."""
+    if key is None:
+        _count("uncacheable")
+        return None
+    path = _path(key)
+    if path is None:
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            rec = json.load(f)
+        os.utime(path)  # LRU: a hit makes the entry recent
+    except (OSError, ValueError):
+        _count("misses")
+        return None
+    _count("hits")
+    _count("saved_output_tokens", int((rec.get("usage") or {}).get("candidates_token_count") or 0))
+    return rec
+
+
+def _evict(root: Path) -> None:
+    entries = []
+    for p in root.glob("*/*.json"):
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+    total = sum(e[1] for e in entries)
+    limit = _max_bytes()
+    for _, size, p in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            p.unlink()
+            total -= size
+            _count("evictions")
+        except OSError:
+            pass
+
+
+def put(key: Optional[str], text: str, finish_reason=None, usage: Optional[dict] = None, model_version=None) -> bool:
+    """Store a response; empty text and uncacheable keys are ignored. Non-fatal."""
+    if key is None or not text:
+        return False
+    path = _path(key)
+    if path is None:
+        return False
+    rec = {
+        "text": text,
+        "finish_reason": str(finish_reason) if finish_reason is not None else None,
+        "usage": usage or {},
+        "model_version": model_version,
+        "created": time.time(),
+    }
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(rec, f)
+        os.replace(tmp, path)
+        _count("stores")
+        _evict(path.parent.parent)
+        return True
+    except OSError:
+        return False
+
+
+def metrics() -> dict:
+    """Hit/miss counters for this process."""
+    with _LOCK:
+        return dict(_METRICS)
+
+
+def reset_metrics() -> None:
+    """Zero the counters (worker.py, between jobs)."""
+    with _LOCK:
+        for k in _METRICS:
+            _METRICS[k] = 0
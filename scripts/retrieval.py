@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+retrieval.py
+Local BM25 retrieval over the prepared PDFs' page text, so the model only
+receives the pages an issue is about.
+
+An issue about PayTo mandates does not need all 600 pages of an NPP
+specification. After fetch_and_prepare_pdf.py this stage scores every page of
+every prepared PDF against the issue text (title, body, comments) and the
+planned sections, keeps the best RETRIEVAL_TOP_K pages plus
+RETRIEVAL_CONTEXT neighbouring pages on each side (and the first
+RETRIEVAL_KEEP_FRONT pages: title, contents, definitions), and replaces
+ctx["final_pdf_paths"] with:
+
+  pdf   one trimmed PDF per source holding only the kept pages (re-split
+        when it is still over fetch_and_prepare_pdf's SPLIT_MAX_PAGES /
+        SPLIT_TARGET_MB); the page ranges go to ctx["part_manifest"] and
+        build_prompt.py tells the model which original pages it is reading.
+        ctx["gcs_uris"] is dropped and written again by upload_to_gcs.py;
+  text  no PDFs at all: the kept pages' text is written to an excerpts file
+        that build_prompt.py inlines into the prompt.
+
+Documents shorter than RETRIEVAL_MIN_PAGES, issues whose text matches no
+page, and selections covering more than RETRIEVAL_MAX_SHARE of the pages are
+sent whole, as before.
+
+The index (per page: length and term frequencies, as term postings) is built
+in one pass over each prepared part and persisted under the PDF cache root
+(<PDF_CACHE_DIR>/retrieval/<sha256>.json), keyed by the part's content hash,
+so comment re-runs on the same PDF only tokenise the query. Scoring touches
+the postings of the query terms only, so it stays in pure Python.
+
+Measuring it: ctx["retrieval"] (-> run_meta.json) records the pages kept,
+their ranges and the estimated input tokens with and without retrieval; the
+usage ledger has the billed tokens of runs with and without it. Recall
+against labelled pages:
+
+  python scripts/retrieval.py --eval qrels.json --pdf upload-pdf/spec.pdf
+  qrels.json: [{"query": "PayTo mandate amendment", "pages": [212, 213]}, ...]
+
+reports, per query and on average, the share of relevant pages kept and the
+share of the document sent.
+
+Environment:
+  RETRIEVAL             off (default) | pdf | text
+  RETRIEVAL_TOP_K       best-scoring pages kept (default 30)
+  RETRIEVAL_CONTEXT     neighbouring pages kept on each side of a hit (default 1)
+  RETRIEVAL_KEEP_FRONT  leading pages always kept (default 2)
+  RETRIEVAL_MIN_PAGES   smaller documents are sent whole (default 50)
+  RETRIEVAL_MAX_SHARE   send whole above this share of pages kept (default 0.7)
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from util import load_or_build_json, read_json, write_json
+import fetch_and_prepare_pdf
+import pdf_cache
+import pdf_io
+import token_budget
+
+__all__ = [
+    "INDEX_VERSION",
+    "MODES",
+    "tokenize",
+    "build_index",
+    "load_or_build",
+    "Corpus",
+    "build_query",
+    "select_pages",
+    "to_ranges",
+    "retrieve_context",
+]
+
+INDEX_VERSION = 1
+MODES = ("off", "pdf", "text")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+SECTION_WEIGHT = 0.5  # planned section names are generic; the issue text leads
+
+UNSAFE_NAME_RE = re.compile(r"[^A-Za-z0-9._-]+")
+WORD_RE = re.compile(r"[a-z0-9]+(?:[._-][a-z0-9]+)*")
+NOISE_RE = re.compile(r"https?://\S+|\S+\.pdf\b|@\w+", re.I)
+STOPWORDS = frozenset("""
+a about above after all also an and any are as at be been but by can could do does for from had has
+have how i if in into is it its may more must no not of on or other our shall should so such than
+that the their then there these they this those to under up upon was we were what when where which
+while who will with would you your
+""".split())
+# issue boilerplate that says nothing about the topic
+QUERY_STOPWORDS = STOPWORDS | frozenset("""
+please pdf doc document documents file upload report summary summarise summarize update gemini issue
+thanks thank section sections include add need want like see attached new latest comment focus
+focusing cover covering detail details
+""".split())
+
+
+def _env_num(name: str, default, cast=int):
+    try:
+        return cast(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _stem(word: str) -> str:
+    """Plural folding only: "mandates" and "mandate" are one term."""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str, stopwords=STOPWORDS) -> List[str]:
+    """Lower-cased terms; dotted/hyphenated identifiers (pacs.008) also yield their pieces."""
+    out = []
+    for tok in WORD_RE.findall((text or "").lower()):
+        pieces = re.split(r"[._-]", tok)
+        for t in ([tok] + pieces) if len(pieces) > 1 else [tok]:
+            if len(t) > 1 and t not in stopwords:
+                out.append(_stem(t))
+    return out
+
+
+# ---------------------------
+# Index (per prepared PDF part)
+# ---------------------------
+
+def build_index(pdf_path, sha256: Optional[str] = None) -> dict:
+    """Tokenise every page once: page lengths plus term -> [page, tf, page, tf, ...]."""
+    page_len: List[int] = []
+    postings: Dict[str, list] = {}
+    doc = pdf_io.open_doc(pdf_path)
+    for i, pg in enumerate(doc):
+        terms = Counter(tokenize(pg.get_text("text") or ""))
+        page_len.append(sum(terms.values()))
+        for term, tf in terms.items():
+            postings.setdefault(term, []).extend((i, tf))
+    return {
+        "version": INDEX_VERSION,
+        "sha256": sha256,
+        "page_count": len(page_len),
+        "page_len": page_len,
+        "postings": postings,
+    }
+
+
+def index_path(sha256: str) -> Optional[Path]:
+    root = pdf_cache.cache_root()
+    if root is None:
+        return None
+    return root / "retrieval" / f"{sha256}.json"
+
+
+def load_or_build(pdf_path, sha256: Optional[str] = None) -> tuple:
+    """(index, cache_hit) for pdf_path, persisted by content hash like page_index.py."""
+    sha256 = sha256 or pdf_cache.sha256_file(pdf_path)
+    return load_or_build_json(index_path(sha256), INDEX_VERSION, lambda: build_index(pdf_path, sha256))
+
+
+# ---------------------------
+# Scoring
+# ---------------------------
+
+class Corpus:
+    """BM25 over the pages of several indexed parts; IDF is shared by all of them."""
+
+    def __init__(self):
+        self.pages: List[tuple] = []  # (source, original 1-based page)
+        self.page_len: List[int] = []
+        self.parts: List[tuple] = []  # (first corpus page, postings)
+
+    def add(self, idx: dict, source: str, first_page: int = 1) -> None:
+        self.parts.append((len(self.pages), idx["postings"]))
+        self.pages.extend((source, first_page + i) for i in range(idx["page_count"]))
+        self.page_len.extend(idx["page_len"])
+
+    def postings(self, term: str) -> List[tuple]:
+        """[(corpus page, tf), ...] for one term across all parts."""
+        out = []
+        for base, postings in self.parts:
+            flat = postings.get(term) or ()
+            out.extend((base + flat[j], flat[j + 1]) for j in range(0, len(flat), 2))
+        return out
+
+    def scores(self, query: Dict[str, float]) -> List[float]:
+        n = len(self.pages)
+        out = [0.0] * n
+        if not n:
+            return out
+        avg = (sum(self.page_len) / n) or 1.0
+        for term, weight in query.items():
+            plist = self.postings(term)
+            if not plist:
+                continue
+            idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for page, tf in plist:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.page_len[page] / avg)
+                out[page] += weight * idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return out
+
+
+def _planned_sections(ctx: dict) -> List[str]:
+    env_val = os.environ.get("CUSTOM_REQUIRED_SECTIONS")
+    if env_val:
+        return [s.strip() for s in env_val.split(",") if s.strip()]
+    if ctx.get("required_sections"):
+        return list(ctx["required_sections"])
+    try:
+        return list(read_json("required_sections.json").get("sections") or [])
+    except (OSError, ValueError, AttributeError):
+        return []
+
+
+def build_query(ctx: dict) -> Dict[str, float]:
+    """Weighted query terms from the issue text and the planned sections."""
+    text = "\n".join(ctx.get(k) or "" for k in ("title", "body", "latest_comment", "all_comments_text"))
+    query: Dict[str, float] = {}
+    for term in tokenize(NOISE_RE.sub(" ", text), QUERY_STOPWORDS):
+        query[term] = query.get(term, 0.0) + 1.0
+    for term in tokenize(" ".join(_planned_sections(ctx)), QUERY_STOPWORDS):
+        query[term] = query.get(term, 0.0) + SECTION_WEIGHT
+    # repeated words count, but sublinearly
+    return {t: 1.0 + math.log(w) if w >= 1 else w for t, w in query.items()}
+
+
+def select_pages(scores: List[float], top_k: int, context: int = 1) -> List[int]:
+    """Corpus pages of the top_k positive scores, widened by context pages (sorted)."""
+    ranked = sorted((i for i, s in enumerate(scores) if s > 0), key=lambda i: -scores[i])[:top_k]
+    keep = set()
+    for i in ranked:
+        keep.update(range(max(0, i - context), min(len(scores), i + context + 1)))
+    return sorted(keep)
+
+
+def to_ranges(pages: List[int]) -> List[List[int]]:
+    """[3, 4, 5, 9] -> [[3, 5], [9, 9]]."""
+    ranges: List[List[int]] = []
+    for p in sorted(pages):
+        if ranges and p == ranges[-1][1] + 1:
+            ranges[-1][1] = p
+        else:
+            ranges.append([p, p])
+    return ranges
+
+
+# ---------------------------
+# Stage
+# ---------------------------
+
+def _write_trimmed(parts: List[tuple], out_path: str) -> int:
+    """Concatenate (part path, [[first, last], ...] 0-based) ranges into one PDF; returns bytes."""
+    import fitz
+
+    out = fitz.open()
+    for path, ranges in parts:
+        src = pdf_io.open_doc(path)
+        for first, last in ranges:
+            out.insert_pdf(src, from_page=first, to_page=last)
+    out.save(out_path, garbage=3, deflate=True)
+    out.close()
+    return os.path.getsize(out_path)
+
+
+def _part_stem(n: int, source: str) -> str:
+    """File/object-safe stem for source n's trimmed PDF; source may be a URL with a query string."""
+    base = source.split("?", 1)[0].split("#", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+    base = UNSAFE_NAME_RE.sub("_", Path(base).stem).strip("._")[:40] or "source"
+    return f"retrieved-{n}-{base}-{hashlib.sha256(source.encode('utf-8')).hexdigest()[:8]}"
+
+
+def _split_trimmed(out_path: str, size: int, pages: List[int], work_dir: str) -> List[tuple]:
+    """
+    Re-apply fetch_and_prepare_pdf's per-part limits to a trimmed PDF.
+    Returns [(path, original pages, bytes)]; pages are the original page
+    numbers held by each part.
+    """
+    max_pages, target_mb = fetch_and_prepare_pdf.SPLIT_MAX_PAGES, fetch_and_prepare_pdf.SPLIT_TARGET_MB
+    if len(pages) <= max_pages and size <= target_mb * 1024 * 1024:
+        return [(out_path, pages, size)]
+    split = fetch_and_prepare_pdf.split_pdf_by_size(out_path, work_dir, max_pages=max_pages, target_mb=target_mb)
+    os.remove(out_path)
+    return [(m["path"], pages[m["first_page"] - 1:m["last_page"]], m["bytes"]) for m in split]
+
+
+def _write_excerpts(corpus: Corpus, keep: List[int], locate: Dict[int, tuple], out_path: str) -> str:
+    """Kept pages' text, headed "[<source>, page N]"; returns the text written."""
+    chunks = []
+    for c in keep:
+        path, i = locate[c]
+        source, page = corpus.pages[c]
+        text = (pdf_io.open_doc(path)[i].get_text("text") or "").strip()
+        if text:
+            chunks.append(f"[{source}, page {page}]\n{text}")
+    body = "\n\n".join(chunks)
+    Path(out_path).write_text(body, encoding="utf-8")
+    return body
+
+
+def retrieve_context(ctx: dict, mode: Optional[str] = None) -> dict:
+    """Trim ctx["final_pdf_paths"] to the pages relevant to the issue; updates and returns ctx."""
+    mode = (mode or os.environ.get("RETRIEVAL") or "off").strip().lower()
+    if mode not in MODES:
+        raise ValueError(f"RETRIEVAL must be one of {', '.join(MODES)}, not {mode!r}")
+    if mode == "off":
+        return ctx
+    paths = ctx.get("final_pdf_paths") or []
+    manifest = ctx.get("part_manifest") or []
+    if not paths or len(manifest) != len(paths):
+        print("WARN: retrieval needs final_pdf_paths and part_manifest; sending whole PDFs", file=sys.stderr)
+        return ctx
+
+    top_k = _env_num("RETRIEVAL_TOP_K", 30)
+    context = _env_num("RETRIEVAL_CONTEXT", 1)
+    keep_front = _env_num("RETRIEVAL_KEEP_FRONT", 2)
+    min_pages = _env_num("RETRIEVAL_MIN_PAGES", 50)
+    max_share = _env_num("RETRIEVAL_MAX_SHARE", 0.7, float)
+
+    t0 = time.perf_counter()
+    corpus, locate, hits = Corpus(), {}, 0
+    for path, m in zip(paths, manifest):
+        idx, hit = load_or_build(path)
+        hits += hit
+        base = len(corpus.pages)
+        corpus.add(idx, m.get("source") or Path(path).name, m.get("first_page") or 1)
+        locate.update((base + i, (path, i)) for i in range(idx["page_count"]))
+    index_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    query = build_query(ctx)
+    scores = corpus.scores(query)
+    keep = set(select_pages(scores, top_k, context))
+    if keep:
+        keep.update(c for c, (_, page) in enumerate(corpus.pages) if page <= keep_front)
+    keep = sorted(keep)
+    search_s = time.perf_counter() - t0
+
+    total = len(corpus.pages)
+    info = {
+        "mode": mode,
+        "query_terms": sorted(query, key=lambda t: -query[t])[:25],
+        "pages_total": total,
+        "pages_kept": len(keep),
+        "index_cache_hits": hits,
+        "index_s": round(index_s, 3),
+        "search_s": round(search_s, 3),
+        "est_tokens_full": total * token_budget.PDF_PAGE_TOKENS,
+    }
+    reason = ""
+    if total < min_pages:
+        reason = f"{total} pages < RETRIEVAL_MIN_PAGES={min_pages}"
+    elif not keep:
+        reason = "no page matches the issue text"
+    elif len(keep) > max_share * total:
+        reason = f"{len(keep)}/{total} pages kept > RETRIEVAL_MAX_SHARE={max_share}"
+    if reason:
+        info.update(applied=False, reason=reason, pages_kept=total, est_tokens_kept=info["est_tokens_full"])
+        ctx["retrieval"] = info
+        print(f"Retrieval: sending whole PDFs ({reason})", file=sys.stderr)
+        return ctx
+
+    # group the kept pages by source, in document order
+    by_source: Dict[str, list] = {}
+    for c in keep:
+        by_source.setdefault(corpus.pages[c][0], []).append(c)
+    info["ranges"] = {src: to_ranges([corpus.pages[c][1] for c in cs]) for src, cs in by_source.items()}
+
+    work_dir = os.path.dirname(paths[0])
+    if mode == "text":
+        excerpts = os.path.join(work_dir, "retrieved-excerpts.txt")
+        text = _write_excerpts(corpus, keep, locate, excerpts)
+        info["excerpts_path"] = excerpts
+        info["est_tokens_kept"] = token_budget.estimate_text_tokens(text)
+        ctx["final_pdf_paths"], ctx["gcs_uris"], ctx["part_manifest"] = [], [], []
+        ctx.setdefault("policy", {})["chunked"] = False
+    else:
+        final_pdfs, new_manifest = [], []
+        for n, (src, cs) in enumerate(by_source.items(), 1):
+            per_part: Dict[str, list] = {}
+            for c in cs:
+                path, i = locate[c]
+                per_part.setdefault(path, []).append(i)
+            out_path = os.path.join(work_dir, _part_stem(n, src) + ".pdf")
+            size = _write_trimmed([(p, [[a, b] for a, b in to_ranges(ix)]) for p, ix in per_part.items()], out_path)
+            pages = [corpus.pages[c][1] for c in cs]
+            for path, held, nbytes in _split_trimmed(out_path, size, pages, work_dir):
+                final_pdfs.append(path)
+                new_manifest.append({"part": Path(path).name, "source": src, "first_page": held[0],
+                                     "last_page": held[-1], "page_count": len(held), "bytes": nbytes,
+                                     "pages": to_ranges(held)})
+        ctx["final_pdf_paths"] = final_pdfs
+        ctx["part_manifest"] = new_manifest
+        ctx.setdefault("policy", {})["chunked"] = len(final_pdfs) > len(by_source)
+        # upload_to_gcs.py names the objects and records their URIs and hashes
+        ctx.pop("gcs_uris", None)
+        ctx.pop("gcs_hashes", None)
+        info["est_tokens_kept"] = len(keep) * token_budget.PDF_PAGE_TOKENS
+    pdf_io.close_docs()
+
+    info["applied"] = True
+    info["saved_pct"] = round(100.0 * (1 - info["est_tokens_kept"] / max(1, info["est_tokens_full"])), 1)
+    ctx["retrieval"] = info
+    print(f"Retrieval ({mode}): kept {len(keep)}/{total} pages, ~{info['saved_pct']}% fewer input tokens "
+          f"(index {info['index_s']}s, {hits}/{len(paths)} cached; search {info['search_s']}s)", file=sys.stderr)
+    return ctx
+
+
+# ---------------------------
+# Evaluation
+# ---------------------------
+
+def evaluate(qrels: List[dict], pdf_paths: List[str]) -> dict:
+    """Recall of labelled relevant pages (1-based) and share of pages sent, per query."""
+    top_k = _env_num("RETRIEVAL_TOP_K", 30)
+    context = _env_num("RETRIEVAL_CONTEXT", 1)
+    keep_front = _env_num("RETRIEVAL_KEEP_FRONT", 2)
+    corpus = Corpus()
+    for path in pdf_paths:
+        corpus.add(load_or_build(path)[0], path)
+    total = len(corpus.pages)
+    rows = []
+    for q in qrels:
+        scores = corpus.scores(build_query({"body": q["query"]}))
+        keep = set(select_pages(scores, top_k, context))
+        if keep:
+            keep.update(c for c, (_, page) in enumerate(corpus.pages) if page <= keep_front)
+        kept = {corpus.pages[c] for c in keep}
+        source = q.get("source") or pdf_paths[0]
+        relevant = {(source, int(p)) for p in q["pages"]}
+        rows.append({
+            "query": q["query"],
+            "recall": round(len(relevant & kept) / max(1, len(relevant)), 3),
+            "missed": sorted(p for _, p in relevant - kept),
+            "pages_kept": len(keep),
+            "share_sent": round(len(keep) / max(1, total), 3),
+        })
+    n = max(1, len(rows))
+    return {
+        "pages_total": total,
+        "top_k": top_k,
+        "context": context,
+        "mean_recall": round(sum(r["recall"] for r in rows) / n, 3),
+        "mean_share_sent": round(sum(r["share_sent"] for r in rows) / n, 3),
+        "queries": rows,
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Trim prepared PDFs to the pages relevant to the issue")
+    ap.add_argument("--context", help="issue_context.json after fetch_and_prepare_pdf.py")
+    ap.add_argument("--mode", choices=MODES, default=None, help="default: RETRIEVAL env (off)")
+    ap.add_argument("--eval", dest="qrels", help="labelled queries JSON; prints recall instead")
+    ap.add_argument("--pdf", action="append", default=[], help="PDF(s) to evaluate against (--eval)")
+    a = ap.parse_args(argv)
+
+    if a.qrels:
+        if not a.pdf:
+            ap.error("--eval needs --pdf")
+        print(json.dumps(evaluate(read_json(a.qrels), a.pdf), indent=2))
+        return
+    if not a.context:
+        ap.error("--context is required")
+    ctx = read_json(a.context)
+    write_json(a.context, retrieve_context(ctx, a.mode))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""
+retry_policy.py
+Retry policy for model calls in run_gemini_sdk.py.
+
+  - classify(err): "rate_limit" | "transient" | "fatal", from the exception
+    type (google.api_core exceptions, connection/timeout errors), its HTTP
+    status (err.code / err.response.status_code / a leading "503 ..." in the
+    message), and only then from message hints.
+  - Backoff: decorrelated jitter (sleep = min(cap, uniform(base, 3 * prev))),
+    overridden by the server's Retry-After header, RetryInfo detail or
+    "retry in Ns" hint when one is given.
+  - CircuitBreaker (one per region): after GEMINI_BREAKER_FAILURES
+    consecutive retryable failures the circuit opens; calls wait out
+    GEMINI_BREAKER_COOLDOWN_S instead of adding load, then a single probe
+    is let through (half-open) and its outcome closes or re-opens it.
+  - hedged(): when a second region is configured, a duplicate request is
+    started there once the primary has been running longer than the
+    GEMINI_HEDGE_PERCENTILE latency of earlier successful calls (or at once
+    when the primary circuit is open); the first success wins. A losing
+    request that has not started is cancelled; one already sent cannot be,
+    so it finishes in the background and its result goes to on_loser (the
+    runner records its usage: it is billed all the same). drain_losers()
+    waits for those before a run is accounted.
+
+Environment:
+  GEMINI_RETRY_BASE_S        first backoff step (default 1)
+  GEMINI_RETRY_CAP_S         longest single backoff (default 60)
+  GEMINI_RETRY_DEADLINE_S    give up retrying a call after this long (default 900)
+  GEMINI_BREAKER_FAILURES    consecutive failures that open a circuit (default 5)
+  GEMINI_BREAKER_COOLDOWN_S  seconds a circuit stays open (default 30)
+  GEMINI_HEDGE_PERCENTILE    latency percentile that triggers a hedge (default 95)
+  GEMINI_HEDGE_AFTER_S       hedge delay until 5 latencies are known (default 30)
+  GEMINI_HEDGE_MIN_S         lower bound on the hedge delay (default 5)
+  GEMINI_HEDGE_DRAIN_S       longest drain_losers() wait at the end of a run (default 60)
+"""
+
+from __future__ import annotations
+
+import email.utils
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional
+
+__all__ = [
+    "RETRY_STATUS",
+    "classify",
+    "retry_after",
+    "Backoff",
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "breaker",
+    "call",
+    "hedge_delay",
+    "hedged",
+    "drain_losers",
+    "metrics",
+    "reset_metrics",
+]
+
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+# google.api_core.exceptions class names (matched by name, so the module
+# works without google-api-core installed)
+RATE_LIMIT_TYPES = {"TooManyRequests", "ResourceExhausted"}
+TRANSIENT_TYPES = {
+    "ServiceUnavailable", "InternalServerError", "BadGateway", "GatewayTimeout",
+    "DeadlineExceeded", "Aborted", "RequestTimeout",
+    "ConnectionError", "ConnectionResetError", "ChunkedEncodingError", "ReadTimeout", "TimeoutError",
+}
+FATAL_TYPES = {
+    "InvalidArgument", "BadRequest", "PermissionDenied", "Forbidden", "Unauthenticated",
+    "Unauthorized", "NotFound", "FailedPrecondition", "ValueError", "TypeError",
+}
+
+# last resort for errors that carry neither a known type nor a status
+TRANSIENT_HINTS = (
+    "deadline exceeded",
+    "busy",
+    "temporar",   # temporary / temporarily
+    "unavailable",
+    "connection reset",
+    "rate limit",
+)
+
+_STATUS_RE = re.compile(r"^\s*(\d{3})\b")
+_HINT_RE = re.compile(r"retry (?:in|after) (\d+(?:\.\d+)?)\s*s", re.I)
+
+_LOCK = threading.Lock()
+_METRICS = {"retries": 0, "slept_s": 0.0, "circuit_opens": 0, "circuit_waits": 0, "hedges": 0, "hedge_wins": 0}
+LATENCY_WINDOW = 500  # successful-call latencies kept for hedge_delay()
+_LATENCIES: deque = deque(maxlen=LATENCY_WINDOW)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _count(name: str, n=1) -> None:
+    with _LOCK:
+        _METRICS[name] += n
+
+
+def _status(err: BaseException) -> Optional[int]:
+    code = getattr(err, "code", None)
+    if isinstance(code, int) and 100 <= code <= 599:
+        return code
+    status = getattr(getattr(err, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status
+    m = _STATUS_RE.match(str(err))
+    return int(m.group(1)) if m else None
+
+
+def classify(err: BaseException) -> str:
+    """"rate_limit", "transient" (both retried) or "fatal"."""
+    names = {c.__name__ for c in type(err).__mro__}
+    if names & RATE_LIMIT_TYPES:
+        return "rate_limit"
+    if names & TRANSIENT_TYPES:
+        return "transient"
+    status = _status(err)
+    if status == 429:
+        return "rate_limit"
+    if status in RETRY_STATUS:
+        return "transient"
+    if names & FATAL_TYPES or (status is not None and 400 <= status < 500):
+        return "fatal"
+    msg = str(err).lower()
+    if "rate limit" in msg or "resource exhausted" in msg:
+        return "rate_limit"
+    return "transient" if any(h in msg for h in TRANSIENT_HINTS) else "fatal"
+
+
+def retry_after(err: BaseException) -> Optional[float]:
+    """Server-requested delay in seconds, if the error carries one."""
+    headers = getattr(getattr(err, "response", None), "headers", None) or {}
+    value = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    for detail in getattr(err, "details", None) or []:  # google.rpc.RetryInfo
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return getattr(delay, "seconds", 0) + getattr(delay, "nanos", 0) / 1e9
+    m = _HINT_RE.search(str(err))
+    return float(m.group(1)) if m else None
+
+
+class Backoff:
+    """Decorrelated-jitter delays for one call; Retry-After takes precedence."""
+
+    def __init__(self, base: Optional[float] = None, cap: Optional[float] = None):
+        self.base = base if base is not None else _env_float("GEMINI_RETRY_BASE_S", 1.0)
+        self.cap = cap if cap is not None else _env_float("GEMINI_RETRY_CAP_S", 60.0)
+        self.prev = self.base
+
+    def next_delay(self, err: Optional[BaseException] = None) -> float:
+        hinted = retry_after(err) if err is not None else None
+        if hinted is not None:
+            return min(hinted, self.cap)
+        self.prev = min(self.cap, random.uniform(self.base, self.prev * 3))
+        return self.prev
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half-open probe -> closed."""
+
+    def __init__(self, name: str, failures: Optional[int] = None, cooldown_s: Optional[float] = None):
+        self.name = name
+        self.threshold = failures or int(_env_float("GEMINI_BREAKER_FAILURES", 5))
+        self.cooldown_s = cooldown_s if cooldown_s is not None else _env_float("GEMINI_BREAKER_COOLDOWN_S", 30.0)
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown_s
+
+    def before_call(self) -> float:
+        """0 when the call may proceed, else seconds to wait before asking again."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            left = self.cooldown_s - (time.monotonic() - self.opened_at)
+            if left > 0:
+                return left
+            if self.probing:
+                return 1.0
+            self.probing = True  # half-open: this caller is the probe
+            return 0.0
+
+    def record(self, ok: Optional[bool]) -> None:
+        """ok=None (e.g. a rejected request) only ends a half-open probe."""
+        with self._lock:
+            self.probing = False
+            if ok is None:
+                return
+            if ok:
+                self.failures, self.opened_at = 0, None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None or time.monotonic() - self.opened_at >= self.cooldown_s:
+                    print(f"WARN: circuit '{self.name}' open after {self.failures} failures; "
+                          f"pausing calls for {self.cooldown_s:.0f}s", file=sys.stderr)
+                    _count("circuit_opens")
+                self.opened_at = time.monotonic()
+
+
+_BREAKERS: dict = {}
+
+
+def breaker(name: str) -> CircuitBreaker:
+    """Shared breaker per region/endpoint name."""
+    with _LOCK:
+        if name not in _BREAKERS:
+            _BREAKERS[name] = CircuitBreaker(name)
+        return _BREAKERS[name]
+
+
+def call(fn: Callable, attempts: int, circuit: Optional[CircuitBreaker] = None, label: str = "Gemini call",
+         deadline_s: Optional[float] = None, stats: Optional[dict] = None):
+    """
+    fn() with retries: retryable errors back off (Backoff) and count toward
+    the circuit; fatal errors, the last attempt, or the deadline re-raise.
+    Waiting on an open circuit does not use up an attempt. stats, if given,
+    gets "attempts" incremented per try.
+    """
+    deadline = time.monotonic() + (deadline_s if deadline_s is not None else _env_float("GEMINI_RETRY_DEADLINE_S", 900.0))
+    backoff = Backoff()
+    attempt = 0
+    while True:
+        if circuit is not None:
+            wait_s = circuit.before_call()
+            if wait_s > 0:
+                if time.monotonic() + wait_s > deadline:
+                    raise CircuitOpenError(f"circuit '{circuit.name}' is open")
+                _count("circuit_waits")
+                time.sleep(wait_s)
+                continue
+        t0 = time.monotonic()
+        if stats is not None:
+            stats["attempts"] = stats.get("attempts", 0) + 1
+        try:
+            result = fn()
+        except Exception as e:
+            attempt += 1
+            kind = classify(e)
+            if circuit is not None:
+                circuit.record(None if kind == "fatal" else False)  # a rejected request says nothing about the service
+            delay = backoff.next_delay(e)
+            if kind == "fatal" or attempt >= attempts or time.monotonic() + delay > deadline:
+                raise
+            print(f"WARN: {label}: {kind} error ({attempt}/{attempts}): {e}; retrying in {delay:.1f}s", file=sys.stderr)
+            _count("retries")
+            _count("slept_s", delay)
+            time.sleep(delay)
+            continue
+        if circuit is not None:
+            circuit.record(True)
+        with _LOCK:
+            _LATENCIES.append(time.monotonic() - t0)
+        return result
+
+
+def hedge_delay() -> float:
+    """Seconds after which a hedge is sent: latency percentile of the last LATENCY_WINDOW successful calls."""
+    with _LOCK:
+        lat = sorted(_LATENCIES)
+    floor = _env_float("GEMINI_HEDGE_MIN_S", 5.0)
+    if len(lat) < 5:
+        return max(floor, _env_float("GEMINI_HEDGE_AFTER_S", 30.0))
+    pct = min(100.0, max(0.0, _env_float("GEMINI_HEDGE_PERCENTILE", 95.0)))
+    return max(floor, lat[min(len(lat) - 1, int(len(lat) * pct / 100))])
+
+
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+_LOSERS: set = set()  # losing requests still running
+
+
+def _watch_loser(fut, on_loser: Optional[Callable]) -> None:
+    """Cancel the losing request if it has not started, else hand its result to on_loser."""
+    if fut.cancel():
+        return
+    with _LOCK:
+        _LOSERS.add(fut)
+
+    def done(f):
+        with _LOCK:
+            _LOSERS.discard(f)
+        if on_loser is not None and not f.cancelled() and f.exception() is None:
+            try:
+                on_loser(f.result())
+            except Exception as e:
+                print(f"WARN: recording the losing hedged request failed: {e}", file=sys.stderr)
+
+    fut.add_done_callback(done)
+
+
+def hedged(primary: Callable, secondary: Callable, primary_circuit: Optional[CircuitBreaker] = None,
+           on_loser: Optional[Callable] = None):
+    """
+    Run primary(); if it has not finished after hedge_delay() (or its circuit
+    is open), also run secondary() and return the first success. Raises the
+    primary's error when both fail. on_loser(result) is called when the other
+    request, once hedged, also succeeds.
+    """
+    if primary_circuit is not None and primary_circuit.is_open:
+        _count("hedges")
+        result = secondary()
+        _count("hedge_wins")
+        return result
+    first = _HEDGE_POOL.submit(primary)
+    done, _ = wait([first], timeout=hedge_delay())
+    if done and first.exception() is None:
+        return first.result()
+    _count("hedges")
+    second = _HEDGE_POOL.submit(secondary)
+    print(f"WARN: primary request {'failed' if done else 'slow'}; hedging to the second region", file=sys.stderr)
+    pending = {first, second}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            if fut.exception() is None:
+                if fut is second:
+                    _count("hedge_wins")
+                _watch_loser(first if fut is second else second, on_loser)
+                return fut.result()
+    raise first.exception()
+
+
+def drain_losers(timeout: Optional[float] = None) -> int:
+    """Wait up to timeout (GEMINI_HEDGE_DRAIN_S) for losing hedged requests; returns how many still run."""
+    with _LOCK:
+        running = list(_LOSERS)
+    if running:
+        wait(running, timeout=timeout if timeout is not None else _env_float("GEMINI_HEDGE_DRAIN_S", 60.0))
+    with _LOCK:
+        return len(_LOSERS)
+
+
+def metrics() -> dict:
+    with _LOCK:
+        out = dict(_METRICS)
+    out["slept_s"] = round(out["slept_s"], 1)
+    out["open_circuits"] = [b.name for b in list(_BREAKERS.values()) if b.is_open]
+    return out
+
+
+def reset_metrics() -> None:
+    """Zero the counters between jobs of a long-lived process (worker.py).
+
+    Circuit state and the latency history used for hedging are kept: they
+    describe the regions, not the job.
+    """
+    with _LOCK:
+        for k in _METRICS:
+            _METRICS[k] = 0
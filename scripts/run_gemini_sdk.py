@@ -1,14 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Run Gemini on PDFs in GCS via the stable Vertex AI SDK (enterprise-grade).
+Run Gemini on PDFs in GCS via the stable Vertex AI SDK (enterprise-grade),
+or offline against the fake backend.
 
 Why this version?
 - Fixes "Multiple content parts are not supported" by concatenating all text parts.
 - Adds debug & raw response dumping for reliable troubleshooting.
 - Keeps Workload Identity (no API key) and gs:// ingestion.
 - Continuation pass if output looks truncated or misses planned sections.
-- Safety settings (SDK-version tolerant) + bounded retries with expo backoff.
+- Safety settings (SDK-version tolerant) + bounded retries (retry_policy.py).
 - Optional "Figures" appendix if images exist but weren't embedded.
 
 Inputs (unchanged):
@@ -20,14 +21,124 @@ Inputs (unchanged):
   --out          Path to write Markdown output (e.g., summary.txt)
 
 Optional:
-  --max_output_tokens  default 8192
+  --max_output_tokens  default: planned (see Token budget); 8192 with --no-budget
   --temperature        default 0.2
   --top_p              default 0.95
   --top_k              default 40
-  --retries            default 3
-  --continuations      default 1 (extra pass if truncated)
+  --retries            default 3 (attempts per call)
+  --hedge-location     second region: a slow blocking request is duplicated
+                       there (GEMINI_HEDGE_LOCATION)
+  --continuations      default: planned; 1 with --no-budget (extra pass if truncated)
+  --no-budget          skip the token-budget planner (GEMINI_BUDGET=0)
   --dump-response      path to write raw response JSON (for 1st main call)
   --debug              enable verbose diagnostics to stderr
+  --mode               auto | single | map-reduce (default auto: map-reduce
+                       when policy.chunked and there are several PDF parts)
+  --map-concurrency    parallel per-part map requests (default 4)
+  --by-section         generate each required section in its own request
+  --section-concurrency  parallel section requests (default 4)
+  --stream             stream the report, writing --out as chunks arrive
+  --stall-seconds      streaming: seconds without a chunk before the pass is
+                       treated as stalled (default 90)
+  --stats-out          write per-pass timing/usage stats JSON here
+  --settings           settings JSON from build_prompt.py; its
+                       systemInstruction is sent as the system instruction
+  --no-cache           bypass the response cache for this run
+  --context-cache      register PDFs + prompt + system instruction once as
+                       cached context (GEMINI_CONTEXT_CACHE=1)
+  --context-ttl        cached context lifetime in seconds (default 3600)
+  --backend            vertex | fake (GEMINI_BACKEND; default vertex)
+  --ledger             usage ledger JSON (GEMINI_LEDGER; default
+                       <artifact_dir>/gemini_ledger.json)
+
+Backends (model_backend.py):
+  All model access (models, PDF parts, generation config, safety settings,
+  cached context) goes through a backend. "fake" runs fully offline with
+  simulated latency, throughput, MAX_TOKENS truncation and transient errors
+  (FAKE_GEMINI_* variables, see model_backend.py), for load-testing the
+  retry, continuation and concurrency paths, e.g.:
+    FAKE_GEMINI_MAX_TOKENS=600 FAKE_GEMINI_ERROR_RATE=0.2 \
+      python run_gemini_sdk.py --backend fake --project x --location x ...
+
+Retries (retry_policy.py):
+  Errors are classified by exception type / HTTP status (rate_limit,
+  transient, fatal); retryable ones back off with decorrelated jitter or the
+  server's Retry-After. Consecutive failures open a per-region circuit so
+  concurrent map/section calls pause instead of piling onto a 503 storm.
+  With --hedge-location, a blocking request still running after the p95 of
+  earlier call latencies (or whose region's circuit is open) is duplicated
+  in the second region and the first success is used. The losing request
+  is billed as well and is recorded in the ledger as "hedge-loser:<pass>"
+  (the run waits up to GEMINI_HEDGE_DRAIN_S for it before saving).
+
+Token budget (token_budget.py):
+  Before the first call the request's input tokens are counted (backend
+  count_tokens, else a local estimate from text length and PDF page counts)
+  and the output needed per required section is estimated (output/input
+  ratio calibrated from earlier runs in the usage ledgers). The planner then
+  sizes max_output_tokens (never below 8192, plus a thinking allowance on
+  gemini-2.5) and the continuation count, and switches to
+  section-parallel generation when the report exceeds the model's output cap
+  (map-reduce when the input exceeds the context window). Explicit CLI values
+  win. The plan plus the estimate-vs-actual output error go to stderr,
+  --stats-out and ctx["gemini_budget"] (-> run_meta.json).
+
+Ledger and budgets (usage_ledger.py):
+  Every call (cache hits included) is recorded with its pass, input/output/
+  cached tokens, latency, finish_reason, model version, attempts and an
+  estimated cost; the run's record is appended to --ledger, which keeps the
+  issue's earlier runs too. With GEMINI_RUN_MAX_TOKENS / _USD or
+  GEMINI_ISSUE_MAX_TOKENS / _USD set, the run degrades at
+  GEMINI_BUDGET_DEGRADE_AT (default 80%) of a budget (no further
+  continuations or hedges) and refuses further calls once it is used up,
+  writing what it has; the run is then marked "aborted" in the ledger.
+
+Cached context (--context-cache; model_backend.py):
+  The PDFs, the prompt and the system instruction are registered once as
+  Vertex cached content; the first pass, section requests and continuations
+  then send only their new text (CONTEXT_REQUEST, section notes,
+  the PRIOR_OUTPUT window) instead of re-attaching every PDF. Not used in map-reduce
+  mode (each part is sent once anyway). Falls back to plain requests if the
+  context cannot be created; it is deleted when the run ends.
+
+Continuations (continuation.py):
+  A continuation pass sends an outline of the headings written so far plus
+  only the last GEMINI_CONT_WINDOW_CHARS (default 6000) characters of the
+  output, not the whole report. The reply is spliced in at the longest
+  suffix/prefix overlap (rolling hash), so text the model repeats from the
+  window is dropped.
+
+Response cache (response_cache.py):
+  Every model call (first pass, map, section, continuation; streamed or not)
+  is looked up by model id, GenerationConfig, system instruction, the SHA-256
+  of each text part and the content hash of each PDF behind gs:// parts
+  (ctx["gcs_hashes"] from upload_to_gcs.py, else the local final_pdf_paths).
+  max_output_tokens is part of the key only when given on the command line;
+  the planned value drifts as the ledgers grow and would defeat reruns.
+  Calls whose PDF hashes are unknown are not cached. GEMINI_CACHE=0 or
+  --no-cache bypasses it; hit/miss metrics go to stderr and --stats-out.
+
+Map-reduce (chunked PDFs):
+  Each PDF part is sent in its own request that extracts requirement notes
+  for that part only (the "map"); the requests run concurrently. One text-only
+  "reduce" request then merges the notes into the final report, and the
+  continuation loop works on that reduce request. Map results land in the
+  response cache (below), so a rerun only repeats failed parts.
+
+Section-parallel (--by-section or GEMINI_BY_SECTION=1):
+  Each required section (see _load_required_sections) is generated by its own
+  request, concurrently, on top of the same PDFs (or map-reduce notes). A
+  deterministic assembler normalises each section's heading and joins them in
+  the planned order. Sections that end mid-sentence are continued
+  individually, so the whole-report continuation loop is skipped.
+
+Streaming (--stream or GEMINI_STREAM=1; single-report passes only):
+  Chunks are consumed as they arrive and --out is rewritten atomically (temp
+  file + rename, at most once per second) so it always holds a consistent
+  prefix of the report. Headings are tracked as they appear. A pass that ends
+  with finish_reason MAX_TOKENS, errors mid-stream, or receives nothing for
+  --stall-seconds is continued immediately. Time-to-first-byte and output
+  tokens per second are recorded per pass (stderr and --stats-out).
 
 Environment / dynamic sections:
   CUSTOM_REQUIRED_SECTIONS="A,B,C"
@@ -38,42 +149,31 @@ Exit behavior:
 """
 
 import argparse
+import hashlib
 import json
 import os
+import queue
+import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Optional, Any
 
-# Vertex AI SDK (stable)
-from google.cloud import aiplatform
-from vertexai import init as vertexai_init
-from vertexai.generative_models import (
-    GenerativeModel,
-    Part,
-    GenerationConfig,
-    SafetySetting,
-)
-
-from util import mkdirp, read_json as _read_json
+from util import mkdirp, read_json as _read_json, tmp_path, write_json
+import model_backend
+import pdf_cache
+import continuation
+import response_cache
+import retry_policy
+import token_budget
+import usage_ledger
 
 # ---------------------------
 # Config / Utilities
 # ---------------------------
 
-TRANSIENT_HINTS = (
-    "deadline exceeded",
-    "503",
-    "500",
-    "busy",
-    "temporar",   # temporary / temporarily
-    "unavailable",
-    "retry",
-    "backoff",
-    "connection reset",
-    "rate limit",
-)
-
 DEFAULT_REQUIRED = (
     "Executive Summary",
     "Functional Requirements",
@@ -97,10 +197,6 @@ def read_text(path: str) -> str:
 def load_json(path: str) -> dict:
     return _read_json(path)
 
-def is_transient(err: Exception) -> bool:
-    msg = str(err).lower()
-    return any(h in msg for h in TRANSIENT_HINTS)
-
 def _safe_get(dct: Any, path: List[str], default=None):
     """Safely crawl nested dict/list by keys/indexes."""
     cur = dct
@@ -154,43 +250,30 @@ def _extract_all_text_from_response(resp_obj: Any) -> str:
         return ""
 
 
-def build_parts(gcs_uris: List[str], prompt_text: str) -> List:
+def build_parts(gcs_uris: List[str], prompt_text: str, backend) -> List:
     """Each PDF (gs://) + the prompt text (as the final part)."""
     parts: List = []
     for uri in gcs_uris:
         if uri.startswith("gs://"):
-            parts.append(Part.from_uri(uri, mime_type="application/pdf"))
+            parts.append(backend.pdf_part(uri))
     # The SDK accepts raw strings as a text part.
     parts.append(prompt_text)
     return parts
 
-# ---------------------------
-# Safety (version tolerant)
-# ---------------------------
-
-def _build_safety_settings():
-    try:
-        HC = SafetySetting.HarmCategory
-        HBT = SafetySetting.HarmBlockThreshold
-        return [
-            SafetySetting(category=HC.HARASSMENT, threshold=HBT.BLOCK_NONE),
-            SafetySetting(category=HC.HATE_SPEECH, threshold=HBT.BLOCK_NONE),
-            SafetySetting(category=HC.SEXUAL, threshold=HBT.BLOCK_MEDIUM_AND_ABOVE),
-            SafetySetting(category=HC.DANGEROUS, threshold=HBT.BLOCK_NONE),
-        ]
-    except Exception:
-        return None
-
 # ---------------------------
 # Dynamic sections + continuation
 # ---------------------------
 
+PLANNED_SECTIONS: List[str] = []  # ctx["required_sections"] of the current run (agent.py)
+
 def _load_required_sections() -> List[str]:
     env_val = os.environ.get("CUSTOM_REQUIRED_SECTIONS")
     if env_val:
         got = [s.strip() for s in env_val.split(",") if s.strip()]
         if got:
             return got
+    if PLANNED_SECTIONS:
+        return list(PLANNED_SECTIONS)
     p = Path("required_sections.json")
     if p.exists():
         try:
@@ -202,14 +285,17 @@ def _load_required_sections() -> List[str]:
             pass
     return list(DEFAULT_REQUIRED)
 
+def _tail_truncated(t: str) -> bool:
+    tail = t[-200:]
+    # mid-sentence cutoff / incomplete trailing line
+    return bool(tail) and not tail.endswith((".", "!", "?", "```")) and "\n## " not in tail
+
 def looks_truncated(text: str) -> bool:
     req = [s.lower() for s in _load_required_sections()]
     if not text:
         return True
     t = text.strip()
-    tail = t[-200:]
-    # mid-sentence cutoff / incomplete trailing line
-    if tail and not tail.endswith((".", "!", "?", "```")) and "\n## " not in tail:
+    if _tail_truncated(t):
         return True
     lowered = t.lower()
     for sec in req:
@@ -227,79 +313,506 @@ def build_continuation_prompt() -> str:
         "Do not restate earlier sections. Continue directly."
     )
 
+# ---------------------------
+# Response cache
+# ---------------------------
+
+def load_pdf_hashes(ctx: dict) -> dict:
+    """Content hash per gs:// URI: from the upload stage, else from the local parts."""
+    hashes = dict(ctx.get("gcs_hashes") or {})
+    uris, paths = ctx.get("gcs_uris") or [], ctx.get("final_pdf_paths") or []
+    if len(uris) == len(paths):
+        for uri, path in zip(uris, paths):
+            if uri not in hashes and os.path.isfile(path):
+                hashes[uri] = "sha256:" + pdf_cache.sha256_file(path)
+    return hashes
+
+def _part_fingerprint(part: Any, pdf_hashes: dict) -> Optional[str]:
+    if isinstance(part, str):
+        return "text:" + hashlib.sha256(part.encode("utf-8")).hexdigest()
+    try:
+        uri = part.to_dict()["file_data"]["file_uri"]  # type: ignore[attr-defined]
+    except Exception:
+        return None
+    h = pdf_hashes.get(uri)
+    return f"pdf:{h}" if h else None
+
+def cached_response(args, parts: List) -> tuple:
+    """Return (key, record) for a request; key is None when it cannot be cached."""
+    if args.no_cache or response_cache.cache_root() is None:
+        return None, None
+    prints = list(getattr(args, "context_prints", [])) + [_part_fingerprint(p, args.pdf_hashes) for p in parts]
+    key = None
+    if all(prints):
+        key = response_cache.make_key(args.model, args.cache_cfg, args.system_instruction, prints)
+    return key, response_cache.get(key)
+
+# ---------------------------
+# Ledger / budgets
+# ---------------------------
+
+def budget_refuses(args, label: str) -> bool:
+    """True (and an error logged) once the run or issue budget is exhausted."""
+    if args.ledger.state() == "exceeded":
+        print(f"ERROR: token/cost budget exhausted; skipping {label}", file=sys.stderr)
+        return True
+    return False
+
+def continuation_allowed(args) -> bool:
+    """Continuation passes stop as soon as a budget is nearly used up."""
+    return args.ledger.state() == "ok"
+
 # ---------------------------
 # Retry wrapper
 # ---------------------------
 
+def _response_meta(resp) -> tuple:
+    """(usage_metadata, model_version, finish_reason) of a response; empty when unavailable."""
+    try:
+        as_dict = resp.to_dict()  # type: ignore[attr-defined]
+    except Exception:
+        return {}, None, None
+    return (as_dict.get("usage_metadata") or {}, as_dict.get("model_version"),
+            _safe_get(as_dict, ["candidates", 0, "finish_reason"]))
+
 def call_model_with_retries(
     args,
-    model: GenerativeModel,
+    model,
     parts: List,
-    gen_cfg: GenerationConfig,
+    gen_cfg,
     safety,  # may be None
     max_attempts: int = 3,
     dump_path: Optional[str] = None,  # only for the first main call
+    label: str = "first",
 ) -> Optional[str]:
     """
-    Bounded retry with exponential backoff. On the 1st attempt of the first
-    main call you can pass dump_path to save the raw JSON for troubleshooting.
+    One model call under retry_policy (error classification, jittered backoff,
+    Retry-After, per-region circuit breaker; hedged to --hedge-location when
+    configured). Pass dump_path on the first main call to save the raw JSON
+    for troubleshooting. Served from the response cache when an identical
+    request was answered before. Every call is recorded in the ledger under
+    label; nothing is sent once the budget is exhausted.
     """
-    attempt = 0
-    while attempt < max_attempts:
-        try:
+    key, hit = cached_response(args, parts)
+    if hit is not None:
+        log_debug(args, f"response cache hit ({key[:12]})")
+        args.ledger.record(label, hit.get("usage"), finish_reason=hit.get("finish_reason"),
+                           model_version=hit.get("model_version"), attempts=0, cache_hit=True)
+        return hit["text"]
+    if budget_refuses(args, label):
+        return None
+
+    runs: List[dict] = []  # per-region stats; a hedged call has two
+
+    def run(m, region: str):
+        stats = {"region": region}
+        runs.append(stats)
+
+        def once():
             if debug_enabled(args):
-                print("[DEBUG] generating content...", file=sys.stderr)
+                print(f"[DEBUG] generating content in {region}...", file=sys.stderr)
                 print(f"[DEBUG] parts: {len(parts)} (pdfs+prompt)", file=sys.stderr)
                 # Note: do not print the full prompt to avoid log bloat
+            return m.generate_content(parts, generation_config=gen_cfg, safety_settings=safety)
+        t_run = time.perf_counter()
+        resp = retry_policy.call(once, max_attempts, retry_policy.breaker(region), stats=stats)
+        return resp, stats, time.perf_counter() - t_run
 
-            resp = model.generate_content(
-                parts,
-                generation_config=gen_cfg,
-                safety_settings=safety,
+    def record_loser(result):
+        # the duplicate is billed even though its answer is discarded
+        resp, stats, latency = result
+        usage, model_version, finish_reason = _response_meta(resp)
+        args.ledger.record(f"hedge-loser:{label}", usage, latency, finish_reason, model_version,
+                           attempts=stats.get("attempts", 1), served=False, region=stats["region"])
+
+    t0 = time.perf_counter()
+    try:
+        hedge_model = getattr(args, "hedge_model", None)
+        # cached context lives in one region, so only plain requests are hedged;
+        # a duplicate request is not worth it once the budget runs low
+        if hedge_model is not None and model is args.default_model and args.ledger.state() == "ok":
+            resp, tries, _ = retry_policy.hedged(
+                lambda: run(model, args.location),
+                lambda: run(hedge_model, args.hedge_location),
+                retry_policy.breaker(args.location),
+                on_loser=record_loser,
             )
+        else:
+            resp, tries, _ = run(model, args.location)
+    except Exception as e:
+        print(f"ERROR: Gemini call failed ({retry_policy.classify(e)}): {e}", file=sys.stderr)
+        args.ledger.record(label, latency_s=time.perf_counter() - t0, finish_reason="FAILED",
+                           attempts=sum(r.get("attempts", 0) for r in runs), error=str(e)[:300])
+        return None
+    latency = time.perf_counter() - t0
+
+    # Dump raw response if requested (best-effort)
+    if dump_path:
+        try:
+            as_dict = resp.to_dict()  # type: ignore[attr-defined]
+            Path(dump_path).parent.mkdir(parents=True, exist_ok=True)
+            Path(dump_path).write_text(json.dumps(as_dict, indent=2), encoding="utf-8")
+            print(f"[DEBUG] raw response dumped to: {dump_path}", file=sys.stderr)
+        except Exception as e_dump:
+            print(f"[DEBUG] raw dump failed: {e_dump}", file=sys.stderr)
+
+    text = _extract_all_text_from_response(resp)
+    # Diagnostics to help you see why truncation might occur
+    usage, model_version, finish_reason = _response_meta(resp)
+    print(
+        json.dumps(
+            {
+                "gemini_usage": usage,
+                "model_version": model_version,
+                "finish_reason": finish_reason,
+            },
+            ensure_ascii=False,
+        ),
+        file=sys.stderr,
+    )
+
+    extra = {"region": tries["region"]} if len(runs) > 1 else {}
+    args.ledger.record(label, usage, latency, finish_reason, model_version, attempts=tries.get("attempts", 1), **extra)
+    response_cache.put(key, text, finish_reason, usage, model_version)
+    return text or ""
+
+# ---------------------------
+# Map-reduce across PDF parts
+# ---------------------------
+
+def _part_label(i: int, n: int, part_info: dict) -> str:
+    label = f"Part {i + 1} of {n}"
+    spans = ""
+    if part_info.get("pages"):  # non-contiguous: trimmed by retrieval.py
+        spans = ", ".join(f"{a}-{b}" if a != b else str(a) for a, b in part_info["pages"])
+    elif part_info.get("first_page"):
+        spans = f"{part_info['first_page']}-{part_info['last_page']}"
+    if spans:
+        label += f" (pages {spans}"
+        if part_info.get("source"):
+            label += f" of {part_info['source']}"
+        label += ")"
+    return label
+
+def build_map_prompt(prompt_text: str, label: str) -> str:
+    return (
+        prompt_text
+        + "\n\nMAP STEP - " + label + ":\n"
+        "The attached PDF is only one part of the source document. Do NOT write the final report. "
+        "Extract, as concise Markdown notes, every requirement, rule, control, data element and "
+        "fact from THIS part that the report above would need, grouped under the required section "
+        "names. Keep identifiers, figures and page references exactly as written. "
+        "If the part contains nothing relevant, reply with 'NO RELEVANT CONTENT'."
+    )
+
+def build_reduce_prompt(prompt_text: str, extracts: List[tuple]) -> str:
+    blocks = []
+    for label, notes in extracts:
+        body = notes if notes is not None else "(extraction failed for this part; not covered)"
+        blocks.append(f"### {label}\n{body.strip()}")
+    return (
+        prompt_text
+        + "\n\nREDUCE STEP:\nThe source PDF was processed in parts; the notes extracted from each part "
+        "follow. Merge them into the single final report requested above: deduplicate, resolve "
+        "overlaps between parts and keep every required section. Use only these notes.\n\n"
+        "PART_EXTRACTS:\n\n" + "\n\n".join(blocks)
+    )
+
+def run_map_phase(args, model, gcs_uris: List[str], prompt_text: str, gen_cfg, safety, manifest: List[dict]) -> List:
+    """
+    Map each PDF part concurrently (answered parts come from the response
+    cache on reruns). Returns the (text-only) reduce request parts, which the
+    caller generates from like any other first pass.
+    """
+    uris = [u for u in gcs_uris if u.startswith("gs://")]
+    n = len(uris)
+    infos = manifest if len(manifest) == n else [{} for _ in uris]
+    labels = [_part_label(i, n, infos[i]) for i in range(n)]
+
+    def map_one(i: int) -> Optional[str]:
+        map_prompt = build_map_prompt(prompt_text, labels[i])
+        t0 = time.perf_counter()
+        notes = call_model_with_retries(
+            args=args,
+            model=model,
+            parts=[args.backend.pdf_part(uris[i]), map_prompt],
+            gen_cfg=gen_cfg,
+            safety=safety,
+            max_attempts=max(1, args.retries),
+            label=f"map:{labels[i]}",
+        )
+        print(f"map {labels[i]}: {'ok' if notes else 'FAILED'} in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+        return notes or None
+
+    with ThreadPoolExecutor(max_workers=max(1, args.map_concurrency)) as pool:
+        results = list(pool.map(map_one, range(n)))
+
+    failed = [labels[i] for i, r in enumerate(results) if r is None]
+    if failed:
+        print(f"ERROR: map step failed for {len(failed)}/{n} part(s): {', '.join(failed)}; "
+              "rerun to retry only those parts", file=sys.stderr)
+
+    return [build_reduce_prompt(prompt_text, list(zip(labels, results)))]
+
+# ---------------------------
+# Section-parallel generation
+# ---------------------------
+
+def build_section_prompt(section: str, sections: List[str]) -> str:
+    return (
+        "\n\nSECTION REQUEST:\n"
+        f"Write ONLY the section '## {section}' of the report described above "
+        f"(the full report has these sections, in order: {'; '.join(sections)}; "
+        "the others are written separately). Start with the heading line "
+        f"'## {section}', use ### or lower for sub-headings, and do not add a title, "
+        "preamble or any other top-level section."
+    )
+
+def _section_parts(base_parts: List, note: str) -> List:
+    """Same request as base_parts with note appended to its final text part."""
+    return list(base_parts[:-1]) + [str(base_parts[-1]) + note]
+
+def normalize_section(section: str, text: str) -> str:
+    """Deterministic clean-up: unwrap fences, drop any leading heading/title,
+    demote stray top-level headings and re-emit one '## <section>' heading."""
+    body = (text or "").strip()
+    if body.startswith("```") and body.endswith("```"):
+        body = body.split("\n", 1)[-1].rsplit("```", 1)[0].strip()
+    lines = body.splitlines()
+    while lines and (not lines[0].strip() or lines[0].lstrip().startswith("#")):
+        lines.pop(0)
+    lines = [re.sub(r"^#{1,2}(?=\s)", "###", ln) for ln in lines]
+    body = "\n".join(lines).strip()
+    return f"## {section}\n\n{body}" if body else f"## {section}\n\n_Not generated._"
+
+def assemble_sections(sections: List[str], texts: List[Optional[str]]) -> str:
+    """Stitch section outputs together in planned order (independent of completion order)."""
+    return "\n\n".join(normalize_section(sec, txt) for sec, txt in zip(sections, texts)).strip() + "\n"
+
+def generate_sections(args, model, base_parts: List, gen_cfg, safety) -> str:
+    """
+    Generate every required section in its own concurrent request and
+    assemble them in order. A section that ends mid-sentence gets up to
+    --continuations follow-ups of its own.
+    """
+    sections = _load_required_sections()
+
+    def one(sec: str) -> Optional[str]:
+        t0 = time.perf_counter()
+        sec_parts = _section_parts(base_parts, build_section_prompt(sec, sections))
+        text = call_model_with_retries(
+            args=args,
+            model=model,
+            parts=sec_parts,
+            gen_cfg=gen_cfg,
+            safety=safety,
+            max_attempts=max(1, args.retries),
+            label=f"section:{sec}",
+        ) or ""
+        remaining = max(0, int(args.continuations))
+        n = 0
+        # a section is cut off when it stops mid-line (tables may end with "|")
+        while (remaining > 0 and text.strip() and not text.rstrip().endswith((".", "!", "?", "```", "|"))
+               and continuation_allowed(args)):
+            remaining -= 1
+            n += 1
+            more = call_model_with_retries(
+                args=args,
+                model=model,
+                parts=list(sec_parts) + [
+                    continuation.prior_block(text),
+                    f"\n\nCONTINUATION REQUEST:\nContinue the '## {sec}' section from the exact point of "
+                    "truncation. Do not repeat content or start other sections.",
+                ],
+                gen_cfg=gen_cfg,
+                safety=safety,
+                max_attempts=max(1, args.retries),
+                label=f"section:{sec}/continuation-{n}",
+            ) or ""
+            if not more.strip():
+                break
+            text = continuation.splice(text, more)
+        print(f"section '{sec}': {len(text)} chars in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+        return text or None
+
+    with ThreadPoolExecutor(max_workers=max(1, args.section_concurrency)) as pool:
+        texts = list(pool.map(one, sections))
+    missing = [sec for sec, t in zip(sections, texts) if t is None]
+    if missing:
+        print(f"ERROR: no output for section(s): {', '.join(missing)}", file=sys.stderr)
+    return assemble_sections(sections, texts)
+
+# ---------------------------
+# Streaming
+# ---------------------------
+
+HEADING_RE = re.compile(r"^##\s+(.+?)\s*#*\s*$", re.M)
+
+# Per-pass timing/usage records (written to --stats-out)
+PASS_STATS: List[dict] = []
+
+def write_atomic(path: str, text: str) -> None:
+    """Replace path with text without readers ever seeing a partial file."""
+    dest = Path(path)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_path(dest)
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, dest)
+
+def _chunk_meta(chunk: Any) -> dict:
+    try:
+        as_dict = chunk.to_dict()  # type: ignore[attr-defined]
+    except Exception:
+        return {}
+    return {
+        "finish_reason": _safe_get(as_dict, ["candidates", 0, "finish_reason"]),
+        "usage": as_dict.get("usage_metadata") or {},
+        "model_version": as_dict.get("model_version"),
+    }
 
-            # Dump raw response once if requested (best-effort)
-            if dump_path and attempt == 0:
-                try:
-                    as_dict = resp.to_dict()  # type: ignore[attr-defined]
-                    Path(dump_path).parent.mkdir(parents=True, exist_ok=True)
-                    Path(dump_path).write_text(json.dumps(as_dict, indent=2), encoding="utf-8")
-                    print(f"[DEBUG] raw response dumped to: {dump_path}", file=sys.stderr)
-                except Exception as e_dump:
-                    print(f"[DEBUG] raw dump failed: {e_dump}", file=sys.stderr)
-
-            text = _extract_all_text_from_response(resp)
-            # Diagnostics to help you see why truncation might occur
+def stream_pass(args, model, parts: List, gen_cfg, safety, out_path: str, prefix: str = "", label: str = "first") -> tuple:
+    """
+    Stream one generation pass, rewriting out_path (prefix + text so far) as
+    chunks arrive. Returns (text, finish_reason) where finish_reason is the
+    model's value, "STALL" (no chunk for --stall-seconds) or "ERROR" (the
+    stream broke after output started). A failure before the first chunk is
+    retried like call_model_with_retries(). Cached responses are written out
+    at once; stalled or broken passes are never cached.
+    """
+    key, hit = cached_response(args, parts)
+    if hit is not None:
+        write_atomic(out_path, continuation.splice(prefix, hit["text"]))
+        PASS_STATS.append({"pass": label, "cache": "hit", "chars": len(hit["text"]), "finish_reason": hit["finish_reason"]})
+        log_debug(args, f"response cache hit ({key[:12]}) for {label} pass")
+        args.ledger.record(label, hit.get("usage"), finish_reason=hit.get("finish_reason"),
+                           model_version=hit.get("model_version"), attempts=0, cache_hit=True, stream=True)
+        return hit["text"], hit["finish_reason"] or ""
+    if budget_refuses(args, f"{label} pass"):
+        return "", "ERROR"
+    t_start = time.perf_counter()
+    circuit = retry_policy.breaker(args.location)
+    backoff = retry_policy.Backoff()
+    attempt = 0
+    while True:
+        wait_s = circuit.before_call()
+        if wait_s > 0:
+            time.sleep(wait_s)
+            continue
+        chunks: "queue.Queue" = queue.Queue()
+        stop = threading.Event()
+
+        def pump():
             try:
-                as_dict = resp.to_dict()  # type: ignore[attr-defined]
-                usage = as_dict.get("usage_metadata") or {}
-                model_version = as_dict.get("model_version")
-                finish_reason = _safe_get(as_dict, ["candidates", 0, "finish_reason"])
-
-                print(
-                    json.dumps(
-                        {
-                            "gemini_usage": usage,
-                            "model_version": model_version,
-                            "finish_reason": finish_reason,
-                        },
-                        ensure_ascii=False,
-                    ),
-                    file=sys.stderr,
-                )
-            except Exception:
-                pass
+                for chunk in model.generate_content(
+                    parts, generation_config=gen_cfg, safety_settings=safety, stream=True
+                ):
+                    if stop.is_set():
+                        return
+                    chunks.put(("chunk", chunk))
+                chunks.put(("end", None))
+            except Exception as e:  # surfaced to the consumer
+                chunks.put(("error", e))
 
-            return text or ""
-        except Exception as e:
+        t0 = time.perf_counter()
+        threading.Thread(target=pump, daemon=True).start()
+        text, meta, finish, ttfb, error = "", {}, None, None, None
+        seen: List[str] = []
+        last_flush = 0.0
+        while True:
+            try:
+                kind, val = chunks.get(timeout=max(1.0, args.stall_seconds))
+            except queue.Empty:
+                stop.set()
+                finish = "STALL"
+                print(f"WARN: stream stalled after {len(text)} chars ({args.stall_seconds}s without data)", file=sys.stderr)
+                break
+            if kind == "end":
+                break
+            if kind == "error":
+                if not text:
+                    error = val
+                    break
+                finish = "ERROR"
+                print(f"WARN: stream broke after {len(text)} chars: {val}", file=sys.stderr)
+                break
+            piece = _extract_all_text_from_response(val)
+            meta = _chunk_meta(val) or meta
+            if piece:
+                if ttfb is None:
+                    ttfb = time.perf_counter() - t0
+                text += piece
+                for h in HEADING_RE.findall(text):
+                    if h not in seen:
+                        seen.append(h)
+                        log_debug(args, f"stream heading: {h}")
+                if time.perf_counter() - last_flush >= 1.0:
+                    write_atomic(out_path, continuation.splice(prefix, text))
+                    last_flush = time.perf_counter()
+
+        if error is not None:
             attempt += 1
-            if attempt >= max_attempts or not is_transient(e):
-                print(f"ERROR: Gemini call failed ({attempt}/{max_attempts}): {e}", file=sys.stderr)
-                return None
-            sleep_for = 2.0 * (2 ** (attempt - 1))
-            print(f"WARN: transient error ({attempt}/{max_attempts}): {e}", file=sys.stderr)
-            print(f"Retrying in {sleep_for:.1f}s ...", file=sys.stderr)
+            kind = retry_policy.classify(error)
+            circuit.record(None if kind == "fatal" else False)
+            if attempt >= max(1, args.retries) or kind == "fatal":
+                print(f"ERROR: Gemini stream failed ({kind}, {attempt}/{args.retries}): {error}", file=sys.stderr)
+                args.ledger.record(label, latency_s=time.perf_counter() - t_start, finish_reason="FAILED",
+                                   attempts=attempt, stream=True, error=str(error)[:300])
+                return "", "ERROR"
+            sleep_for = backoff.next_delay(error)
+            print(f"WARN: {kind} error ({attempt}/{args.retries}): {error}; retrying in {sleep_for:.1f}s", file=sys.stderr)
             time.sleep(sleep_for)
+            continue
+        circuit.record(finish not in ("STALL", "ERROR"))
+
+        total = time.perf_counter() - t0
+        finish = finish or str(meta.get("finish_reason") or "")
+        write_atomic(out_path, continuation.splice(prefix, text))
+        usage = meta.get("usage") or {}
+        out_tokens = usage.get("candidates_token_count") or max(1, len(text) // 4)
+        gen_s = max(1e-6, total - (ttfb or 0.0))
+        stats = {
+            "pass": label,
+            "ttfb_s": round(ttfb, 3) if ttfb is not None else None,
+            "total_s": round(total, 3),
+            "chars": len(text),
+            "output_tokens": out_tokens,
+            "tokens_per_s": round(out_tokens / gen_s, 1),
+            "finish_reason": finish,
+            "headings": seen,
+            "usage": usage,
+            "model_version": meta.get("model_version"),
+        }
+        PASS_STATS.append(stats)
+        args.ledger.record(label, usage, time.perf_counter() - t_start, finish, meta.get("model_version"),
+                           attempts=attempt + 1, stream=True, ttfb_s=stats["ttfb_s"])
+        print(json.dumps({"gemini_stream": stats}, ensure_ascii=False), file=sys.stderr)
+        if finish not in ("STALL", "ERROR"):
+            response_cache.put(key, text, finish, usage, meta.get("model_version"))
+        return text, finish
+
+def stream_report(args, model, parts: List, gen_cfg, safety, out_path: str) -> str:
+    """
+    Streamed first pass plus continuations. A continuation starts as soon as
+    a pass ends truncated (MAX_TOKENS, stall, broken stream) or the report
+    still looks incomplete, instead of after a full blocking call.
+    """
+    text, finish = stream_pass(args, model, parts, gen_cfg, safety, out_path)
+    remaining = max(0, int(args.continuations))
+    n = 0
+    while (remaining > 0 and (finish in ("MAX_TOKENS", "STALL", "ERROR") or looks_truncated(text))
+           and continuation_allowed(args)):
+        remaining -= 1
+        n += 1
+        print(f"continuation {n}: previous pass ended with {finish or 'incomplete output'}", file=sys.stderr)
+        cont_parts = list(parts) + [
+            continuation.prior_block(text),
+            "\n\n" + build_continuation_prompt(),
+        ]
+        more, finish = stream_pass(args, model, cont_parts, gen_cfg, safety, out_path, prefix=text, label=f"continuation-{n}")
+        if not more.strip():
+            break
+        text = continuation.splice(text, more)
+    return text
 
 # ---------------------------
 # Image appendix
@@ -332,11 +845,137 @@ def append_figures_section_if_needed(md: str, issue_dir: Path) -> str:
     extra = ["\n\n## Figures\n"] + [f"- ![]({rel})" for rel in images]
     return (md or "") + "\n" + "\n".join(extra) + "\n"
 
+# ---------------------------
+# Token budget
+# ---------------------------
+
+def _pdf_pages(ctx: dict, gcs_uris: List[str]) -> List[Optional[int]]:
+    """Page count per gs:// part from ctx["part_manifest"] (None when unknown)."""
+    manifest = ctx.get("part_manifest") or []
+    uris = [u for u in gcs_uris if u.startswith("gs://")]
+    if len(manifest) != len(uris):
+        return [None] * len(uris)
+    return [
+        m.get("page_count") or ((m["last_page"] - m["first_page"] + 1) if m.get("first_page") else None)
+        for m in manifest
+    ]
+
+def plan_budget(args, model, ctx: dict, gcs_uris: List[str], prompt_text: str, n_pdfs: int) -> dict:
+    """
+    Count the request's input tokens and let token_budget pick the output
+    budget, continuation passes and generation mode. Explicit CLI values
+    (--max_output_tokens, --continuations, --mode, --by-section) win.
+    """
+    parts = build_parts(gcs_uris, prompt_text, args.backend)
+    tokens, source = token_budget.count_input_tokens(
+        model, parts, _pdf_pages(ctx, gcs_uris), args.system_instruction
+    )
+    ratio = token_budget.calibrate_ratio(token_budget.ledger_paths(args.ledger.path))
+    decision = token_budget.plan(args.model, tokens, _load_required_sections(), n_pdfs, ratio)
+    decision["input_source"] = source
+    if args.max_output_tokens is None:
+        args.max_output_tokens = decision["max_output_tokens"]
+    if args.continuations is None:
+        args.continuations = decision["continuations"]
+    if args.mode == "auto" and decision["mode"]:
+        args.mode = decision["mode"]
+    if decision["by_section"] and not args.by_section and args.mode != "map-reduce":
+        args.by_section = True
+    decision["applied"] = {
+        "max_output_tokens": args.max_output_tokens,
+        "continuations": args.continuations,
+        "mode": args.mode,
+        "by_section": args.by_section,
+    }
+    print(json.dumps({"gemini_budget": decision}, ensure_ascii=False), file=sys.stderr)
+    return decision
+
+# ---------------------------
+# Cached document context
+# ---------------------------
+
+CONTEXT_REQUEST = "Generate the report described above from the attached document(s)."
+
+def open_cached_context(args, backend, parts: List) -> tuple:
+    """
+    Register parts (PDFs + prompt) and the system instruction as cached
+    context. Returns (model, request_parts, handle): later requests carry only
+    CONTEXT_REQUEST plus whatever new text they add (section notes,
+    PRIOR_OUTPUT). Falls back to (plain model, parts, None) if the backend
+    refuses (e.g. below the minimum cacheable size).
+    """
+    try:
+        t0 = time.perf_counter()
+        handle = backend.create_context(args.model, parts, args.system_instruction, args.context_ttl)
+        model = backend.model_for_context(handle)
+    except Exception as e:
+        print(f"WARN: cached context unavailable, sending documents with every call: {e}", file=sys.stderr)
+        return args.default_model, parts, None
+    log_debug(args, f"cached context created in {time.perf_counter() - t0:.1f}s")
+    # the response cache must still see what the context contains
+    args.context_prints = [_part_fingerprint(p, args.pdf_hashes) for p in parts]
+    return model, [CONTEXT_REQUEST], handle
+
+def generate_report(args, model, parts: List, gen_cfg, safety) -> str:
+    """First pass (section-parallel, streamed or blocking) plus continuations."""
+    if debug_enabled(args):
+        try:
+            log_debug(args, f"request size: {model.count_tokens(parts).total_tokens} tokens")
+        except Exception as e:
+            log_debug(args, f"count_tokens failed: {e}")
+    if args.by_section:
+        log_debug(args, f"section-parallel generation, concurrency={args.section_concurrency}")
+        text = generate_sections(args, model, parts, gen_cfg, safety)
+    elif args.stream:
+        log_debug(args, f"streaming to {args.out}, stall timeout={args.stall_seconds}s")
+        text = stream_report(args, model, parts, gen_cfg, safety, args.out)
+    else:
+        # First pass (dump raw JSON if requested)
+        dump_path = args.dump_response or ""
+        text = call_model_with_retries(
+            args=args,
+            model=model,
+            parts=parts,
+            gen_cfg=gen_cfg,
+            safety=safety,
+            max_attempts=max(1, args.retries),
+            dump_path=dump_path if dump_path else None,
+            label="reduce" if args.map_reduced else "first",
+        ) or ""
+
+    # Continuation loop (bounded; sections and streaming handle their own continuations)
+    remaining = 0 if (args.by_section or args.stream) else max(0, int(args.continuations))
+    n = 0
+    while remaining > 0 and looks_truncated(text) and continuation_allowed(args):
+        remaining -= 1
+        n += 1
+        cont_note = build_continuation_prompt()
+        cont_parts = list(parts) + [
+            continuation.prior_block(text),
+            "\n\n" + cont_note,
+        ]
+        more = call_model_with_retries(
+            args=args,
+            model=model,
+            parts=cont_parts,
+            gen_cfg=gen_cfg,
+            safety=safety,
+            max_attempts=max(1, args.retries),
+            dump_path=None,  # Only dump the first main call
+            label=f"continuation-{n}",
+        ) or ""
+        if more.strip():
+            text = continuation.splice(text, more)
+        else:
+            break
+
+    return text
+
 # ---------------------------
 # Main
 # ---------------------------
 
-def main():
+def build_parser() -> argparse.ArgumentParser:
     p = argparse.ArgumentParser()
     p.add_argument("--context", required=True)
     p.add_argument("--model", required=True)
@@ -345,75 +984,115 @@ def main():
     p.add_argument("--location", required=True)
     p.add_argument("--out", required=True)
     # Tunables
-    p.add_argument("--max_output_tokens", type=int, default=8192)
+    p.add_argument("--max_output_tokens", type=int, default=None, help="default: planned (8192 with --no-budget)")
     p.add_argument("--temperature", type=float, default=0.2)
     p.add_argument("--top_p", type=float, default=0.95)
     p.add_argument("--top_k", type=int, default=40)
     p.add_argument("--retries", type=int, default=3)
-    p.add_argument("--continuations", type=int, default=1)
+    p.add_argument("--continuations", type=int, default=None, help="default: planned (1 with --no-budget)")
+    p.add_argument("--no-budget", action="store_true",
+                   default=os.environ.get("GEMINI_BUDGET", "").lower() in ("0", "off", "false", "no"),
+                   help="Skip the token-budget planner")
+    p.add_argument("--mode", choices=("auto", "single", "map-reduce"), default="auto")
+    p.add_argument("--map-concurrency", type=int, default=int(os.environ.get("GEMINI_MAP_CONCURRENCY", "4")))
+    p.add_argument("--by-section", action="store_true",
+                   default=os.environ.get("GEMINI_BY_SECTION", "").lower() in ("1", "true", "yes"))
+    p.add_argument("--section-concurrency", type=int, default=int(os.environ.get("GEMINI_SECTION_CONCURRENCY", "4")))
+    p.add_argument("--stream", action="store_true",
+                   default=os.environ.get("GEMINI_STREAM", "").lower() in ("1", "true", "yes"))
+    p.add_argument("--stall-seconds", type=float, default=float(os.environ.get("GEMINI_STALL_SECONDS", "90")))
+    p.add_argument("--stats-out", default="", help="Write per-pass timing/usage stats JSON")
+    p.add_argument("--settings", default="", help="settings JSON from build_prompt.py (systemInstruction)")
+    p.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+    p.add_argument("--context-cache", action="store_true",
+                   default=os.environ.get("GEMINI_CONTEXT_CACHE", "").lower() in ("1", "true", "yes"))
+    p.add_argument("--backend", dest="backend_name", choices=sorted(model_backend.BACKENDS),
+                   default=os.environ.get("GEMINI_BACKEND", "vertex"))
+    p.add_argument("--hedge-location", default=os.environ.get("GEMINI_HEDGE_LOCATION", ""),
+                   help="Second region for hedged requests (blocking calls only)")
+    p.add_argument("--ledger", default=os.environ.get("GEMINI_LEDGER", ""),
+                   help="usage ledger JSON (default: <artifact_dir>/gemini_ledger.json)")
+    p.add_argument("--context-ttl", type=int, default=int(os.environ.get("GEMINI_CONTEXT_TTL", "3600")))
     # Debug / dump
     p.add_argument("--dump-response", default="", help="Write raw JSON of the first main response")
     p.add_argument("--debug", action="store_true", help="Verbose diagnostics to stderr")
-    args = p.parse_args()
+    return p
 
-    # Load context + prompt
-    ctx = load_json(args.context)
+def run(args, ctx: dict, prompt_text: str, system_instruction: Optional[str] = None) -> str:
+    """
+    Generate the report for an issue context and write it to args.out.
+    Returns the text. ctx gets "gemini_budget" when the budget planner ran;
+    persisting ctx is left to the caller.
+    """
     gcs_uris = ctx.get("gcs_uris", [])
     if not gcs_uris:
         print("WARN: No gcs_uris found in context; proceeding with prompt only.", file=sys.stderr)
 
-    prompt_text = read_text(args.prompt_file)
+    PLANNED_SECTIONS[:] = ctx.get("required_sections") or []
+    args.system_instruction = system_instruction
+    args.pdf_hashes = load_pdf_hashes(ctx)
+    ledger_path = args.ledger
+    if not ledger_path and ctx.get("artifact_dir"):
+        ledger_path = os.path.join(ctx["artifact_dir"], "gemini_ledger.json")
+    args.ledger = usage_ledger.Ledger(ledger_path, args.model, ctx.get("issue_number"))
 
-    # Initialize Vertex AI (Workload Identity picks up GOOGLE_APPLICATION_CREDENTIALS)
-    vertexai_init(project=args.project, location=args.location)
-    aiplatform.init(project=args.project, location=args.location)
-    log_debug(args, f"Vertex initialized: project={args.project}, location={args.location}")
+    # Initialize the backend (Vertex: Workload Identity picks up GOOGLE_APPLICATION_CREDENTIALS)
+    backend = args.backend = model_backend.get_backend(args.backend_name, args.project, args.location)
+    log_debug(args, f"{backend.name} backend initialized: project={args.project}, location={args.location}")
 
     # Model + config
-    model = GenerativeModel(args.model)
-    gen_cfg = GenerationConfig(
-        max_output_tokens=args.max_output_tokens,
-        temperature=args.temperature,
-        top_p=args.top_p,
-        top_k=args.top_k,
-    )
-    safety = _build_safety_settings()
-    parts = build_parts(gcs_uris, prompt_text)
-
-    # First pass (dump raw JSON if requested)
-    dump_path = args.dump_response or ""
-    text = call_model_with_retries(
-        args=args,
-        model=model,
-        parts=parts,
-        gen_cfg=gen_cfg,
-        safety=safety,
-        max_attempts=max(1, args.retries),
-        dump_path=dump_path if dump_path else None,
-    ) or ""
-
-    # Continuation loop (bounded)
-    remaining = max(0, int(args.continuations))
-    while remaining > 0 and looks_truncated(text):
-        remaining -= 1
-        cont_note = build_continuation_prompt()
-        cont_parts = list(parts) + [
-            "\n\nPRIOR_OUTPUT (do not repeat; continue from the end):\n" + text,
-            "\n\n" + cont_note,
-        ]
-        more = call_model_with_retries(
-            args=args,
-            model=model,
-            parts=cont_parts,
-            gen_cfg=gen_cfg,
-            safety=safety,
-            max_attempts=max(1, args.retries),
-            dump_path=None,  # Only dump the first main call
-        ) or ""
-        if more.strip():
-            text = (text + "\n" + more).strip()
-        else:
-            break
+    model = args.default_model = backend.model(args.model, args.system_instruction)
+    args.hedge_model = None
+    if args.hedge_location and args.hedge_location != args.location:
+        args.hedge_model = backend.model(args.model, args.system_instruction, location=args.hedge_location)
+        log_debug(args, f"hedging slow requests to {args.hedge_location}")
+    n_pdfs = sum(1 for u in gcs_uris if u.startswith("gs://"))
+    explicit_max_output = args.max_output_tokens
+    budget = None
+    if not args.no_budget:
+        budget = plan_budget(args, model, ctx, gcs_uris, prompt_text, n_pdfs)
+    if args.max_output_tokens is None:
+        args.max_output_tokens = 8192
+    if args.continuations is None:
+        args.continuations = 1
+    args.gen_cfg_dict = {
+        "max_output_tokens": args.max_output_tokens,
+        "temperature": args.temperature,
+        "top_p": args.top_p,
+        "top_k": args.top_k,
+    }
+    # The planned budget moves as the ledgers grow (calibrate_ratio), so the
+    # response cache keys on what the caller fixed, not on the plan.
+    args.cache_cfg = dict(args.gen_cfg_dict, max_output_tokens=explicit_max_output or "planned")
+    gen_cfg = backend.generation_config(**args.gen_cfg_dict)
+    safety = backend.safety_settings()
+
+    chunked = bool((ctx.get("policy") or {}).get("chunked"))
+    use_map_reduce = args.mode == "map-reduce" or (args.mode == "auto" and chunked and n_pdfs > 1)
+    args.map_reduced = bool(use_map_reduce and n_pdfs)
+
+    if use_map_reduce and n_pdfs:
+        log_debug(args, f"map-reduce over {n_pdfs} part(s), concurrency={args.map_concurrency}")
+        parts = run_map_phase(
+            args, model, gcs_uris, prompt_text, gen_cfg, safety, ctx.get("part_manifest") or []
+        )
+    else:
+        parts = build_parts(gcs_uris, prompt_text, backend)
+
+    # Register PDFs + prompt + system instruction once as cached context
+    handle = None
+    if args.context_cache and n_pdfs and not use_map_reduce:
+        model, parts, handle = open_cached_context(args, backend, parts)
+
+    out_tokens_before = args.ledger.totals["served_output_tokens"]  # map-phase notes are not report output
+    try:
+        text = generate_report(args, model, parts, gen_cfg, safety)
+    finally:
+        if handle is not None:
+            try:
+                backend.delete_context(handle)
+            except Exception as e:
+                print(f"WARN: could not delete cached context: {e}", file=sys.stderr)
 
     # Best-effort image appendix
     issue_dir = Path(ctx.get("artifact_dir") or ".")
@@ -421,7 +1100,44 @@ def main():
 
     # Persist
     mkdirp(os.path.dirname(args.out) or ".")
-    Path(args.out).write_text(text or "", encoding="utf-8")
+    write_atomic(args.out, text or "")
+    cache_metrics = response_cache.metrics()
+    print(json.dumps({"gemini_cache": cache_metrics, "gemini_retry": retry_policy.metrics()}), file=sys.stderr)
+    if budget is not None:
+        token_budget.finish(budget, args.ledger.totals["served_output_tokens"] - out_tokens_before)
+        print(json.dumps({"gemini_budget_actual": {k: budget.get(k) for k in (
+            "estimated_output_tokens", "actual_output_tokens", "estimate_error")}}), file=sys.stderr)
+        ctx["gemini_budget"] = budget  # copied into run_meta.json by the workflow
+        # what calibrate_ratio() learns from on later runs
+        args.ledger.run["budget"] = {k: budget.get(k) for k in (
+            "input_tokens", "estimated_output_tokens", "actual_output_tokens", "max_output_tokens", "ratio")}
+    left = retry_policy.drain_losers()  # losing hedged requests are billed too
+    if left:
+        print(f"WARN: {left} losing hedged request(s) still running; their usage is not in the ledger",
+              file=sys.stderr)
+    ledger_run = args.ledger.save()
+    print(json.dumps({"gemini_usage": ledger_run["totals"], "status": ledger_run["status"],
+                      "issue_cost_usd": args.ledger.issue_totals()["cost_usd"]}), file=sys.stderr)
+    if args.stats_out:
+        write_atomic(args.stats_out, json.dumps(
+            {"passes": PASS_STATS, "cache": cache_metrics, "usage": ledger_run["totals"], "budget": budget,
+             "retry": retry_policy.metrics()}, indent=2
+        ))
+    return text
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # Load context + prompt
+    ctx = load_json(args.context)
+    prompt_text = read_text(args.prompt_file)
+    system_instruction = None
+    if args.settings and Path(args.settings).exists():
+        system_instruction = load_json(args.settings).get("systemInstruction") or None
+
+    text = run(args, ctx, prompt_text, system_instruction)
+    if ctx.get("gemini_budget") is not None:
+        write_json(args.context, ctx)
 
     if text:
         print(f"OK: wrote Gemini output to {args.out} ({len(text)} chars)")
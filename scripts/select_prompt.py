@@ -5,27 +5,42 @@ resulting selection is written to a JSON file with keys:
 
   chosen    – list of prompt identifiers (primary plus any combos)
   scores    – dictionary of scores per rule
-  signals   – placeholder for future PDF analysis signals
+  signals   – PDF signals the pdf_signals rules match on (pdf_signals.py):
+              page_count, contains_tables, likely_invoice, likely_datasheet,
+              text/image/table densities and a doc_type hint
 
 The script expects a routing YAML file that defines matching rules and
 combination logic. The context JSON should contain at least 'body' and
-'latest_comment' fields.
+'latest_comment' fields. Signals are computed from the prepared PDFs
+(ctx["final_pdf_paths"]), so run it after fetch_and_prepare_pdf.py; before
+that, repo-local ctx["pdf_urls"] are analysed instead. Numeric signals can be
+bounded in rules with <name>_min / <name>_max (e.g. table_density_min: 0.1).
 """
 
 import argparse
 import json
 import re
+import sys
+from pathlib import Path
 import yaml
+from util import read_cached
+import pdf_signals
 
 
-def detect_pdf_signals():
-    """Placeholder for future PDF meta analysis. Currently returns defaults."""
-    return {
-        "page_count": 0,
-        "contains_tables": False,
-        "likely_invoice": False,
-        "likely_datasheet": False,
-    }
+def detect_pdf_signals(ctx=None):
+    """Signals for the issue's PDFs (cached per content hash); defaults when there are none."""
+    ctx = ctx or {}
+    paths = ctx.get("final_pdf_paths") or [
+        ref for ref in ctx.get("pdf_urls") or []
+        if not re.match(r"^https?://", ref, re.I) and Path(ref).is_file()
+    ]
+    if not paths:
+        return dict(pdf_signals.DEFAULT_SIGNALS)
+    try:
+        return pdf_signals.detect(paths)
+    except Exception as e:
+        print(f"WARN: PDF signals unavailable: {e}", file=sys.stderr)
+        return dict(pdf_signals.DEFAULT_SIGNALS)
 
 
 def score_rules(routing, comment, signals):
@@ -45,9 +60,14 @@ def score_rules(routing, comment, signals):
                 if isinstance(v, bool):
                     if bool(signals.get(k)) != v:
                         ok = False
-                if isinstance(v, int) and k.endswith("_min"):
-                    base = k[:-4]
-                    if int(signals.get(base, 0)) < v:
+                elif isinstance(v, (int, float)) and k.endswith("_min"):
+                    if float(signals.get(k[:-4]) or 0) < v:
+                        ok = False
+                elif isinstance(v, (int, float)) and k.endswith("_max"):
+                    if float(signals.get(k[:-4]) or 0) > v:
+                        ok = False
+                elif isinstance(v, str):
+                    if str(signals.get(k, "")) != v:
                         ok = False
         if ok:
             for pid in rule.get("choose", []):
@@ -55,16 +75,14 @@ def score_rules(routing, comment, signals):
     return scores
 
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--context", required=True)
-    ap.add_argument("--routing", required=True)
-    ap.add_argument("--out", required=True)
-    args = ap.parse_args()
+def load_routing(path):
+    """Parsed routing YAML, re-read only when the file changes."""
+    return read_cached(path, yaml.safe_load)
 
-    ctx = json.load(open(args.context))
-    routing = yaml.safe_load(open(args.routing))
-    signals = detect_pdf_signals()
+
+def select(ctx, routing):
+    """Selection dict (chosen, scores, signals) for an issue context and routing rules."""
+    signals = detect_pdf_signals(ctx)
     # Use latest comment for update events or fallback to body
     comment = (ctx.get("latest_comment") or ctx.get("body") or "")
     scores = score_rules(routing, comment, signals)
@@ -76,14 +94,25 @@ def main():
         for co in combo_map.get(pid, []):
             if co not in chosen:
                 chosen.append(co)
-    out = {
+    return {
         "chosen": chosen,
         "scores": scores,
         "signals": signals,
     }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--context", required=True)
+    ap.add_argument("--routing", required=True)
+    ap.add_argument("--out", required=True)
+    args = ap.parse_args(argv)
+
+    ctx = json.load(open(args.context))
+    out = select(ctx, load_routing(args.routing))
     with open(args.out, "w") as f:
         json.dump(out, f, indent=2)
-    print(f"Selected prompts: {chosen}")
+    print(f"Selected prompts: {out['chosen']}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+snippet_store.py
+Compiled, ranked store of regulatory snippets for build_prompt.py's micro-RAG.
+
+build_prompt.py used to parse prompts/standards/au_snippets.yaml with PyYAML
+on every run and append the first 8 snippets, whatever the issue was about.
+This module compiles the YAML once into a JSON index (the snippets plus BM25
+term postings over their id, title, tags and text) stored under
+SNIPPET_CACHE_DIR/<sha256 of the YAML>.json, so an edited YAML compiles
+afresh and an unchanged one loads with a single json.load. Within a process
+(worker.py) the store is also memoized until the file changes.
+
+select() ranks the snippets against the issue (title, body, comments,
+planned sections; see retrieval.build_query) and the chosen prompt IDs:
+
+  - BM25 relevance over the snippet terms (retrieval.Corpus);
+  - a snippet whose optional "prompts: [...]" lists a chosen prompt ID gets
+    PROMPT_BOOST on top;
+
+and then takes snippets in rank order while their rendered lines fit
+SNIPPET_TOKEN_BUDGET, up to SNIPPET_MAX. When nothing matches, the first
+snippets in file order are used, as before.
+
+Snippet fields: id, title, text, source (as before), plus optional tags and
+prompts lists.
+
+Environment:
+  SNIPPET_TOKEN_BUDGET  estimated tokens for the snippet block (default 800)
+  SNIPPET_MAX           most snippets included (default 8)
+  SNIPPET_CACHE_DIR     compiled stores (default .agent/cache/snippets)
+
+Usage (inspect the ranking for a query):
+  python scripts/snippet_store.py prompts/standards/au_snippets.yaml \\
+      --query "PayTo mandate privacy" --prompts risk_compliance_au
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from util import load_or_build_json, read_cached
+import retrieval
+import token_budget
+
+__all__ = ["STORE_VERSION", "compile_store", "load", "render", "rank", "fit", "build_query", "select"]
+
+STORE_VERSION = 1
+PROMPT_BOOST = 1.0
+TITLE_WEIGHT = 2  # title and tag terms count twice
+
+DEFAULT_CACHE_DIR = os.path.join(".agent", "cache", "snippets")
+
+
+def render(s: dict) -> str:
+    """The prompt line for one snippet."""
+    return f"- [{s['id']}] {s['title']}: {s['text']} (Source: {s['source']})"
+
+
+def compile_store(yaml_text: str, sha256: Optional[str] = None) -> dict:
+    """Parse the snippet YAML and index it; the result is plain JSON."""
+    import yaml  # only needed when the YAML changed
+
+    snippets, page_len, postings = [], [], {}
+    for raw in yaml.safe_load(yaml_text) or []:
+        if not isinstance(raw, dict):
+            continue
+        s = {
+            "id": str(raw.get("id", "ref")),
+            "title": str(raw.get("title", "Untitled")),
+            "text": str(raw.get("text", "")).strip(),
+            "source": str(raw.get("source", "")),
+            "tags": [str(t) for t in raw.get("tags") or []],
+            "prompts": [str(p) for p in raw.get("prompts") or []],
+        }
+        s["tokens"] = token_budget.estimate_text_tokens(render(s))
+        heading = " ".join([s["id"], s["title"]] + s["tags"])
+        terms = Counter(retrieval.tokenize(heading) * TITLE_WEIGHT + retrieval.tokenize(s["text"]))
+        i = len(snippets)
+        snippets.append(s)
+        page_len.append(sum(terms.values()))
+        for term, tf in terms.items():
+            postings.setdefault(term, []).extend((i, tf))
+    return {
+        "version": STORE_VERSION,
+        "sha256": sha256,
+        "snippets": snippets,
+        "page_count": len(snippets),
+        "page_len": page_len,
+        "postings": postings,
+    }
+
+
+def _from_text(yaml_text: str) -> dict:
+    """Compiled store for this YAML text: from the on-disk cache, else compiled and saved."""
+    sha256 = hashlib.sha256(yaml_text.encode("utf-8")).hexdigest()
+    path = Path(os.environ.get("SNIPPET_CACHE_DIR") or DEFAULT_CACHE_DIR) / f"{sha256}.json"
+    store, _ = load_or_build_json(path, STORE_VERSION, lambda: compile_store(yaml_text, sha256))
+    return store
+
+
+def load(yaml_path) -> dict:
+    """The compiled store for yaml_path (memoized until the file changes)."""
+    return read_cached(yaml_path, parse=_from_text)
+
+
+def rank(store: dict, query: Dict[str, float], prompt_ids=()) -> List[tuple]:
+    """[(score, snippet), ...] for snippets scoring above zero, best first."""
+    corpus = retrieval.Corpus()
+    corpus.add(store, "snippets")
+    scores = corpus.scores(query)
+    chosen = set(prompt_ids or ())
+    ranked = []
+    for i, s in enumerate(store["snippets"]):
+        score = scores[i] + (PROMPT_BOOST if chosen.intersection(s["prompts"]) else 0.0)
+        if score > 0:
+            ranked.append((score, i, s))
+    ranked.sort(key=lambda r: (-r[0], r[1]))  # ties keep file order
+    return [(score, s) for score, _, s in ranked]
+
+
+def fit(snippets: List[dict], budget: int, limit: int) -> List[dict]:
+    """Snippets in order while their lines fit the token budget (skipping ones that do not)."""
+    out, used = [], 0
+    for s in snippets:
+        if len(out) >= limit:
+            break
+        if used + s["tokens"] <= budget:
+            out.append(s)
+            used += s["tokens"]
+    return out
+
+
+def build_query(ctx: dict, prompt_ids=()) -> Dict[str, float]:
+    """The issue's query terms (retrieval.build_query) plus the words of the prompt IDs."""
+    query = retrieval.build_query(ctx)
+    for term in retrieval.tokenize(" ".join(prompt_ids or ()).replace("_", " "), retrieval.QUERY_STOPWORDS):
+        query[term] = query.get(term, 0.0) + retrieval.SECTION_WEIGHT
+    return query
+
+
+def select(yaml_path, ctx: dict, prompt_ids=(), budget: Optional[int] = None,
+           limit: Optional[int] = None) -> List[dict]:
+    """The snippets to append for this issue, ranked and fitted to the budget."""
+    budget = budget if budget is not None else int(os.environ.get("SNIPPET_TOKEN_BUDGET", "800"))
+    limit = limit if limit is not None else int(os.environ.get("SNIPPET_MAX", "8"))
+    store = load(yaml_path)
+    ranked = [s for _, s in rank(store, build_query(ctx, prompt_ids), prompt_ids)]
+    return fit(ranked or store["snippets"], budget, limit)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Compile the snippet store and show its ranking for a query")
+    ap.add_argument("yaml", help="snippet YAML, e.g. prompts/standards/au_snippets.yaml")
+    ap.add_argument("--query", default="", help="issue text to rank against")
+    ap.add_argument("--prompts", default="", help="comma-separated chosen prompt IDs")
+    a = ap.parse_args(argv)
+
+    store = load(a.yaml)
+    print(f"{len(store['snippets'])} snippets, {len(store['postings'])} terms ({store['sha256'][:12]})")
+    if a.query or a.prompts:
+        ids = [p.strip() for p in a.prompts.split(",") if p.strip()]
+        chosen = {s["id"] for s in select(a.yaml, {"body": a.query}, ids)}
+        ranked = rank(store, build_query({"body": a.query}, ids), ids)
+        if not ranked:
+            print("no snippet matches; the first ones in file order are used: " + ", ".join(sorted(chosen)))
+        for score, s in ranked:
+            print(f"{'*' if s['id'] in chosen else ' '} {score:7.3f}  {s['id']}  {s['title']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+token_budget.py
+Token-budget planner for run_gemini_sdk.py.
+
+Instead of a fixed max_output_tokens / continuation count, the runner counts
+the input tokens of the request before the first call (the backend's
+count_tokens, or a local estimate when that is unavailable or fails) and
+plans from them:
+
+  - expected output: a share of the input per required section, clamped to
+    [SECTION_MIN_TOKENS, SECTION_MAX_TOKENS] per section, plus headroom;
+  - thinking models (gemini-2.5) spend thinking tokens out of
+    max_output_tokens as well, so THINKING_TOKENS is added to every request;
+  - one request (max_output_tokens sized to the estimate) when it fits the
+    model's output cap;
+  - section-parallel generation when the whole report would not fit, with
+    continuation passes per section when a single section would not either;
+  - map-reduce over the PDF parts when the input itself does not fit the
+    context window.
+
+max_output_tokens is never planned below MIN_OUTPUT_TOKENS, the fixed value
+used before planning. SECTION_MIN_TOKENS is set from the committed reports
+(docs/issue-reports: 23-34 KB, ~6-8.5k tokens over 7 sections).
+
+The share of the input comes from GEMINI_BUDGET_RATIO when set, else from
+real report sizes: calibrate_ratio() takes the median of served output over
+counted input across the runs in usage ledgers (the issue's own and its
+sibling issues'), once CALIBRATION_MIN_RUNS completed runs are recorded;
+DEFAULT_RATIO until then.
+
+Local estimate: ~4 characters per text token and PDF_PAGE_TOKENS per PDF
+page (Gemini bills each page as an image plus its extracted text).
+
+After the run, finish() compares the estimate with the output tokens the
+model actually reported. The plan is written to --stats-out and
+ctx["gemini_budget"] (copied into run_meta.json by the workflow).
+
+Environment:
+  GEMINI_BUDGET_RATIO     expected output tokens per input token (default:
+                          calibrated from the ledgers, else 0.04)
+  GEMINI_BUDGET_HEADROOM  multiplier on the estimate (default 1.25)
+  GEMINI_THINKING_TOKENS  thinking allowance per request on thinking models
+                          (default 8192; 0 to disable)
+"""
+
+from __future__ import annotations
+
+import glob
+import json
+import math
+import os
+import statistics
+from typing import List, Optional
+
+__all__ = [
+    "MODEL_LIMITS",
+    "model_limits",
+    "estimate_text_tokens",
+    "estimate_input_tokens",
+    "count_input_tokens",
+    "thinking_allowance",
+    "calibrate_ratio",
+    "ledger_paths",
+    "plan",
+    "finish",
+]
+
+# (context window, max output tokens); first matching prefix wins
+MODEL_LIMITS = (
+    ("gemini-2.5", (1_048_576, 65_536)),
+    ("gemini-2.0", (1_048_576, 8_192)),
+    ("gemini-1.5-pro", (2_097_152, 8_192)),
+    ("gemini-1.5-flash", (1_048_576, 8_192)),
+)
+DEFAULT_LIMITS = (1_048_576, 8_192)
+THINKING_MODELS = ("gemini-2.5",)  # thinking tokens count against max_output_tokens
+THINKING_TOKENS = 8_192
+MIN_OUTPUT_TOKENS = 8_192  # the fixed max_output_tokens before planning
+
+PDF_PAGE_TOKENS = 560  # page image (258) + typical extracted text
+DEFAULT_PDF_PAGES = 30  # when the page count of a part is unknown
+SECTION_MIN_TOKENS = 1_200  # 7 sections -> ~8.7k, the size of the larger committed reports
+SECTION_MAX_TOKENS = 8_000
+REPORT_OVERHEAD_TOKENS = 300  # title, preamble, figures
+MAX_CONTINUATIONS = 4
+DEFAULT_RATIO = 0.04
+CALIBRATION_MIN_RUNS = 3
+RATIO_BOUNDS = (0.01, 1.0)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def model_limits(model_id: str) -> tuple:
+    """(context window, output cap) for a model id such as 'gemini-2.5-pro'."""
+    name = (model_id or "").rsplit("/", 1)[-1]
+    for prefix, limits in MODEL_LIMITS:
+        if name.startswith(prefix):
+            return limits
+    return DEFAULT_LIMITS
+
+
+def estimate_text_tokens(text: str) -> int:
+    return (len(text or "") + 3) // 4
+
+
+def estimate_input_tokens(parts: List, pdf_pages: List[Optional[int]], system_instruction: Optional[str] = None) -> int:
+    """Local estimate: text parts by length, PDF parts by page count (in order)."""
+    pages = iter(pdf_pages)
+    total = estimate_text_tokens(system_instruction or "")
+    for p in parts:
+        if isinstance(p, str):
+            total += estimate_text_tokens(p)
+        else:
+            total += (next(pages, None) or DEFAULT_PDF_PAGES) * PDF_PAGE_TOKENS
+    return total
+
+
+def count_input_tokens(model, parts: List, pdf_pages: List[Optional[int]], system_instruction: Optional[str] = None) -> tuple:
+    """(tokens, source) where source is "count_tokens" or "estimate"."""
+    try:
+        return int(model.count_tokens(parts).total_tokens), "count_tokens"
+    except Exception:
+        return estimate_input_tokens(parts, pdf_pages, system_instruction), "estimate"
+
+
+def thinking_allowance(model_id: str) -> int:
+    """Tokens reserved for thinking per request (0 for models that do not think)."""
+    name = (model_id or "").rsplit("/", 1)[-1]
+    if not name.startswith(THINKING_MODELS):
+        return 0
+    try:
+        return max(0, int(os.environ.get("GEMINI_THINKING_TOKENS", THINKING_TOKENS)))
+    except ValueError:
+        return THINKING_TOKENS
+
+
+def calibrate_ratio(ledger_paths: List[str]) -> Optional[float]:
+    """
+    Median served-output / counted-input ratio of the completed runs in the
+    given usage ledgers (runs carry "budget" once the planner ran), or None
+    with fewer than CALIBRATION_MIN_RUNS of them.
+    """
+    ratios = []
+    for path in ledger_paths:
+        try:
+            with open(path, encoding="utf-8") as f:
+                runs = json.load(f).get("runs") or []
+        except (OSError, ValueError, AttributeError):
+            continue
+        for run in runs:
+            b = run.get("budget") or {}
+            if run.get("status") == "ok" and b.get("input_tokens") and b.get("actual_output_tokens"):
+                ratios.append(b["actual_output_tokens"] / b["input_tokens"])
+    if len(ratios) < CALIBRATION_MIN_RUNS:
+        return None
+    lo, hi = RATIO_BOUNDS
+    return round(min(hi, max(lo, statistics.median(ratios))), 4)
+
+
+def ledger_paths(ledger_path: Optional[str]) -> List[str]:
+    """The issue's ledger plus its sibling issues' (<output root>/issue-*/gemini_ledger.json)."""
+    if not ledger_path:
+        return []
+    pattern = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(ledger_path))),
+                           "issue-*", os.path.basename(ledger_path))
+    return sorted(set(glob.glob(pattern)) | ({ledger_path} if os.path.isfile(ledger_path) else set()))
+
+
+def _round_up(n: float, step: int = 1024) -> int:
+    return int(math.ceil(n / step) * step)
+
+
+def plan(model_id: str, input_tokens: int, sections: List[str], n_pdfs: int,
+         ratio: Optional[float] = None) -> dict:
+    """
+    Decide output budget, continuation passes and generation mode.
+
+    ratio is the calibrated output/input ratio (see calibrate_ratio);
+    GEMINI_BUDGET_RATIO overrides it, DEFAULT_RATIO applies without either.
+
+    Returns {"input_tokens", "context_window", "output_cap",
+    "estimated_output_tokens", "per_section_tokens", "thinking_tokens",
+    "ratio", "ratio_source", "max_output_tokens", "continuations",
+    "mode": "single"|"map-reduce"|None, "by_section", "reason"}; mode None
+    leaves the runner's own choice in place.
+    """
+    window, cap = model_limits(model_id)
+    n_sec = max(1, len(sections))
+    if os.environ.get("GEMINI_BUDGET_RATIO"):
+        ratio, ratio_source = _env_float("GEMINI_BUDGET_RATIO", DEFAULT_RATIO), "env"
+    elif ratio:
+        ratio_source = "ledger"
+    else:
+        ratio, ratio_source = DEFAULT_RATIO, "default"
+    headroom = _env_float("GEMINI_BUDGET_HEADROOM", 1.25)
+    thinking = thinking_allowance(model_id)
+    floor = min(cap, MIN_OUTPUT_TOKENS)
+
+    per_section = min(SECTION_MAX_TOKENS, max(SECTION_MIN_TOKENS, int(input_tokens * ratio / n_sec)))
+    estimate = per_section * n_sec + REPORT_OVERHEAD_TOKENS
+    need, need_section = estimate * headroom, per_section * headroom
+    room = max(1, cap - thinking)  # answer tokens one request can hold
+
+    def budget(n: float) -> int:
+        return min(cap, max(floor, _round_up(n + thinking)))
+
+    decision = {
+        "input_tokens": input_tokens,
+        "context_window": window,
+        "output_cap": cap,
+        "estimated_output_tokens": estimate,
+        "per_section_tokens": per_section,
+        "thinking_tokens": thinking,
+        "ratio": ratio,
+        "ratio_source": ratio_source,
+        "mode": None,
+    }
+    if input_tokens > window * 0.9 and n_pdfs > 1:
+        # the documents alone overflow the window: map each part separately
+        decision.update(mode="map-reduce", by_section=False, max_output_tokens=budget(need),
+                        continuations=1 if need <= room else min(MAX_CONTINUATIONS, math.ceil(need / room)),
+                        reason=f"input {input_tokens} tokens exceeds 90% of the {window}-token window")
+    elif need <= room:
+        decision.update(by_section=False, max_output_tokens=budget(need),
+                        continuations=1, reason="report fits one response")
+    elif need_section <= room:
+        decision.update(by_section=True, max_output_tokens=budget(need_section),
+                        continuations=1, reason=f"report ~{int(need)} tokens exceeds the {room} answer tokens of one response")
+    else:
+        decision.update(by_section=True, max_output_tokens=cap,
+                        continuations=min(MAX_CONTINUATIONS, math.ceil(need_section / room)),
+                        reason=f"each section ~{int(need_section)} tokens exceeds the {room} answer tokens of one response")
+    if thinking:
+        decision["reason"] += f" (+{thinking} thinking tokens per request)"
+    if decision["mode"] is None and input_tokens > window * 0.9:
+        decision["reason"] += f"; WARNING input {input_tokens} tokens is close to the {window}-token window"
+    return decision
+
+
+def finish(decision: dict, actual_output_tokens: int) -> dict:
+    """Record actual output tokens and the estimate's relative error."""
+    decision["actual_output_tokens"] = actual_output_tokens
+    if actual_output_tokens:
+        err = (decision["estimated_output_tokens"] - actual_output_tokens) / actual_output_tokens
+        decision["estimate_error"] = round(err, 3)
+    return decision
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+upload_to_gcs.py
+Upload the prepared PDFs (ctx["final_pdf_paths"]) to Cloud Storage in parallel
+and write the confirmed gs:// URIs back into the context.
+
+Replaces the workflow's per-file `gcloud storage cp` loop:
+  - Parts are uploaded concurrently (GCS_UPLOAD_WORKERS, default 4).
+  - An object whose stored MD5 (or CRC32C, for composite objects that have no
+    MD5) already matches the local file is skipped, so re-runs on the same
+    issue do not re-send unchanged bytes.
+  - Files above GCS_RESUMABLE_MB (default 8) use chunked resumable uploads;
+    files above GCS_COMPOSITE_MB (default 64) are sent as up to 32 slices in
+    parallel and composed server-side, then the slices are deleted.
+  - Every uploaded object is re-read and its checksum compared with the local
+    file before its URI is written to ctx["gcs_uris"].
+
+The storage client is injectable (upload_all / upload_context(..., client=...);
+tests/test_upload_to_gcs.py uses an in-memory store), so the stage
+can run against any object exposing the small google.cloud.storage surface
+used here: client.bucket(name) -> bucket with get_blob(name) and blob(name);
+blobs with md5_hash, crc32c, chunk_size, upload_from_filename(),
+upload_from_file(), compose(), reload() and delete().
+
+Usage:
+  python upload_to_gcs.py --context issue_context.json --bucket gs://pdf-agent
+
+Writes ctx["gcs_uris"] (same order as final_pdf_paths), ctx["gcs_hashes"]
+(uri -> "md5:<base64>" content hash) and ctx["upload"] (per-object status,
+bytes sent and timings).
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import hashlib
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from util import read_json, write_json
+
+__all__ = [
+    "local_hashes",
+    "remote_matches",
+    "default_client",
+    "parse_gs_uri",
+    "upload_one",
+    "upload_workers",
+    "upload_all",
+    "upload_context",
+]
+
+MAX_COMPOSE = 32  # GCS compose accepts at most 32 source objects
+CHUNK = 256 * 1024  # resumable chunk sizes must be multiples of 256 KiB
+
+
+def _env_mb(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, str(default))) * 1024 * 1024
+    except ValueError:
+        return default * 1024 * 1024
+
+
+def _crc32c():
+    """Return a google_crc32c.Checksum, or None when the package is missing."""
+    try:
+        import google_crc32c
+    except ImportError:
+        return None
+    return google_crc32c.Checksum()
+
+
+def local_hashes(path, chunk_size: int = 1024 * 1024) -> dict:
+    """Base64 MD5 and CRC32C of a file (the encoding GCS reports), in one pass."""
+    md5 = hashlib.md5()
+    crc = _crc32c()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+            if crc is not None:
+                crc.update(chunk)
+    return {
+        "md5": base64.b64encode(md5.digest()).decode("ascii"),
+        "crc32c": base64.b64encode(crc.digest()).decode("ascii") if crc is not None else None,
+    }
+
+
+def remote_matches(blob, hashes: dict) -> bool:
+    """True when the stored object has the same content as the local file."""
+    if blob is None:
+        return False
+    if getattr(blob, "md5_hash", None):
+        return blob.md5_hash == hashes["md5"]
+    if getattr(blob, "crc32c", None) and hashes.get("crc32c"):
+        return blob.crc32c == hashes["crc32c"]
+    return False
+
+
+_CLIENTS: dict = {}
+
+
+def default_client(project: Optional[str] = None):
+    """google.cloud.storage.Client using Application Default Credentials.
+
+    One client per project and process, so a long-lived worker reuses its
+    authorised session across issues.
+    """
+    if project not in _CLIENTS:
+        from google.cloud import storage
+
+        _CLIENTS[project] = storage.Client(project=project)
+    return _CLIENTS[project]
+
+
+def parse_gs_uri(uri: str):
+    """Split "gs://bucket/some/prefix" (or "bucket/prefix") into (bucket, prefix)."""
+    rest = uri[5:] if uri.startswith("gs://") else uri
+    bucket, _, prefix = rest.partition("/")
+    return bucket, prefix.strip("/")
+
+
+def _upload_slice(bucket, name, path, offset, length):
+    blob = bucket.blob(name)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        blob.upload_from_file(f, size=length)
+    return blob
+
+
+def _upload_composite(bucket, object_name, path, size):
+    n = min(MAX_COMPOSE, math.ceil(size / CHUNK))
+    step = math.ceil(size / n / CHUNK) * CHUNK
+    slices = [(i, off, min(step, size - off)) for i, off in enumerate(range(0, size, step))]
+    with ThreadPoolExecutor(max_workers=min(len(slices), 8)) as pool:
+        futures = [
+            pool.submit(_upload_slice, bucket, f"{object_name}.__slice-{i}", path, off, length)
+            for i, off, length in slices
+        ]
+        sources = [fut.result() for fut in futures]
+    blob = bucket.blob(object_name)
+    try:
+        blob.compose(sources)
+    finally:
+        for src in sources:
+            try:
+                src.delete()
+            except Exception:
+                pass
+    return blob
+
+
+def upload_one(client, bucket_name: str, path, object_name: str) -> dict:
+    """
+    Upload one file unless an identical object already exists.
+
+    Returns {"uri", "status": "skipped"|"uploaded"|"composed", "bytes",
+    "md5", "seconds"}; raises RuntimeError if the stored checksum does not match
+    after upload.
+    """
+    t0 = time.perf_counter()
+    bucket = client.bucket(bucket_name)
+    size = os.path.getsize(path)
+    hashes = local_hashes(path)
+    uri = f"gs://{bucket_name}/{object_name}"
+
+    if remote_matches(bucket.get_blob(object_name), hashes):
+        return {"uri": uri, "status": "skipped", "bytes": 0, "md5": hashes["md5"], "seconds": round(time.perf_counter() - t0, 3)}
+
+    if size > _env_mb("GCS_COMPOSITE_MB", 64):
+        blob = _upload_composite(bucket, object_name, path, size)
+        status = "composed"
+    else:
+        blob = bucket.blob(object_name)
+        if size > _env_mb("GCS_RESUMABLE_MB", 8):
+            blob.chunk_size = 8 * 1024 * 1024  # chunked resumable upload, retried per chunk
+        blob.upload_from_filename(str(path))
+        status = "uploaded"
+
+    blob.reload()
+    if not remote_matches(blob, hashes):
+        if status == "composed" and hashes["crc32c"] is None:
+            print(f"Warning: cannot verify composite object {uri} (google-crc32c missing)", file=sys.stderr)
+        else:
+            raise RuntimeError(f"Checksum mismatch after upload: {path} -> {uri}")
+    return {"uri": uri, "status": status, "bytes": size, "md5": hashes["md5"], "seconds": round(time.perf_counter() - t0, 3)}
+
+
+def upload_workers() -> int:
+    """Concurrent uploads (GCS_UPLOAD_WORKERS, default 4)."""
+    try:
+        return max(1, int(os.environ.get("GCS_UPLOAD_WORKERS", "4")))
+    except ValueError:
+        return 4
+
+
+def upload_all(paths: List[str], bucket_uri: str, prefix: str, client=None, workers: Optional[int] = None) -> dict:
+    """
+    Upload paths to <bucket_uri>/<prefix>/<basename> in parallel.
+
+    Returns {"uris": [...] in input order, "uploaded", "skipped", "bytes",
+    "wall_s", "objects": [...]}. The first failure is raised after the
+    other uploads finish.
+    """
+    bucket_name, base = parse_gs_uri(bucket_uri)
+    if not bucket_name:
+        raise RuntimeError("No GCS bucket given (use --bucket or GCS_BUCKET)")
+    prefix = "/".join(p for p in (base, prefix.strip("/")) if p)
+    client = client or default_client(os.environ.get("GCP_PROJECT_ID") or None)
+    t_run = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers or upload_workers()) as pool:
+        futures = [
+            pool.submit(upload_one, client, bucket_name, p, f"{prefix}/{Path(p).name}" if prefix else Path(p).name)
+            for p in paths
+        ]
+        objects = []
+        for p, fut in zip(paths, futures):
+            try:
+                objects.append(fut.result())
+            except Exception as e:
+                raise RuntimeError(f"Failed to upload {p}: {e}") from e
+
+    for p, obj in zip(paths, objects):
+        print(f"{obj['status']:>8}  {p} -> {obj['uri']} ({obj['seconds']}s)", file=sys.stderr)
+    return {
+        "uris": [o["uri"] for o in objects],
+        "uploaded": sum(1 for o in objects if o["status"] != "skipped"),
+        "skipped": sum(1 for o in objects if o["status"] == "skipped"),
+        "bytes": sum(o["bytes"] for o in objects),
+        "wall_s": round(time.perf_counter() - t_run, 3),
+        "objects": objects,
+    }
+
+
+def upload_context(ctx: dict, bucket_uri: str, prefix: Optional[str] = None, workers: Optional[int] = None,
+                   client=None) -> dict:
+    """Upload ctx["final_pdf_paths"] and record gcs_uris / gcs_hashes / upload in ctx; returns the summary."""
+    paths = ctx.get("final_pdf_paths", [])
+    if not paths and (ctx.get("retrieval") or {}).get("excerpts_path"):
+        # retrieval.py text mode: the excerpts travel in the prompt
+        ctx["gcs_uris"], ctx["gcs_hashes"] = [], {}
+        ctx["upload"] = {"uploaded": 0, "skipped": 0, "bytes": 0, "wall_s": 0.0, "objects": []}
+        return dict(ctx["upload"])
+    if not paths:
+        raise RuntimeError("No final_pdf_paths in context; run fetch_and_prepare_pdf.py first.")
+    prefix = prefix if prefix is not None else f"issues/{ctx['issue_number']}"
+
+    result = upload_all(paths, bucket_uri, prefix, client=client, workers=workers)
+    ctx["gcs_uris"] = result.pop("uris")
+    # content hash per object, used by run_gemini_sdk.py's response cache
+    ctx["gcs_hashes"] = {o["uri"]: "md5:" + o["md5"] for o in result["objects"]}
+    ctx["upload"] = result
+    return result
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--context", required=True)
+    ap.add_argument("--bucket", default=os.environ.get("GCS_BUCKET", ""), help="gs://bucket[/prefix]")
+    ap.add_argument("--prefix", default=None, help="object prefix (default: issues/<issue_number>)")
+    ap.add_argument("--workers", type=int, default=None)
+    a = ap.parse_args(argv)
+
+    ctx = read_json(a.context)
+    result = upload_context(ctx, a.bucket, a.prefix, a.workers)
+    write_json(a.context, ctx)
+    print(
+        f"GCS: {result['uploaded']} uploaded, {result['skipped']} unchanged, "
+        f"{result['bytes']} bytes in {result['wall_s']}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
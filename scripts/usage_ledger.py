@@ -0,0 +1,219 @@
+"""
+usage_ledger.py
+Per-call token/cost ledger and budget enforcement for run_gemini_sdk.py.
+
+Every model call of a run (cache hits included) is recorded with its pass
+("first", "map:Part 1 of 3", "section:Controls", "continuation-2", ...),
+input / output / cached tokens, latency, finish_reason, model_version,
+attempts and an estimated cost. The ledger file (default
+<artifact_dir>/gemini_ledger.json, next to run_meta.json) keeps every run of
+the issue:
+
+  {"issue": ..., "runs": [{"run_id", "started", "finished", "model",
+   "status": "ok"|"degraded"|"aborted", "totals", "budgets", "calls": [...]}],
+   "issue_totals": {...}}
+
+Per-call detail is kept for the last KEEP_CALL_DETAIL runs; older runs keep
+their totals only.
+
+Budgets (tokens = billed input + output; cost in USD; unset = unlimited):
+  GEMINI_RUN_MAX_TOKENS    GEMINI_RUN_MAX_USD
+  GEMINI_ISSUE_MAX_TOKENS  GEMINI_ISSUE_MAX_USD   (this run + earlier runs in the ledger)
+  GEMINI_BUDGET_DEGRADE_AT fraction of a budget at which the run degrades
+                           (default 0.8)
+
+state() is "ok", then "degraded" (the runner stops starting continuation
+passes and hedged duplicates) and finally "exceeded" (further calls are
+refused and the run is marked aborted).
+
+Prices are USD per million tokens (input, output, cached input), by model
+prefix; GEMINI_PRICE_INPUT / _OUTPUT / _CACHED override them.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+__all__ = ["PRICES", "prices_for", "budgets_from_env", "Ledger"]
+
+# (input, output, cached input) USD per 1M tokens; first matching prefix wins
+PRICES = (
+    ("gemini-2.5-pro", (1.25, 10.0, 0.31)),
+    ("gemini-2.5-flash-lite", (0.10, 0.40, 0.025)),
+    ("gemini-2.5-flash", (0.30, 2.50, 0.075)),
+    ("gemini-2.0-flash", (0.15, 0.60, 0.0375)),
+    ("gemini-1.5-pro", (1.25, 5.0, 0.3125)),
+)
+DEFAULT_PRICES = (1.25, 10.0, 0.31)
+LONG_CONTEXT_TOKENS = 200_000  # 2.5 Pro bills prompts above this at 2x input, 1.5x output
+KEEP_CALL_DETAIL = 10
+STATES = ("ok", "degraded", "exceeded")
+
+
+def _env_float(name: str) -> Optional[float]:
+    try:
+        value = os.environ.get(name, "").strip()
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def prices_for(model_id: str) -> tuple:
+    name = (model_id or "").rsplit("/", 1)[-1]
+    base = next((p for prefix, p in PRICES if name.startswith(prefix)), DEFAULT_PRICES)
+    overrides = (_env_float("GEMINI_PRICE_INPUT"), _env_float("GEMINI_PRICE_OUTPUT"), _env_float("GEMINI_PRICE_CACHED"))
+    return tuple(o if o is not None else b for o, b in zip(overrides, base))
+
+
+def budgets_from_env() -> dict:
+    return {
+        "run_tokens": _env_float("GEMINI_RUN_MAX_TOKENS"),
+        "run_usd": _env_float("GEMINI_RUN_MAX_USD"),
+        "issue_tokens": _env_float("GEMINI_ISSUE_MAX_TOKENS"),
+        "issue_usd": _env_float("GEMINI_ISSUE_MAX_USD"),
+        "degrade_at": _env_float("GEMINI_BUDGET_DEGRADE_AT") or 0.8,
+    }
+
+
+def _zero_totals() -> dict:
+    return {"calls": 0, "cache_hits": 0, "input_tokens": 0, "output_tokens": 0,
+            "cached_tokens": 0, "served_output_tokens": 0, "cost_usd": 0.0}
+
+
+class Ledger:
+    """Thread-safe call ledger for one run, persisted alongside earlier runs."""
+
+    def __init__(self, path: str, model: str, issue=None, budgets: Optional[dict] = None):
+        self.path = path
+        self.model = model
+        self.issue = issue
+        self.budgets = budgets if budgets is not None else budgets_from_env()
+        self.prices = prices_for(model)
+        self.calls: list = []
+        self.totals = _zero_totals()
+        self.run = {"run_id": uuid.uuid4().hex[:12], "started": time.time(), "model": model}
+        self._state = "ok"
+        self._lock = threading.Lock()
+        self.previous = self._load()
+        self._update_state()  # earlier runs may already have used up the issue budget
+
+    def _load(self) -> dict:
+        if not self.path or not os.path.isfile(self.path):
+            return {"runs": []}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data.get("runs"), list) else {"runs": []}
+        except (OSError, ValueError):
+            return {"runs": []}
+
+    def cost(self, usage: dict) -> float:
+        p_in, p_out, p_cached = self.prices
+        prompt = int(usage.get("prompt_token_count") or 0)
+        cached = int(usage.get("cached_content_token_count") or 0)
+        out = int(usage.get("candidates_token_count") or 0) + int(usage.get("thoughts_token_count") or 0)
+        m_in = m_out = 1.0
+        if prompt > LONG_CONTEXT_TOKENS and "pro" in self.model:
+            m_in, m_out = 2.0, 1.5
+        return ((prompt - cached) * p_in * m_in + cached * p_cached * m_in + out * p_out * m_out) / 1e6
+
+    def record(self, pass_name: str, usage: Optional[dict] = None, latency_s: float = 0.0, finish_reason=None,
+               model_version=None, attempts: int = 1, cache_hit: bool = False, served: bool = True,
+               **extra) -> dict:
+        """Add one call; returns the entry. Cache hits cost nothing; served=False
+        (the losing copy of a hedged request) is billed but its output is not used."""
+        usage = usage or {}
+        out = int(usage.get("candidates_token_count") or 0)
+        entry = {
+            "pass": pass_name,
+            "ts": round(time.time(), 3),
+            "input_tokens": int(usage.get("prompt_token_count") or 0),
+            "output_tokens": out,
+            "cached_tokens": int(usage.get("cached_content_token_count") or 0),
+            "thoughts_tokens": int(usage.get("thoughts_token_count") or 0),
+            "latency_s": round(latency_s, 3),
+            "finish_reason": str(finish_reason) if finish_reason is not None else None,
+            "model_version": model_version,
+            "attempts": attempts,
+            "cache": "hit" if cache_hit else "miss",
+            "cost_usd": 0.0 if cache_hit else round(self.cost(usage), 6),
+            **extra,
+        }
+        with self._lock:
+            self.calls.append(entry)
+            t = self.totals
+            t["served_output_tokens"] += out if served else 0
+            if cache_hit:
+                t["cache_hits"] += 1
+            else:
+                t["calls"] += 1
+                t["input_tokens"] += entry["input_tokens"]
+                t["output_tokens"] += out + entry["thoughts_tokens"]
+                t["cached_tokens"] += entry["cached_tokens"]
+                t["cost_usd"] += entry["cost_usd"]
+        self._update_state()
+        return entry
+
+    def issue_totals(self) -> dict:
+        out = _zero_totals()
+        for run in self.previous.get("runs", []) + [{"totals": self.totals}]:
+            for k, v in (run.get("totals") or {}).items():
+                if k in out:
+                    out[k] += v
+        out["cost_usd"] = round(out["cost_usd"], 6)
+        return out
+
+    def _usage_ratio(self) -> tuple:
+        """(highest fraction of any budget used, name of that budget)."""
+        b, run, issue = self.budgets, self.totals, self.issue_totals()
+        used = {
+            "run_tokens": run["input_tokens"] + run["output_tokens"],
+            "run_usd": run["cost_usd"],
+            "issue_tokens": issue["input_tokens"] + issue["output_tokens"],
+            "issue_usd": issue["cost_usd"],
+        }
+        ratios = [(used[k] / b[k], k) for k in used if b.get(k)]
+        return max(ratios) if ratios else (0.0, "")
+
+    def _update_state(self) -> None:
+        ratio, name = self._usage_ratio()
+        new = "exceeded" if ratio >= 1.0 else "degraded" if ratio >= self.budgets.get("degrade_at", 0.8) else "ok"
+        with self._lock:
+            old = self._state
+            if STATES.index(new) <= STATES.index(old):
+                return  # states only escalate
+            self._state = new
+        if new != old:
+            action = "refusing further calls" if new == "exceeded" else "no more continuations or hedges"
+            print(f"WARN: {name} budget {ratio:.0%} used; {action}", file=sys.stderr)
+
+    def state(self) -> str:
+        """"ok", "degraded" or "exceeded"."""
+        with self._lock:
+            return self._state
+
+    def save(self, status: Optional[str] = None) -> dict:
+        """Write the ledger file (if a path is set); returns this run's record."""
+        with self._lock:
+            totals = dict(self.totals, cost_usd=round(self.totals["cost_usd"], 6))
+            run = dict(self.run, finished=time.time(), totals=totals, budgets=self.budgets,
+                       status=status or {"ok": "ok", "degraded": "degraded", "exceeded": "aborted"}[self._state],
+                       calls=list(self.calls))
+        if self.path:
+            runs = self.previous.get("runs", [])[-200:] + [run]
+            for old in runs[:-KEEP_CALL_DETAIL]:
+                old.pop("calls", None)
+            data = {"issue": self.issue, "runs": runs, "issue_totals": self.issue_totals()}
+            dest = Path(self.path)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmp = dest.with_name(f".{dest.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps(data, indent=2), encoding="utf-8")
+            os.replace(tmp, dest)
+        return run
@@ -4,29 +4,51 @@ Minimal utilities for the PDF pipeline.
 
 This module provides helper functions for:
   - Creating directories (mkdirp)
-  - Downloading files over HTTP(S) (http_get)  ← no GitHub CLI fallback
-  - JSON read/write helpers
+  - Downloading files over HTTP(S) (http_get / http_download)  ← no GitHub CLI fallback
+  - A shared keep-alive HTTP session and HEAD helper (get_session / http_head)
+  - JSON read/write helpers, thread-safe temp names for atomic replaces
+    (tmp_path) and the load-or-build cache of JSON records by content hash
+    (load_or_build_json)
+  - Config files parsed once per process and re-read only when they change (read_cached)
   - Simple file checks and image listing helpers
 
 Notes:
 - The previous GitHub user-attachments fallback via `gh api` has been removed.
 - For the new flow, PDFs are committed to the repo (e.g., upload-pdf/*.pdf) and
   read locally by the pipeline. http_get remains for any plain public URLs.
+- All requests go through one pooled requests.Session per process, so a HEAD
+  probe and the following GET reuse the same connection. Downloads resume with
+  a Range request after a dropped connection, retry transient failures with
+  exponential backoff, enforce a byte cap while streaming and hash the content
+  as it arrives.
 """
 
 from __future__ import annotations
 
+import hashlib
+import io
 import json
+import os
+import random
+import threading
+import time
 from pathlib import Path
 from typing import Optional, Union
 
 import requests
+from requests.adapters import HTTPAdapter
 
 __all__ = [
     "mkdirp",
+    "get_session",
+    "http_head",
+    "http_download",
     "http_get",
     "write_json",
     "read_json",
+    "tmp_path",
+    "load_or_build_json",
+    "read_cached",
     "file_nonempty",
     "list_images_nonempty",
 ]
@@ -38,12 +60,183 @@ def mkdirp(path: str) -> str:
     return path
 
 
+_SESSION: Optional[requests.Session] = None
+_SESSION_LOCK = threading.Lock()
+
+# Status codes worth retrying; anything else non-2xx fails immediately.
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+def get_session() -> requests.Session:
+    """Return this process's shared keep-alive session (created on first use).
+
+    requests.Session is safe to share across the pipeline's fetch threads for
+    plain GET/HEAD; the adapter pool keeps up to 16 connections per host.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            sess = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=0)
+            sess.mount("http://", adapter)
+            sess.mount("https://", adapter)
+            _SESSION = sess
+        return _SESSION
+
+
+def http_head(
+    url: str,
+    headers: Optional[dict] = None,
+    timeout: int = 8,
+    session: Optional[requests.Session] = None,
+) -> Optional[requests.Response]:
+    """HEAD a URL on the shared session (follows redirects); None on network errors."""
+    sess = session or get_session()
+    try:
+        return sess.head(url, headers=headers or {}, timeout=timeout, allow_redirects=True)
+    except requests.RequestException:
+        return None
+
+
+def _backoff_sleep(attempt: int, backoff: float, retry_after: Optional[str] = None) -> None:
+    delay = backoff * (2 ** attempt)
+    if retry_after and retry_after.strip().isdigit():
+        delay = max(delay, float(retry_after))
+    time.sleep(delay * (0.5 + random.random() / 2))
+
+
+def http_download(
+    url: str,
+    dest_path: Optional[Union[str, Path]] = None,
+    headers: Optional[dict] = None,
+    timeout: int = 120,
+    chunk_size: int = 64 * 1024,
+    max_bytes: Optional[int] = None,
+    retries: int = 4,
+    backoff: float = 1.0,
+    session: Optional[requests.Session] = None,
+) -> dict:
+    """
+    Stream a URL to dest_path (or memory), resuming and hashing as it goes.
+
+    - Uses the shared keep-alive session unless one is injected (e.g. a
+      session pointed at a local test server).
+    - After a dropped connection or timeout the download continues from the
+      last byte received with a Range request (guarded by If-Range on the
+      first response's ETag/Last-Modified); a server that ignores Range
+      restarts the transfer from zero.
+    - Requests are sent with Accept-Encoding: identity so byte offsets match
+      the body; a server that compresses regardless is restarted, not resumed.
+    - Transient failures (connection errors, 408/425/429/5xx) are retried up
+      to `retries` times with exponential backoff, honouring Retry-After.
+    - max_bytes is enforced from Content-Length up front and while streaming.
+    - The file is written to "<dest>.part" and renamed into place on success.
+      chunk_size bounds how much of an interrupted read is lost, so it is
+      kept small.
+
+    Returns:
+        {"path": str or None, "content": bytes or None, "bytes": int,
+         "sha256": hex digest, "attempts": int, "resumed": int}
+
+    Raises:
+        requests.HTTPError for non-retryable (or exhausted) non-2xx responses,
+        RuntimeError when the size cap is exceeded, and the last network
+        error when retries are exhausted.
+    """
+    sess = session or get_session()
+    headers = dict(headers or {})
+    # Byte offsets below (Range, the short-read check, the cap) must refer to
+    # the bytes on the wire, so ask for the body without content coding.
+    headers["Accept-Encoding"] = "identity"
+    dest = Path(dest_path) if dest_path else None
+    if dest is not None:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        part = dest.with_name(dest.name + ".part")
+        out = open(part, "wb")
+    else:
+        out = io.BytesIO()
+
+    h = hashlib.sha256()
+    received, attempts, resumed = 0, 0, 0
+    validator = None
+    resumable = True
+    ok = False
+    try:
+        while True:
+            attempts += 1
+            req_headers = dict(headers)
+            if received and resumable:
+                req_headers["Range"] = f"bytes={received}-"
+                if validator:
+                    req_headers["If-Range"] = validator
+            try:
+                with sess.get(url, headers=req_headers, stream=True, timeout=timeout, allow_redirects=True) as r:
+                    if r.status_code in RETRY_STATUS and attempts <= retries:
+                        _backoff_sleep(attempts - 1, backoff, r.headers.get("Retry-After"))
+                        continue
+                    r.raise_for_status()
+                    if received and r.status_code != 206:
+                        # Range ignored or resource changed: start over
+                        out.seek(0)
+                        out.truncate()
+                        h = hashlib.sha256()
+                        received = 0
+                    elif received:
+                        resumed += 1
+                    validator = validator or r.headers.get("ETag") or r.headers.get("Last-Modified")
+                    length = r.headers.get("Content-Length")
+                    expected = received + int(length) if length and length.isdigit() else None
+                    if r.headers.get("Content-Encoding", "identity").lower() not in ("", "identity"):
+                        # encoded anyway: decoded offsets don't match the wire, so no
+                        # resume and no short-read check (the decoder catches truncation)
+                        resumable, expected = False, None
+                    if max_bytes and expected and expected > max_bytes:
+                        raise RuntimeError(f"Refusing to download oversized file ({expected} bytes > {max_bytes}): {url}")
+                    for chunk in r.iter_content(chunk_size):
+                        if not chunk:
+                            continue
+                        received += len(chunk)
+                        if max_bytes and received > max_bytes:
+                            raise RuntimeError(f"Refusing to download oversized file (> {max_bytes} bytes): {url}")
+                        out.write(chunk)
+                        h.update(chunk)
+                    if expected and received < expected:
+                        raise requests.ConnectionError(f"short read: {received}/{expected} bytes")
+                ok = True
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                if attempts > retries:
+                    raise
+                _backoff_sleep(attempts - 1, backoff)
+    finally:
+        if dest is not None:
+            out.close()
+            if ok:
+                os.replace(part, dest)
+            else:
+                try:
+                    os.remove(part)
+                except OSError:
+                    pass
+
+    return {
+        "path": str(dest) if dest is not None else None,
+        "content": out.getvalue() if dest is None else None,
+        "bytes": received,
+        "sha256": h.hexdigest(),
+        "attempts": attempts,
+        "resumed": resumed,
+    }
+
+
 def http_get(
     url: str,
     headers: Optional[dict] = None,
     dest_path: Optional[Union[str, Path]] = None,
     timeout: int = 120,
-    chunk_size: int = 1024 * 1024,
+    chunk_size: int = 64 * 1024,
+    max_bytes: Optional[int] = None,
+    session: Optional[requests.Session] = None,
 ) -> Union[bytes, str]:
     """
     Download a URL to memory (bytes) or to a file (returns dest path).
@@ -51,6 +244,8 @@ def http_get(
     Simplified downloader for plain HTTP(S) URLs.
     - Follows redirects.
     - No special handling for private GitHub attachments.
+    - Resumes, retries and caps size as described in http_download(), which
+      should be used directly when the content hash is wanted.
 
     Args:
         url: The HTTP(S) URL to fetch.
@@ -59,6 +254,8 @@ def http_get(
                    Otherwise return bytes.
         timeout: Per-request timeout (seconds).
         chunk_size: Streaming chunk size in bytes.
+        max_bytes: Optional size cap, enforced while streaming.
+        session: Optional requests.Session (defaults to the shared one).
 
     Returns:
         str: dest_path if provided, else bytes with the content.
@@ -66,18 +263,16 @@ def http_get(
     Raises:
         requests.HTTPError for non-2xx responses.
     """
-    headers = headers or {}
-    with requests.get(url, headers=headers, stream=True, timeout=timeout, allow_redirects=True) as r:
-        r.raise_for_status()
-        if dest_path:
-            dest = Path(dest_path)
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            with open(dest, "wb") as f:
-                for chunk in r.iter_content(chunk_size):
-                    if chunk:
-                        f.write(chunk)
-            return str(dest)
-        return r.content
+    res = http_download(
+        url,
+        dest_path,
+        headers=headers,
+        timeout=timeout,
+        chunk_size=chunk_size,
+        max_bytes=max_bytes,
+        session=session,
+    )
+    return res["path"] if dest_path else res["content"]
 
 
 def write_json(path: str, obj) -> None:
@@ -94,6 +289,76 @@ def read_json(path: str):
         return json.load(f)
 
 
+def tmp_path(path) -> Path:
+    """Sibling temp name for write-then-os.replace, unique per process and thread.
+
+    The PDF stage prepares documents on a thread pool, so two threads can
+    write the same destination (same content hash) at once; a pid alone would
+    let them share, and clobber, one temp file.
+    """
+    p = Path(path)
+    return p.with_name(f".{p.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+
+
+def load_or_build_json(path, version, build) -> tuple:
+    """
+    (record, cache_hit): the JSON record stored at path when its "version"
+    matches, else build() saved there atomically.
+
+    path None means caching is off. The cache is best effort: unreadable
+    entries are rebuilt and write failures are ignored.
+    """
+    if path is not None:
+        try:
+            with open(path, encoding="utf-8") as f:
+                record = json.load(f)
+            if record.get("version") == version:
+                return record, True
+        except (OSError, ValueError):
+            pass
+
+    record = build()
+    if path is not None:
+        tmp = tmp_path(path)
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(record, f, separators=(",", ":"))
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    return record, False
+
+
+_FILE_CACHE: dict = {}
+_FILE_CACHE_LOCK = threading.Lock()
+
+
+def read_cached(path, parse=None):
+    """Return the text of path (or parse(text)), memoized until the file changes.
+
+    Keyed by absolute path, mtime and size, so a long-lived process (worker.py)
+    reads prompts and routing rules once and picks up edits. Callers must not
+    mutate the returned object.
+    """
+    p = Path(path).resolve()
+    st = p.stat()
+    key = (str(p), parse)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _FILE_CACHE_LOCK:
+        hit = _FILE_CACHE.get(key)
+    if hit is not None and hit[0] == stamp:
+        return hit[1]
+    text = p.read_text(encoding="utf-8")
+    value = parse(text) if parse else text
+    with _FILE_CACHE_LOCK:
+        _FILE_CACHE[key] = (stamp, value)
+    return value
+
+
 def file_nonempty(p: Path) -> bool:
     """Return True if the path exists, is a file, and has size > 0."""
     try:
@@ -18,11 +18,12 @@ import json
 from pathlib import Path
 
 
-def main():
-    if len(sys.argv) < 2:
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 1:
         print("Usage: validate_and_fix_md.py <path>")
         sys.exit(1)
-    p = Path(sys.argv[1])
+    p = Path(argv[0])
     text = p.read_text(encoding="utf-8")
     issues = []
     required_sections = [
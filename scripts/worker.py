@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+worker.py
+Long-lived worker that processes queued issue jobs with warm clients.
+
+Each workflow run is a cold container job: it re-imports PyMuPDF and the
+Vertex SDK, re-initialises the SDK and re-reads prompts and routing rules for
+a single issue. The worker pays those costs once per process and runs the
+pipeline in-process (agent.run_pipeline) for every job it takes from a local
+queue (job_queue.py), so a burst of issue comments is limited by the model
+rather than by container start-up:
+
+  collect -> plan -> prepare -> select -> retrieve -> upload (when a bucket
+  is set) -> prompt -> model -> report.md -> validate_and_fix_md
+
+Usage (from the repository checkout, like the workflow):
+  python scripts/worker.py submit --repo owner/name --issue 42 --event issue_comment
+  python scripts/worker.py submit --issue 42 --context issue_context.json
+      (context already known, e.g. from a webhook payload: collection is skipped)
+  python scripts/worker.py submit --issue 42 --env EXTRACT_MODE=full ...
+  python scripts/worker.py run [--concurrency 4] [--once]
+  python scripts/worker.py status [--job <id>]
+
+Queue (--queue / WORKER_QUEUE, default .agent/queue): a spool directory, or
+SQLite for *.db / *.sqlite / sqlite:///path (see job_queue.py).
+
+Isolation:
+  - --concurrency slot processes (WORKER_CONCURRENCY, default 2) each run one
+    job at a time, so a job's environment overrides, output and crashes stay
+    with it. A slot that dies or runs one job longer than WORKER_JOB_TIMEOUT_S
+    (default 3600) is replaced and its job marked failed.
+  - A job's files (issue_context.json, prompt_selection.json, prompt.txt,
+    settings.json, summary.txt, pass_stats.json, job.log) live in
+    <work dir>/issue-<n>-<job id>/ (--work-dir / WORKER_WORK_DIR, default
+    .agent/worker); the report goes to <output root>/issue-<n>/report.md, as
+    in the workflow, next to the issue's ledger and images.
+  - At most one job per issue runs at a time; jobs queued for an issue that
+    is waiting are merged into the newest one.
+
+Warm state (per slot process, kept across jobs):
+  - PyMuPDF, the stage modules and the model SDK, imported at start-up;
+  - the model backend and its model clients (model_backend.get_backend), the
+    storage client (upload_to_gcs.default_client) and the HTTP session;
+  - prompts and routing rules (util.read_cached; re-read when they change);
+  - circuit-breaker state and call latencies (retry_policy), and the on-disk
+    PDF, page-index and response caches shared by all slots.
+
+Committing the report, pushing and commenting on the issue stay with the
+caller: each finished job records its report path, per-stage timings, log
+and error in the queue (status).
+
+Stage configuration comes from the environment, as in the workflow
+(OUTPUT_ROOT, PROMPTS_DIR, GCS_BUCKET, GCP_PROJECT_ID, GCP_LOCATION,
+GEMINI_BACKEND, EXTRACT_MODE, ...); a job's --env pairs override it for
+that job only.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import time
+from pathlib import Path
+
+from util import mkdirp, read_json, write_json
+import agent
+import job_queue
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+# ---------------------------
+# Per-job isolation
+# ---------------------------
+
+@contextlib.contextmanager
+def job_env(overrides: dict):
+    """Apply environment overrides for one job and restore them afterwards."""
+    saved = dict(os.environ)
+    os.environ.update({k: str(v) for k, v in overrides.items() if v is not None})
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+@contextlib.contextmanager
+def job_output(log_path: str):
+    """Send this process's stdout/stderr (including subprocesses) to log_path."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(log_path, "ab") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+
+# ---------------------------
+# Pipeline
+# ---------------------------
+
+def warm(opts) -> float:
+    """Import every stage and initialise the model backend; returns seconds taken."""
+    t0 = time.perf_counter()
+    for stage in agent.STAGES:
+        agent.import_stage(stage)
+    import model_backend
+    import validate_and_fix_md  # noqa: F401
+
+    model_backend.get_backend(opts.backend, opts.project, opts.location)
+    return time.perf_counter() - t0
+
+
+def run_job(job: dict, opts) -> tuple:
+    """Run the pipeline (agent.run_pipeline) for one job; returns (status, result)."""
+    import response_cache
+    import retry_policy
+    import run_gemini_sdk
+    import validate_and_fix_md
+
+    issue = int(job["issue"])
+    work = Path(mkdirp(os.path.join(opts.work_dir, f"issue-{issue}-{job['id']}")))
+    ctx_path, summary = str(work / "issue_context.json"), str(work / "summary.txt")
+    timings: dict = {}
+    result = {"work_dir": str(work), "log": str(work / "job.log"), "stages": timings}
+
+    # per-job counters; circuit state and latencies stay warm
+    response_cache.reset_metrics()
+    retry_policy.reset_metrics()
+    run_gemini_sdk.PASS_STATS.clear()
+
+    t0 = time.perf_counter()
+    with job_env(job.get("env") or {}), job_output(result["log"]):
+        try:
+            argv = [
+                "--issue", str(issue), "--context-out", ctx_path,
+                "--selection-out", str(work / "prompt_selection.json"),
+                "--prompt-out", str(work / "prompt.txt"), "--settings", str(work / "settings.json"),
+                "--out", summary, "--project", opts.project, "--location", opts.location,
+                "--model", opts.model, "--backend", opts.backend,
+                "--stats-out", str(work / "pass_stats.json"),
+            ]
+            if job.get("context"):
+                write_json(ctx_path, job["context"])
+                argv += ["--context", ctx_path]
+            else:
+                argv += ["--repo", job["repo"], "--event", job.get("event") or "issues"]
+            pipeline_opts, gemini_argv = agent.parse_args(argv)
+            ctx = agent.run_pipeline(pipeline_opts, gemini_argv, timings)
+            if not Path(summary).is_file() or not Path(summary).stat().st_size:
+                raise RuntimeError("model returned no text")
+
+            issue_dir = mkdirp(ctx.get("artifact_dir") or os.path.join(pipeline_opts.output_root, f"issue-{issue}"))
+            report = os.path.join(issue_dir, "report.md")
+            shutil.copyfile(summary, report)
+            result["report"] = report
+            try:
+                validate_and_fix_md.main([report])
+                result["validation"] = "passed"
+            except SystemExit:
+                result["validation"] = "issues"  # reflection gate only; see job.log
+            status = "done"
+        except (Exception, SystemExit) as e:
+            print(f"ERROR: {type(e).__name__}: {e}", file=sys.stderr)
+            result["error"] = f"{type(e).__name__}: {e}"
+            status = "failed"
+    result["wall_s"] = round(time.perf_counter() - t0, 3)
+    return status, result
+
+
+# ---------------------------
+# Slots + supervisor
+# ---------------------------
+
+def slot_main(opts, worker: str, stop) -> None:
+    """One slot process: warm up, then claim and run jobs until stopped."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor drains on Ctrl-C
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    queue = job_queue.open_queue(opts.queue)
+    print(f"[{worker}] warm in {warm(opts):.1f}s", file=sys.stderr)
+    while not stop.is_set():
+        job = queue.claim(worker)
+        if job is None:
+            if opts.once:
+                return
+            stop.wait(opts.poll)
+            continue
+        merged = f" (+{len(job['merged'])} merged)" if job.get("merged") else ""
+        print(f"[{worker}] issue #{job['issue']} job {job['id']}{merged}: started", file=sys.stderr)
+        status, result = run_job(job, opts)
+        queue.finish(job, status, result)
+        run_s = {stage: t.get("run_s") for stage, t in result["stages"].items()}
+        print(f"[{worker}] issue #{job['issue']} job {job['id']}: {status} in {result['wall_s']}s "
+              f"{json.dumps(run_s)}" + (f" - {result['error']}" if "error" in result else ""),
+              file=sys.stderr)
+
+
+def serve(opts) -> None:
+    queue = job_queue.open_queue(opts.queue)
+    n = queue.recover()
+    if n:
+        print(f"Requeued {n} job(s) left running by a previous worker", file=sys.stderr)
+    stop = multiprocessing.Event()
+    slots, generation = {}, 0
+
+    def start(i: int) -> None:
+        nonlocal generation
+        generation += 1
+        worker = f"{os.getpid()}.{i}.{generation}"
+        proc = multiprocessing.Process(target=slot_main, args=(opts, worker, stop), name=f"worker-{i}")
+        proc.start()
+        slots[i] = (worker, proc)
+
+    def shutdown(signum, frame):
+        if not stop.is_set():
+            print("Stopping: finishing running jobs (signal again to kill)", file=sys.stderr)
+            stop.set()
+        else:
+            for _, proc in slots.values():
+                proc.kill()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    for i in range(opts.concurrency):
+        start(i)
+
+    while slots:
+        time.sleep(1.0)
+        now = time.time()
+        for job in queue.running():
+            if job.get("started") and now - job["started"] > opts.job_timeout:
+                for worker, proc in slots.values():
+                    if worker == job.get("worker") and proc.is_alive():
+                        print(f"Job {job['id']} (issue #{job['issue']}) timed out; restarting its worker",
+                              file=sys.stderr)
+                        proc.kill()
+                        proc.join()
+                        queue.release(worker, f"timed out after {opts.job_timeout}s")
+        for i, (worker, proc) in list(slots.items()):
+            if proc.is_alive():
+                continue
+            proc.join()
+            del slots[i]
+            if proc.exitcode:
+                queue.release(worker, f"worker exited with status {proc.exitcode}")
+                if not stop.is_set():
+                    print(f"Worker {worker} died (status {proc.exitcode}); restarting", file=sys.stderr)
+                    start(i)
+    print(json.dumps({"queue": queue.counts()}), file=sys.stderr)
+
+
+def submit(opts) -> None:
+    env = {}
+    for pair in opts.env:
+        key, sep, value = pair.partition("=")
+        if not sep:
+            raise SystemExit(f"--env expects KEY=VALUE, got {pair!r}")
+        env[key] = value
+    payload = {"repo": opts.repo, "event": opts.event, "env": env}
+    if opts.context:
+        payload["context"] = read_json(opts.context)
+    job = job_queue.new_job(opts.issue, **payload)
+    job_queue.open_queue(opts.queue).put(job)
+    print(job["id"])
+
+
+def status(opts) -> None:
+    queue = job_queue.open_queue(opts.queue)
+    if opts.job:
+        print(json.dumps(queue.get(opts.job), indent=2))
+        return
+    print(json.dumps({"counts": queue.counts(), "running": [
+        {k: j.get(k) for k in ("id", "issue", "worker", "started")} for j in queue.running()
+    ]}, indent=2))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Queue-driven worker for the issue pipeline")
+    p.add_argument("--queue", default=os.environ.get("WORKER_QUEUE", os.path.join(".agent", "queue")),
+                   help="spool directory, or SQLite file (*.db, *.sqlite, sqlite:///path)")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    s = sub.add_parser("submit", help="queue a job for an issue")
+    s.add_argument("--issue", type=int, required=True)
+    s.add_argument("--repo", default=os.environ.get("GITHUB_REPOSITORY", ""))
+    s.add_argument("--event", default="issues", choices=["issues", "issue_comment"])
+    s.add_argument("--context", default="", help="issue context JSON to use instead of collecting it")
+    s.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                   help="environment override for this job (repeatable)")
+
+    r = sub.add_parser("run", help="process jobs until stopped")
+    r.add_argument("--concurrency", type=int, default=_env_int("WORKER_CONCURRENCY", 2))
+    r.add_argument("--once", action="store_true", help="exit when no job can be claimed")
+    r.add_argument("--poll", type=float, default=2.0, help="seconds between queue polls when idle")
+    r.add_argument("--job-timeout", type=int, default=_env_int("WORKER_JOB_TIMEOUT_S", 3600))
+    r.add_argument("--work-dir", default=os.environ.get("WORKER_WORK_DIR", os.path.join(".agent", "worker")))
+    r.add_argument("--backend", default=os.environ.get("GEMINI_BACKEND", "vertex"))
+    r.add_argument("--project", default=os.environ.get("GCP_PROJECT_ID", ""))
+    r.add_argument("--location", default=os.environ.get("GCP_LOCATION", "global"))
+    r.add_argument("--model", default=os.environ.get("WORKER_MODEL", "gemini-2.5-pro"),
+                   help="model when the prepared context names none")
+
+    t = sub.add_parser("status", help="queue counts, running jobs, or one job")
+    t.add_argument("--job", default="")
+
+    opts = p.parse_args(argv)
+    if opts.command == "submit":
+        if not opts.context and not opts.repo:
+            p.error("submit needs --repo (or GITHUB_REPOSITORY) unless --context is given")
+        submit(opts)
+    elif opts.command == "run":
+        if opts.concurrency < 1:
+            p.error("--concurrency must be at least 1")
+        serve(opts)
+    else:
+        status(opts)
+
+
+if __name__ == "__main__":
+    main()
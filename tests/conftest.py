@@ -0,0 +1,8 @@
+"""Shared test setup: the stages are flat modules under scripts/."""
+
+import os
+import sys
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+if SCRIPTS not in sys.path:
+    sys.path.insert(0, SCRIPTS)
@@ -0,0 +1,99 @@
+"""job_queue.py: claim, merge and recovery for both queue implementations."""
+
+import threading
+
+import pytest
+
+import job_queue
+
+
+@pytest.fixture(params=["spool", "sqlite"])
+def queue(request, tmp_path):
+    spec = str(tmp_path / "spool") if request.param == "spool" else f"sqlite:///{tmp_path / 'jobs.db'}"
+    return job_queue.open_queue(spec)
+
+
+def enqueue(queue, issue, at, **payload):
+    return queue.put(job_queue.new_job(issue, enqueued=at, **payload))
+
+
+def test_open_queue_picks_the_implementation(tmp_path):
+    assert isinstance(job_queue.open_queue(str(tmp_path / "q")), job_queue.SpoolQueue)
+    assert isinstance(job_queue.open_queue(str(tmp_path / "q.db")), job_queue.SqliteQueue)
+    assert isinstance(job_queue.open_queue(f"sqlite:///{tmp_path / 'jobs'}"), job_queue.SqliteQueue)
+
+
+def test_claim_runs_newest_job_of_oldest_issue_and_merges_the_rest(queue):
+    a1 = enqueue(queue, 5, 1.0, event="issues")
+    b1 = enqueue(queue, 9, 2.0)
+    a2 = enqueue(queue, 5, 3.0, event="issue_comment")
+
+    job = queue.claim("w1")
+    assert (job["id"], job["issue"], job["status"], job["worker"]) == (a2, 5, "running", "w1")
+    assert job["event"] == "issue_comment" and job["merged"] == [a1]
+    merged = queue.get(a1)
+    assert (merged["status"], merged["merged_into"]) == ("merged", a2)
+
+    assert queue.claim("w2")["id"] == b1
+    assert queue.claim("w3") is None
+    assert queue.counts()["running"] == 2 and queue.counts()["merged"] == 1
+
+
+def test_issue_with_a_running_job_is_skipped_until_it_finishes(queue):
+    first = enqueue(queue, 5, 1.0)
+    job = queue.claim("w1")
+    later = enqueue(queue, 5, 2.0)
+    other = enqueue(queue, 7, 3.0)
+
+    assert queue.claim("w2")["id"] == other  # issue 5 is busy
+    assert queue.claim("w2") is None
+    queue.finish(job, "done", {"report": "r.md"})
+    assert queue.get(first)["status"] == "done" and queue.get(first)["result"] == {"report": "r.md"}
+    assert queue.claim("w2")["id"] == later
+
+
+def test_release_fails_the_jobs_of_a_dead_worker(queue):
+    enqueue(queue, 1, 1.0)
+    enqueue(queue, 2, 2.0)
+    j1, j2 = queue.claim("w1"), queue.claim("w2")
+    queue.release("w1", "worker exited with code -9")
+    assert queue.get(j1["id"])["status"] == "failed"
+    assert queue.get(j1["id"])["result"]["error"] == "worker exited with code -9"
+    assert queue.get(j2["id"])["status"] == "running"
+
+
+def test_recover_requeues_jobs_left_running(queue):
+    enqueue(queue, 1, 1.0)
+    job = queue.claim("w1")
+    assert queue.recover() == 1
+    again = queue.claim("w2")
+    assert (again["id"], again["worker"]) == (job["id"], "w2")
+
+
+def test_concurrent_claims_never_share_an_issue(queue):
+    for i in range(40):
+        enqueue(queue, i % 8, float(i))
+    claimed, errors, lock = [], [], threading.Lock()
+
+    def worker(name):
+        try:
+            while True:
+                job = queue.claim(name)
+                if job is None:
+                    return
+                with lock:
+                    claimed.append(job)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(f"w{i}",)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    # nothing finishes, so each issue runs exactly once and absorbs its other jobs
+    assert sorted(j["issue"] for j in claimed) == list(range(8))
+    assert sum(len(j["merged"]) for j in claimed) == 32
+    assert queue.counts()["pending"] == 0
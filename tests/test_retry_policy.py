@@ -0,0 +1,140 @@
+"""retry_policy.py: classification, retries, circuit breaker and hedging."""
+
+import threading
+import time
+
+import pytest
+
+import retry_policy
+
+
+class HttpError(Exception):
+    def __init__(self, msg, code=None, headers=None):
+        super().__init__(msg)
+        self.code = code
+        self.response = type("Response", (), {"headers": headers or {}, "status_code": code})()
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setenv("GEMINI_RETRY_BASE_S", "0")
+    monkeypatch.setenv("GEMINI_RETRY_CAP_S", "0")
+    retry_policy._BREAKERS.clear()
+    retry_policy._LATENCIES.clear()
+    retry_policy.reset_metrics()
+
+
+@pytest.mark.parametrize("err, kind", [
+    (ServiceUnavailable("backend down"), "transient"),
+    (HttpError("Too many", code=429), "rate_limit"),
+    (RuntimeError("503 Service Unavailable"), "transient"),
+    (HttpError("bad request", code=400), "fatal"),
+    (ValueError("prompt too long"), "fatal"),
+    (RuntimeError("the model is temporarily overloaded"), "transient"),
+])
+def test_classify(err, kind):
+    assert retry_policy.classify(err) == kind
+
+
+def test_retry_after_header_wins_over_jitter():
+    backoff = retry_policy.Backoff(base=1, cap=60)
+    assert backoff.next_delay(HttpError("slow down", code=429, headers={"Retry-After": "7"})) == 7.0
+    assert backoff.next_delay(RuntimeError("429 quota, retry in 3s")) == 3.0
+
+
+def test_call_retries_transient_errors_then_succeeds():
+    outcomes = [RuntimeError("503 busy"), RuntimeError("503 busy"), "ok"]
+
+    def fn():
+        out = outcomes.pop(0)
+        if isinstance(out, Exception):
+            raise out
+        return out
+
+    stats = {}
+    assert retry_policy.call(fn, attempts=5, stats=stats) == "ok"
+    assert stats["attempts"] == 3
+    assert retry_policy.metrics()["retries"] == 2
+
+
+def test_call_does_not_retry_fatal_errors():
+    stats = {}
+    with pytest.raises(ValueError):
+        retry_policy.call(lambda: (_ for _ in ()).throw(ValueError("bad")), attempts=5, stats=stats)
+    assert stats["attempts"] == 1
+
+
+def test_circuit_opens_after_consecutive_failures_and_closes_on_success():
+    breaker = retry_policy.CircuitBreaker("region", failures=2, cooldown_s=0.05)
+    breaker.record(False)
+    assert not breaker.is_open
+    breaker.record(False)
+    assert breaker.is_open and breaker.before_call() > 0
+    time.sleep(0.06)
+    assert breaker.before_call() == 0  # half-open probe
+    assert breaker.before_call() > 0   # only one probe at a time
+    breaker.record(True)
+    assert not breaker.is_open and breaker.before_call() == 0
+
+
+def test_latency_history_is_bounded():
+    for i in range(retry_policy.LATENCY_WINDOW + 100):
+        retry_policy._LATENCIES.append(float(i))
+    assert len(retry_policy._LATENCIES) == retry_policy.LATENCY_WINDOW
+
+
+def test_fast_primary_is_not_hedged(monkeypatch):
+    monkeypatch.setenv("GEMINI_HEDGE_MIN_S", "0")
+    called = []
+    assert retry_policy.hedged(lambda: "primary", lambda: called.append(1)) == "primary"
+    assert called == [] and retry_policy.metrics()["hedges"] == 0
+
+
+def test_slow_primary_is_hedged_and_the_loser_reported(monkeypatch):
+    monkeypatch.setenv("GEMINI_HEDGE_AFTER_S", "0.05")
+    monkeypatch.setenv("GEMINI_HEDGE_MIN_S", "0")
+    release = threading.Event()
+    losers = []
+
+    def slow_primary():
+        release.wait(5)
+        return "primary"
+
+    assert retry_policy.hedged(slow_primary, lambda: "secondary", on_loser=losers.append) == "secondary"
+    assert losers == []  # still running
+    release.set()
+    assert retry_policy.drain_losers(timeout=5) == 0
+    assert losers == ["primary"]
+    m = retry_policy.metrics()
+    assert (m["hedges"], m["hedge_wins"]) == (1, 1)
+
+
+def test_open_circuit_goes_straight_to_secondary_and_counts_only_success():
+    breaker = retry_policy.CircuitBreaker("r1", failures=1, cooldown_s=60)
+    breaker.record(False)
+
+    def failing():
+        raise RuntimeError("503 also down")
+
+    with pytest.raises(RuntimeError):
+        retry_policy.hedged(lambda: "primary", failing, breaker)
+    assert retry_policy.metrics()["hedge_wins"] == 0
+    assert retry_policy.hedged(lambda: "primary", lambda: "secondary", breaker) == "secondary"
+    assert retry_policy.metrics()["hedge_wins"] == 1
+
+
+def test_both_failing_raises_the_primary_error(monkeypatch):
+    monkeypatch.setenv("GEMINI_HEDGE_MIN_S", "0")
+
+    def primary():
+        raise RuntimeError("503 primary")
+
+    def secondary():
+        raise RuntimeError("503 secondary")
+
+    with pytest.raises(RuntimeError, match="primary"):
+        retry_policy.hedged(primary, secondary)
@@ -0,0 +1,192 @@
+"""run_gemini_sdk.py end to end against the offline fake backend (model_backend.FakeBackend)."""
+
+import json
+import random
+import time
+
+import pytest
+
+import model_backend
+import retry_policy
+import run_gemini_sdk
+
+SECTIONS = ["Executive Summary", "Controls", "Assumptions"]
+PROMPT = (
+    "Summarise the attached specification.\n"
+    "- You MUST include the following top-level sections in order: "
+    + ", ".join(SECTIONS) + ". Use these headings exactly.\n"
+)
+
+
+@pytest.fixture(autouse=True)
+def fake_env(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name, value in {
+        "FAKE_GEMINI_TTFB": "0",
+        "FAKE_GEMINI_TPS": "0",
+        "FAKE_GEMINI_OUTPUT_TOKENS": "1200",
+        "GEMINI_CACHE_DIR": str(tmp_path / "responses"),
+        "GEMINI_RETRY_BASE_S": "0",
+        "GEMINI_RETRY_CAP_S": "0",
+        "GEMINI_BREAKER_FAILURES": "1000",
+    }.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(model_backend, "_RNG", random.Random(7))
+    retry_policy._BREAKERS.clear()
+    retry_policy._LATENCIES.clear()
+    retry_policy.reset_metrics()
+    run_gemini_sdk.PASS_STATS.clear()
+
+
+def generate(tmp_path, *flags, prompt=PROMPT):
+    """Run the stage on a two-PDF context; returns (text, ledger calls of this run)."""
+    ledger = tmp_path / "ledger.json"
+    args = run_gemini_sdk.build_parser().parse_args([
+        "--context", "ctx.json", "--model", "gemini-2.5-pro", "--prompt-file", "prompt.txt",
+        "--project", "p", "--location", "r1", "--out", str(tmp_path / "summary.md"),
+        "--backend", "fake", "--ledger", str(ledger), "--retries", "8", *flags,
+    ])
+    ctx = {
+        "issue_number": 1,
+        "artifact_dir": str(tmp_path),
+        "required_sections": SECTIONS,
+        "gcs_uris": ["gs://bkt/issues/1/a.pdf", "gs://bkt/issues/1/b.pdf"],
+        "gcs_hashes": {"gs://bkt/issues/1/a.pdf": "md5:a", "gs://bkt/issues/1/b.pdf": "md5:b"},
+    }
+    text = run_gemini_sdk.run(args, ctx, prompt)
+    return text, json.loads(ledger.read_text())["runs"][-1]["calls"]
+
+
+def headings(text):
+    return [line[3:] for line in text.splitlines() if line.startswith("## ")]
+
+
+def test_single_pass_writes_every_section(tmp_path):
+    text, calls = generate(tmp_path)
+    assert headings(text) == SECTIONS
+    assert (tmp_path / "summary.md").read_text() == text
+    assert [c["pass"] for c in calls] == ["first"]
+    assert calls[0]["finish_reason"] == "STOP"
+
+
+def test_truncated_report_is_continued_without_repeats(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_GEMINI_MAX_TOKENS", "250")
+    monkeypatch.setenv("FAKE_GEMINI_REPEAT_CHARS", "40")  # the model echoes some prior text
+    text, calls = generate(tmp_path, "--continuations", "8")
+    assert headings(text) == SECTIONS
+    assert not run_gemini_sdk.looks_truncated(text)
+    paragraphs = [p for p in text.split("\n\n") if p.strip()]
+    assert len(paragraphs) == len(set(paragraphs))
+    assert calls[0]["finish_reason"] == "MAX_TOKENS"
+    assert [c["pass"] for c in calls[1:]] == [f"continuation-{i}" for i in range(1, len(calls))]
+
+
+def test_continuations_stop_at_the_planned_count(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_GEMINI_MAX_TOKENS", "100")
+    text, calls = generate(tmp_path, "--continuations", "2")
+    assert len(calls) == 3
+    assert run_gemini_sdk.looks_truncated(text)
+
+
+def test_transient_errors_are_retried(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_GEMINI_ERROR_RATE", "0.5")
+    text, calls = generate(tmp_path)
+    assert headings(text) == SECTIONS
+    assert calls[0]["attempts"] > 1
+    assert retry_policy.metrics()["retries"] == calls[0]["attempts"] - 1
+
+
+def test_exhausted_retries_are_recorded_as_failed(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_GEMINI_ERROR_RATE", "1")
+    text, calls = generate(tmp_path, "--retries", "3")
+    assert text == ""
+    assert calls[0]["pass"] == "first"
+    assert {(c["finish_reason"], c["attempts"]) for c in calls} == {("FAILED", 3)}
+
+
+def test_repeated_request_is_served_from_the_response_cache(tmp_path):
+    first, _ = generate(tmp_path)
+    second, calls = generate(tmp_path)
+    assert second == first
+    assert [(c["pass"], c["cache"], c["cost_usd"]) for c in calls] == [("first", "hit", 0.0)]
+
+
+def test_cache_survives_a_new_planned_budget_but_not_an_explicit_one(tmp_path, monkeypatch):
+    first, _ = generate(tmp_path)
+    monkeypatch.setattr(run_gemini_sdk.token_budget, "calibrate_ratio", lambda paths: 0.5)
+    second, calls = generate(tmp_path)
+    assert second == first and calls[0]["cache"] == "hit"
+    _, calls = generate(tmp_path, "--max_output_tokens", "9000")
+    assert calls[0]["cache"] != "hit"
+
+
+def test_stream_continues_after_max_tokens(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_GEMINI_MAX_TOKENS", "400")
+    text, calls = generate(tmp_path, "--stream", "--continuations", "6")
+    assert headings(text) == SECTIONS
+    assert len(calls) > 1 and calls[0]["finish_reason"] == "MAX_TOKENS"
+
+
+def test_sections_are_generated_concurrently_and_assembled_in_order(tmp_path, monkeypatch):
+    text, calls = generate(tmp_path, "--by-section", "--section-concurrency", "3")
+    assert headings(text) == SECTIONS
+    assert sorted(c["pass"] for c in calls) == sorted(f"section:{s}" for s in SECTIONS)
+
+
+class RegionModel(model_backend._FakeModel):
+    """Fake model whose primary region answers slowly."""
+
+    def __init__(self, model_id, system_instruction=None, location=None):
+        super().__init__(model_id, system_instruction)
+        self.location = location
+
+    def generate_content(self, parts, generation_config=None, safety_settings=None, stream=False):
+        if self.location is None:
+            time.sleep(0.5)
+        return super().generate_content(parts, generation_config, safety_settings, stream)
+
+
+def test_hedged_request_bills_the_loser_too(tmp_path, monkeypatch):
+    monkeypatch.setenv("GEMINI_HEDGE_AFTER_S", "0.05")
+    monkeypatch.setenv("GEMINI_HEDGE_MIN_S", "0")
+    monkeypatch.setattr(model_backend.FakeBackend, "model",
+                        lambda self, model_id, system_instruction=None, location=None:
+                        RegionModel(model_id, system_instruction, location))
+    text, calls = generate(tmp_path, "--hedge-location", "r2")
+    assert headings(text) == SECTIONS
+    by_pass = {c["pass"]: c for c in calls}
+    assert by_pass["first"]["region"] == "r2"
+    assert by_pass["hedge-loser:first"]["region"] == "r1"
+    assert by_pass["hedge-loser:first"]["cost_usd"] > 0
+    totals = json.loads((tmp_path / "ledger.json").read_text())["runs"][-1]["totals"]
+    assert totals["calls"] == 2
+    assert totals["served_output_tokens"] == by_pass["first"]["output_tokens"]
+    assert retry_policy.metrics()["hedge_wins"] == 1
+
+
+def test_cached_context_sends_documents_once(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_GEMINI_MAX_TOKENS", "250")
+    backend = model_backend.get_backend("fake", "p", "r1")
+    created = []
+    create = model_backend.FakeBackend.create_context
+    monkeypatch.setattr(model_backend.FakeBackend, "create_context",
+                        lambda self, *a: created.append(create(self, *a)) or created[-1])
+
+    text, calls = generate(tmp_path, "--context-cache", "--continuations", "8", "--no-cache")
+    assert headings(text) == SECTIONS
+    assert len(created) == 1 and backend.contexts == {}  # registered once, deleted at the end
+    pdf_tokens = 2 * 10000
+    assert len(calls) > 2
+    for c in calls:
+        assert c["cached_tokens"] >= pdf_tokens
+        assert c["input_tokens"] - c["cached_tokens"] < 2000  # only the new text is billed at full price
+
+
+def test_cached_context_falls_back_to_plain_requests(tmp_path, monkeypatch):
+    def refuse(self, *a):
+        raise RuntimeError("400 cached content is below the minimum size")
+
+    monkeypatch.setattr(model_backend.FakeBackend, "create_context", refuse)
+    text, calls = generate(tmp_path, "--context-cache", "--no-cache")
+    assert headings(text) == SECTIONS
+    assert calls[0]["cached_tokens"] == 0 and calls[0]["input_tokens"] >= 2 * 10000
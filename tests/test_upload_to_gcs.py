@@ -0,0 +1,143 @@
+"""upload_to_gcs.py against an in-memory object store."""
+
+import base64
+import hashlib
+import threading
+
+import pytest
+
+import upload_to_gcs
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket, self.name = bucket, name
+        self.md5_hash = self.crc32c = None
+        self.chunk_size = None
+
+    def _store(self, data: bytes, composite: bool = False):
+        with self.bucket.lock:
+            self.bucket.objects[self.name] = {"data": data, "composite": composite}
+            self.bucket.writes.append(self.name)
+
+    def upload_from_filename(self, path):
+        with open(path, "rb") as f:
+            self._store(f.read())
+
+    def upload_from_file(self, f, size=None):
+        self._store(f.read(size))
+
+    def compose(self, sources):
+        self._store(b"".join(self.bucket.objects[s.name]["data"] for s in sources), composite=True)
+
+    def reload(self):
+        obj = self.bucket.objects[self.name]
+        # like GCS: composite objects carry no MD5
+        self.md5_hash = None if obj["composite"] else base64.b64encode(hashlib.md5(obj["data"]).digest()).decode()
+        crc = upload_to_gcs._crc32c()
+        if crc is not None:
+            crc.update(obj["data"])
+            self.crc32c = base64.b64encode(crc.digest()).decode()
+
+    def delete(self):
+        with self.bucket.lock:
+            del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects, self.writes = {}, []
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        if name not in self.objects:
+            return None
+        blob = FakeBlob(self, name)
+        blob.reload()
+        return blob
+
+
+class FakeClient:
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, FakeBucket())
+
+
+@pytest.fixture
+def parts(tmp_path):
+    paths = []
+    for i, size in enumerate((1000, 5000, 300)):
+        p = tmp_path / f"doc-pages-{i}.pdf"
+        p.write_bytes(bytes([i]) * size)
+        paths.append(str(p))
+    return paths
+
+
+def test_uploads_in_order_then_skips_unchanged(parts):
+    client = FakeClient()
+    first = upload_to_gcs.upload_all(parts, "gs://bkt/base", "issues/7", client=client, workers=3)
+    assert first["uris"] == [f"gs://bkt/base/issues/7/doc-pages-{i}.pdf" for i in range(3)]
+    assert (first["uploaded"], first["skipped"], first["bytes"]) == (3, 0, 6300)
+
+    bucket = client.bucket("bkt")
+    bucket.writes.clear()
+    second = upload_to_gcs.upload_all(parts, "gs://bkt/base", "issues/7", client=client)
+    assert (second["uploaded"], second["skipped"], second["bytes"]) == (0, 3, 0)
+    assert bucket.writes == []
+
+
+def test_changed_file_is_uploaded_again(parts):
+    client = FakeClient()
+    upload_to_gcs.upload_all(parts, "gs://bkt", "issues/7", client=client)
+    with open(parts[1], "wb") as f:
+        f.write(b"changed")
+    result = upload_to_gcs.upload_all(parts, "gs://bkt", "issues/7", client=client)
+    assert [o["status"] for o in result["objects"]] == ["skipped", "uploaded", "skipped"]
+    assert client.bucket("bkt").objects["issues/7/doc-pages-1.pdf"]["data"] == b"changed"
+
+
+def test_large_file_is_composed_from_slices(tmp_path, monkeypatch):
+    monkeypatch.setenv("GCS_COMPOSITE_MB", "1")
+    big = tmp_path / "big.pdf"
+    data = bytes(range(256)) * (6 * 1024)  # 1.5 MiB -> 6 slices of 256 KiB
+    big.write_bytes(data)
+    client = FakeClient()
+
+    result = upload_to_gcs.upload_all([str(big)], "gs://bkt", "issues/1", client=client)
+    assert result["objects"][0]["status"] == "composed"
+    objects = client.bucket("bkt").objects
+    assert list(objects) == ["issues/1/big.pdf"]  # slices deleted
+    assert objects["issues/1/big.pdf"]["data"] == data
+
+
+def test_checksum_mismatch_after_upload_fails(parts, monkeypatch):
+    monkeypatch.setattr(FakeBlob, "upload_from_filename", lambda self, path: self._store(b"corrupted"))
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        upload_to_gcs.upload_all(parts[:1], "gs://bkt", "issues/7", client=FakeClient())
+
+
+def test_upload_context_records_uris_and_hashes(parts):
+    ctx = {"issue_number": 12, "final_pdf_paths": parts}
+    result = upload_to_gcs.upload_context(ctx, "gs://bkt", client=FakeClient())
+    assert ctx["gcs_uris"] == [f"gs://bkt/issues/12/doc-pages-{i}.pdf" for i in range(3)]
+    md5 = base64.b64encode(hashlib.md5(bytes([0]) * 1000).digest()).decode()
+    assert ctx["gcs_hashes"][ctx["gcs_uris"][0]] == "md5:" + md5
+    assert ctx["upload"] is not None and result["uploaded"] == 3
+
+
+def test_text_mode_retrieval_uploads_nothing():
+    ctx = {"issue_number": 3, "final_pdf_paths": [], "retrieval": {"excerpts_path": "excerpts.txt"}}
+    client = FakeClient()
+    result = upload_to_gcs.upload_context(ctx, "gs://bkt", client=client)
+    assert ctx["gcs_uris"] == [] and result["uploaded"] == 0
+    assert client.buckets == {}
+
+
+def test_missing_bucket_is_an_error(parts):
+    with pytest.raises(RuntimeError, match="No GCS bucket"):
+        upload_to_gcs.upload_all(parts, "", "issues/7", client=FakeClient())
@@ -0,0 +1,176 @@
+"""util: http_download against a local HTTP server, and the atomic JSON cache helpers."""
+
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import util
+
+DATA = bytes(range(256)) * 1024  # 256 KiB
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves DATA with per-path misbehaviour; every request is logged on the server."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            seen = sum(1 for p, _ in server.requests if p == self.path)
+        route = getattr(self, "route_" + self.path.strip("/").replace("-", "_"))
+        route(seen)
+
+    def send_body(self, body, status=200, length=True, **headers):
+        self.send_response(status)
+        self.send_header("ETag", ETAG)
+        if length:
+            self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name.replace("_", "-"), value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_truncated(self):
+        """Announce the whole file, send half of it, then drop the connection."""
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(DATA)))
+        self.end_headers()
+        self.wfile.write(DATA[: len(DATA) // 2])
+        self.wfile.flush()
+        self.close_connection = True
+
+    def route_drop(self, seen):
+        rng = self.headers.get("Range")
+        if rng and self.headers.get("If-Range") == ETAG:
+            start = int(rng.split("=")[1].rstrip("-"))
+            self.send_body(DATA[start:], status=206,
+                           Content_Range=f"bytes {start}-{len(DATA) - 1}/{len(DATA)}")
+        else:
+            self.send_truncated()
+
+    def route_no_range(self, seen):
+        if seen == 1:
+            self.send_truncated()
+        else:
+            self.send_body(DATA)  # ignores Range
+
+    def route_busy(self, seen):
+        if seen == 1:
+            self.send_body(b"slow down", status=429, Retry_After="3")
+        elif seen == 2:
+            self.send_body(b"unavailable", status=503, Retry_After="2")
+        else:
+            self.send_body(DATA)
+
+    def route_ok(self, seen):
+        self.send_body(DATA)
+
+    def route_unlimited(self, seen):
+        self.send_body(DATA, length=False)  # close-delimited, size unknown up front
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    srv.lock, srv.requests = threading.Lock(), []
+    thread = threading.Thread(target=srv.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(util.time, "sleep", delays.append)
+    return delays
+
+
+def fetch(server, path, dest=None, **kw):
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+    with requests.Session() as sess:
+        return util.http_download(url, dest, session=sess, backoff=0, **kw)
+
+
+def test_dropped_connection_is_resumed_with_range(server, tmp_path, sleeps):
+    res = fetch(server, "/drop", tmp_path / "out.pdf")
+    assert (tmp_path / "out.pdf").read_bytes() == DATA
+    assert not (tmp_path / "out.pdf.part").exists()
+    assert (res["bytes"], res["attempts"], res["resumed"]) == (len(DATA), 2, 1)
+    first, second = (h for _, h in server.requests)
+    assert "Range" not in first and first["Accept-Encoding"] == "identity"
+    assert second["Range"] == f"bytes={len(DATA) // 2}-" and second["If-Range"] == ETAG
+
+
+def test_server_ignoring_range_restarts_from_zero(server, sleeps):
+    res = fetch(server, "/no-range")
+    assert res["content"] == DATA
+    assert (res["bytes"], res["attempts"], res["resumed"]) == (len(DATA), 2, 0)
+    assert res["sha256"] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_429_and_503_are_retried_after_retry_after(server, sleeps):
+    res = fetch(server, "/busy")
+    assert res["content"] == DATA and res["attempts"] == 3
+    # jitter takes the delay down to half, never below
+    assert sleeps[0] >= 1.5 and sleeps[1] >= 1.0
+
+
+def test_retries_are_bounded(server, sleeps):
+    with pytest.raises(requests.HTTPError):
+        fetch(server, "/busy", retries=1)
+    assert len(server.requests) == 2
+
+
+def test_content_length_over_the_cap_is_refused_up_front(server, tmp_path):
+    with pytest.raises(RuntimeError, match="oversized"):
+        fetch(server, "/ok", tmp_path / "out.pdf", max_bytes=len(DATA) - 1)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cap_is_enforced_while_streaming(server, tmp_path):
+    with pytest.raises(RuntimeError, match="oversized"):
+        fetch(server, "/unlimited", tmp_path / "out.pdf", max_bytes=100_000, chunk_size=4096)
+    assert list(tmp_path.iterdir()) == []
+    assert fetch(server, "/unlimited", max_bytes=len(DATA))["content"] == DATA
+
+
+def test_sha256_matches_the_bytes_on_disk(server, tmp_path, sleeps):
+    res = fetch(server, "/drop", tmp_path / "out.pdf")
+    assert res["sha256"] == hashlib.sha256((tmp_path / "out.pdf").read_bytes()).hexdigest()
+    assert res["path"] == str(tmp_path / "out.pdf") and res["content"] is None
+
+
+def test_concurrent_builds_of_one_json_record_do_not_collide(tmp_path):
+    path = tmp_path / "index" / "abc.json"
+    barrier = threading.Barrier(8)
+    results, errors = [], []
+
+    def build():
+        barrier.wait()  # every thread misses, then all write at once
+        return {"version": 1, "pages": list(range(1000))}
+
+    def worker():
+        try:
+            results.append(util.load_or_build_json(path, 1, build))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == [] and all(hit is False for _, hit in results)
+    assert sorted(p.name for p in path.parent.iterdir()) == ["abc.json"]
+    assert util.load_or_build_json(path, 1, build) == (results[0][0], True)
+    assert util.load_or_build_json(path, 2, lambda: {"version": 2}) == ({"version": 2}, False)